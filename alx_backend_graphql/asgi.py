@@ -2,6 +2,8 @@
 ASGI config for alx_backend_graphql project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
+HTTP goes to Django; WebSocket connections to /graphql/ serve GraphQL
+subscriptions over the graphql-ws protocols.
 
 For more information on this file, see
 https://docs.djangoproject.com/en/5.2/howto/deployment/asgi/
@@ -13,4 +15,18 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'alx_backend_graphql.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+from alx_backend_graphql.schema import schema  # noqa: E402
+from crm.graphql_ws import GraphQLWSConsumer  # noqa: E402
+
+graphql_ws_application = GraphQLWSConsumer(schema)
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'websocket':
+        if scope['path'].rstrip('/') == '/graphql':
+            return await graphql_ws_application(scope, receive, send)
+        await receive()
+        return await send({'type': 'websocket.close', 'code': 4404})
+    return await django_application(scope, receive, send)
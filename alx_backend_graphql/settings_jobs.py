@@ -0,0 +1,29 @@
+"""
+Lightweight settings profile for cron jobs and scripts (seed_db.py,
+crm/cron_jobs, django-crontab runs).
+
+Jobs only need the ORM: the admin, sessions, messages, static files and
+the GraphQL/Celery apps are left out so django.setup() imports as little
+as possible. Celery itself is still imported by jobs that enqueue tasks.
+"""
+from .settings import *  # noqa: F401,F403
+from .settings import INSTALLED_APPS
+
+JOB_EXCLUDED_APPS = {
+    'django.contrib.admin',
+    'django.contrib.sessions',
+    'django.contrib.messages',
+    'django.contrib.staticfiles',
+    'graphene_django',
+    'django_filters',
+    'django_celery_beat',
+}
+
+INSTALLED_APPS = [app for app in INSTALLED_APPS if app not in JOB_EXCLUDED_APPS]
+
+MIDDLEWARE = []
+
+# Jobs serve no requests; this also keeps system checks from importing the URLconf
+ROOT_URLCONF = None
+
+TEMPLATES = []
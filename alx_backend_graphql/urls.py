@@ -17,9 +17,12 @@ Including another URLconf
 from django.contrib import admin
 from django.urls import path
 from django.urls import path
-from graphene_django.views import GraphQLView
+from crm.profiling import ProfileView
+from crm.views import BatchGraphQLView, CRMGraphQLView
 
 urlpatterns = [
     path('admin/', admin.site.urls),
-    path('graphql/', GraphQLView.as_view(graphiql=True)),
+    path('graphql/', CRMGraphQLView.as_view(graphiql=True, fast_json=True, compress=True)),
+    path('graphql/batch/', BatchGraphQLView.as_view(fast_json=True, compress=True)),
+    path('graphql/profiles/<str:profile_id>/', ProfileView.as_view()),
 ]
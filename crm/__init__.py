@@ -1,4 +1,13 @@
 from __future__ import absolute_import, unicode_literals
-from .celery import app as celery_app
 
 __all__ = ('celery_app',)
+
+
+def __getattr__(name):
+    # The Celery app is loaded on first use, so Django processes and jobs
+    # that never enqueue tasks don't import celery. Workers find it through
+    # `celery -A crm`, which falls back to crm.celery.
+    if name == 'celery_app':
+        from .celery import app
+        return app
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
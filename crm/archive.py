@@ -0,0 +1,130 @@
+"""
+Order archival: orders older than CRM_ORDER_ARCHIVE_AFTER_DAYS move, with
+their product links, from Order to ArchivedOrder so the hot table, its
+indexes and every allOrders count only cover recent history.
+
+Reads opt back in to history with `includeArchived`, which UNIONs the
+archive into the Order queryset (with_archived). Archived orders keep their
+global IDs resolvable through node()/nodes() (archived_in_bulk).
+"""
+from functools import lru_cache
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import BooleanField, Value, prefetch_related_objects
+from django.db.models.query import ModelIterable
+
+from .inventory import release_order_reservations
+from .models import ArchivedOrder, Order
+
+OrderProduct = Order.products.through
+ArchivedOrderProduct = ArchivedOrder.products.through
+
+
+# -------------------- MOVING --------------------
+def archive_orders_before(cutoff, batch_size=None):
+    """
+    Moves orders dated before `cutoff`, oldest first, in one transaction
+    per batch. Safe to rerun or run concurrently. Returns the number moved.
+    """
+    batch_size = batch_size or settings.CRM_ORDER_ARCHIVE_BATCH_SIZE
+    moved = 0
+    while True:
+        with transaction.atomic():
+            qs = Order.objects.filter(order_date__lt=cutoff).order_by("order_date", "id")
+            if connection.features.has_select_for_update_skip_locked:
+                qs = qs.select_for_update(skip_locked=True)
+            orders = list(qs[:batch_size])
+            ids = [order.id for order in orders]
+            links = OrderProduct.objects.filter(order_id__in=ids).values_list("order_id", "product_id")
+
+            ArchivedOrder.objects.bulk_create(
+                [
+                    ArchivedOrder(
+                        id=order.id,
+                        customer_id=order.customer_id,
+                        total_amount=order.total_amount,
+                        order_date=order.order_date,
+                    )
+                    for order in orders
+                ],
+                ignore_conflicts=True,
+            )
+            ArchivedOrderProduct.objects.bulk_create(
+                [ArchivedOrderProduct(archivedorder_id=order_id, product_id=product_id) for order_id, product_id in links],
+                ignore_conflicts=True,
+            )
+            # Deleting would cascade to the orders' reservations: release
+            # them first so no held units disappear with them.
+            release_order_reservations(ids)
+            Order.objects.filter(id__in=ids).delete()
+        moved += len(orders)
+        if len(orders) < batch_size:
+            return moved
+
+
+# -------------------- READING --------------------
+@lru_cache(maxsize=None)
+def archived_rows_iterable(archive_model, lookups):
+    """
+    ModelIterable for with_archived() rows that prefetches the many-to-many
+    `lookups` for the whole page: live rows through the live model, archived
+    rows through `archive_model`'s same-named relations into
+    `row.archived_related[lookup]`.
+    """
+
+    class ArchivedRowsIterable(ModelIterable):
+        def __iter__(self):
+            rows = list(super().__iter__())
+            prefetch_related_objects([row for row in rows if not row.archived], *lookups)
+            archived = [row for row in rows if row.archived]
+            if archived:
+                stand_ins = archive_model._default_manager.only("pk").prefetch_related(*lookups).in_bulk(
+                    [row.pk for row in archived]
+                )
+                for row in archived:
+                    stand_in = stand_ins.get(row.pk)
+                    row.archived_related = {
+                        lookup: list(getattr(stand_in, lookup).all()) if stand_in else [] for lookup in lookups
+                    }
+            yield from rows
+
+    return ArchivedRowsIterable
+
+
+def with_archived(live, archived, prefetch=()):
+    """
+    UNION ALL of a live queryset and its archive's (e.g. Order and
+    ArchivedOrder), yielding live-model instances with an `archived` flag,
+    ordered by id. The archive model must declare the live model's columns
+    first, in the same order. Only LIMIT/OFFSET, count() and order_by() may
+    follow. `prefetch` names many-to-many relations both models declare to
+    load for the rows fetched (archived_rows_iterable).
+    """
+    columns = [field.name for field in live.model._meta.concrete_fields]
+    qs = (
+        live.order_by()
+        .annotate(archived=Value(False, output_field=BooleanField()))
+        .union(
+            archived.order_by().only(*columns).annotate(archived=Value(True, output_field=BooleanField())),
+            all=True,
+        )
+        .order_by("id")
+    )
+    if prefetch:
+        qs._iterable_class = archived_rows_iterable(archived.model, tuple(prefetch))
+    return qs
+
+
+def archived_in_bulk(live_model, archived, pks):
+    """
+    {pk: live-model instance} for the rows of `archived` with these pks,
+    flagged `archived` like with_archived() rows.
+    """
+    columns = [field.attname for field in live_model._meta.concrete_fields]
+    rows = {}
+    for values in archived.filter(pk__in=pks).values_list(*columns):
+        row = live_model(**dict(zip(columns, values)))
+        row.archived = True
+        rows[row.pk] = row
+    return rows
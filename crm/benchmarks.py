@@ -0,0 +1,314 @@
+"""
+Micro-benchmarks for CRM hot paths, run via `python manage.py benchmark <scenario>`.
+
+Scenarios seed synthetic rows into the configured database when it holds
+fewer than `--rows` orders, so point DJANGO_SETTINGS_MODULE at a scratch DB.
+"""
+import random
+import time
+from concurrent.futures import ProcessPoolExecutor
+from decimal import Decimal
+import multiprocessing
+
+from django.db import connections, transaction
+from django.utils import timezone
+
+from .models import Customer, Order
+
+SCENARIOS = {}
+
+
+def scenario(name):
+    def register(func):
+        SCENARIOS[name] = func
+        return func
+    return register
+
+
+def timed(func, *args, **kwargs):
+    started = time.perf_counter()
+    result = func(*args, **kwargs)
+    return time.perf_counter() - started, result
+
+
+# -------------------- SEEDING --------------------
+def ensure_customers(count, batch_size=5000):
+    """
+    Tops the Customer table up to `count` rows.
+    """
+    existing = Customer.objects.count()
+    for start in range(existing, count, batch_size):
+        with transaction.atomic():
+            Customer.objects.bulk_create(
+                [
+                    Customer(name=f"Bench {i}", email=f"bench{i}@example.com")
+                    for i in range(start, min(start + batch_size, count))
+                ]
+            )
+
+
+def ensure_orders(rows, batch_size=5000):
+    """
+    Tops the Order table up to `rows` rows spread over a pool of customers.
+    """
+    missing = rows - Order.objects.count()
+    if missing <= 0:
+        return
+
+    ensure_customers(max(1, rows // 20), batch_size)
+    customer_ids = list(Customer.objects.values_list("id", flat=True))
+
+    now = timezone.now()
+    while missing > 0:
+        chunk = min(batch_size, missing)
+        with transaction.atomic():
+            Order.objects.bulk_create(
+                [
+                    Order(
+                        customer_id=random.choice(customer_ids),
+                        total_amount=Decimal(random.randint(100, 500000)) / 100,
+                        order_date=now,
+                    )
+                    for _ in range(chunk)
+                ],
+                batch_size=batch_size,
+            )
+        missing -= chunk
+
+
+# -------------------- SCENARIOS --------------------
+def _aggregate_shard(bounds):
+    from .tasks import aggregate_order_range
+    return aggregate_order_range(*bounds)
+
+
+@scenario("report")
+def bench_report(rows, workers, shard_size=None, **options):
+    """
+    Sharded weekly report: the chord's subtasks executed by 1..N processes.
+    """
+    from .tasks import combine_partials, order_id_shards
+
+    ensure_orders(rows)
+    shards = order_id_shards(shard_size)
+    lines = [f"report: {Order.objects.count()} orders in {len(shards)} shards"]
+
+    baseline = None
+    for procs in sorted({1, workers}):
+        connections.close_all()
+        with ProcessPoolExecutor(procs, mp_context=multiprocessing.get_context("fork")) as pool:
+            list(pool.map(int, range(procs)))  # spawn workers before timing
+            elapsed, partials = timed(lambda: list(pool.map(_aggregate_shard, shards)))
+        orders, revenue = combine_partials(partials)
+        baseline = baseline or elapsed
+        lines.append(
+            f"  {procs} worker(s): {elapsed:.3f}s  speedup x{baseline / elapsed:.2f}"
+            f"  ({orders} orders, {revenue} revenue)"
+        )
+    return lines
+
+
+def _measure(func, repeat):
+    """
+    Best-of-`repeat` wall time and peak traced memory of `func()`.
+    """
+    import tracemalloc
+
+    best = None
+    for _ in range(repeat):
+        elapsed, result = timed(func)
+        best = elapsed if best is None else min(best, elapsed)
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return best, peak, result
+
+
+@scenario("projection")
+def bench_projection(rows, repeat=5, **options):
+    """
+    1000 allOrders nodes (ten 100-node pages, the connection limit) with and
+    without compact (values_list) records.
+    """
+    from django.test.utils import override_settings
+    from alx_backend_graphql.schema import schema
+
+    ensure_orders(max(rows, 1000))
+    pages = " ".join(
+        f"p{i}: allOrders(first: 100, offset: {i * 100}) {{ edges {{ node {{ id totalAmount orderDate }} }} }}"
+        for i in range(10)
+    )
+    query = f"{{ {pages} }}"
+
+    lines = ["projection: 1000 scalar-only allOrders nodes"]
+    for compact in (False, True):
+        with override_settings(CRM_COMPACT_CONNECTIONS=compact):
+            elapsed, peak, result = _measure(lambda: schema.execute(query), repeat)
+        assert not result.errors, result.errors
+        label = "compact records" if compact else "model instances"
+        lines.append(f"  {label:16}: {elapsed * 1000:7.1f} ms  peak {peak / 1024:8.0f} KiB")
+    return lines
+
+
+@scenario("batch")
+def bench_batch(rows, repeat=5, **options):
+    """
+    One /graphql/batch/ request carrying a page load's operations versus the
+    same operations sent as sequential /graphql/ requests.
+    """
+    from django.test import Client
+
+    ensure_orders(rows)
+    customer_id = Customer.objects.values_list("id", flat=True).first()
+    order_id = Order.objects.values_list("id", flat=True).first()
+    operations = [
+        {"query": f"{{ customer(id: {customer_id}) {{ id name email }} }}"},
+        {"query": f"{{ order(id: {order_id}) {{ id totalAmount customer {{ name }} }} }}"},
+        {"query": "{ allCustomers(first: 50) { totalCount edges { node { id name } } } }"},
+        {"query": "{ allProducts(first: 50) { totalCount edges { node { id name price stock } } } }"},
+        {"query": "{ allOrders(first: 50) { totalCount edges { node { id totalAmount orderDate } } } }"},
+        {"query": "{ allOrders(first: 50, totalAmount_Gte: 100) { edges { node { id customer { name } } } } }"},
+    ]
+    client = Client(HTTP_HOST="localhost")
+
+    def sequential():
+        for operation in operations:
+            assert client.post("/graphql/", operation, content_type="application/json").status_code == 200
+
+    def batched():
+        assert client.post("/graphql/batch/", operations, content_type="application/json").status_code == 200
+
+    lines = [f"batch: {len(operations)} operations per page load"]
+    for label, func in (("sequential requests", sequential), ("one batched request", batched)):
+        elapsed = min(timed(func)[0] for _ in range(repeat))
+        lines.append(f"  {label:20}: {elapsed * 1000:7.1f} ms")
+    return lines
+
+
+@scenario("serialization")
+def bench_serialization(rows, repeat=5, **options):
+    """
+    Encoding time and wire size of a 1000-edge allOrders result.
+    """
+    import gzip
+    import json
+
+    from alx_backend_graphql.schema import schema
+    from .views import brotli, fast_json_dumps, orjson
+
+    ensure_orders(max(rows, 1000))
+    pages = " ".join(
+        f"p{i}: allOrders(first: 100, offset: {i * 100}) "
+        f"{{ edges {{ cursor node {{ id totalAmount orderDate customer {{ name email }} }} }} }}"
+        for i in range(10)
+    )
+    result = schema.execute(f"{{ {pages} }}")
+    assert not result.errors, result.errors
+    payload = {"data": result.data}
+
+    stdlib = min(timed(json.dumps, payload, separators=(",", ":"))[0] for _ in range(repeat))
+    fast = min(timed(fast_json_dumps, payload)[0] for _ in range(repeat))
+    body = fast_json_dumps(payload)
+
+    lines = [
+        "serialization: 1000-edge allOrders response",
+        f"  json.dumps      : {stdlib * 1000:7.2f} ms",
+        f"  fast_json_dumps : {fast * 1000:7.2f} ms  ({'orjson' if orjson else 'stdlib fallback'})",
+        f"  identity        : {len(body):8d} bytes",
+        f"  gzip            : {len(gzip.compress(body, compresslevel=6)):8d} bytes",
+    ]
+    if brotli is not None:
+        lines.append(f"  br              : {len(brotli.compress(body, quality=5)):8d} bytes")
+    return lines
+
+
+def _place_orders(args):
+    from django.db import OperationalError
+    from .inventory import InsufficientStock, take_for_order
+
+    product_id, customer_id, count = args
+    placed = failed = 0
+    try:
+        for _ in range(count):
+            try:
+                with transaction.atomic():
+                    order = Order.objects.create(customer_id=customer_id, total_amount=Decimal("1.00"))
+                    order.products.add(product_id)
+                    take_for_order(order, [product_id])
+                placed += 1
+            except (InsufficientStock, OperationalError):
+                failed += 1
+    finally:
+        connections.close_all()
+    return placed, failed
+
+
+@scenario("inventory")
+def bench_inventory(rows, workers, repeat=5, buckets=None, **options):
+    """
+    Orders/sec on one hot product from `workers` processes, with stock in
+    Product.stock versus spread over StockShard buckets.
+    """
+    from .inventory import set_stock_shards
+    from .models import Product
+
+    ensure_orders(rows)
+    buckets = buckets or workers * 2
+    per_worker = 50 * repeat
+    customer_id = Customer.objects.values_list("id", flat=True).first()
+    product = Product.objects.create(name="Bench hot SKU", price=Decimal("1.00"), stock=0)
+
+    lines = [f"inventory: {workers} worker(s) x {per_worker} orders on one product"]
+    try:
+        for shards in (0, buckets):
+            Product.objects.filter(pk=product.pk).update(stock=workers * per_worker)
+            set_stock_shards(product.pk, shards)
+            connections.close_all()
+            with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("fork")) as pool:
+                list(pool.map(int, range(workers)))  # spawn workers before timing
+                elapsed, results = timed(
+                    lambda: list(pool.map(_place_orders, [(product.pk, customer_id, per_worker)] * workers))
+                )
+            placed = sum(r[0] for r in results)
+            failed = sum(r[1] for r in results)
+            label = f"{shards} stock shards" if shards else "Product.stock"
+            lines.append(f"  {label:16}: {placed / elapsed:8.1f} orders/s  ({placed} placed, {failed} failed)")
+    finally:
+        Order.objects.filter(products=product).delete()
+        set_stock_shards(product.pk, 0)
+        product.delete()
+    return lines
+
+
+@scenario("segments")
+def bench_segments(rows, customers=1000000, repeat=5, **options):
+    """
+    Full RFM recomputation over `customers` customers: grouped-aggregate
+    collection, scoring (pure Python and, when installed, NumPy) and upserts.
+    """
+    import tracemalloc
+    from . import segments
+
+    ensure_orders(rows)
+    ensure_customers(customers)
+
+    tracemalloc.start()
+    collect_s, metrics = timed(segments.collect_metrics)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    lines = [
+        f"segments: {len(metrics)} customers, {Order.objects.count()} orders",
+        f"  collect metrics : {collect_s:7.2f} s  peak {peak / 1024 / 1024:6.1f} MiB",
+    ]
+    passes = [("python", segments._score_python)]
+    if segments.numpy is not None:
+        passes.append(("numpy", segments._score_vectorized))
+    for label, score in passes:
+        best = min(timed(score, metrics)[0] for _ in range(repeat))
+        lines.append(f"  score ({label:6}) : {best:7.2f} s")
+
+    store_s, _ = timed(segments.store_segments, metrics, segments.score_metrics(metrics), timezone.now())
+    lines.append(f"  store segments  : {store_s:7.2f} s")
+    return lines
@@ -0,0 +1,122 @@
+"""
+HTTP caching support for GraphQL reads.
+
+Each CRM model has a change version kept in the Django cache and bumped when
+a write to it commits. A GET query's ETag hashes the document, variables and
+the versions of the models its selection touches, so a conditional request
+can be answered with 304 before any resolver runs. Cache-Control max-age is
+the smallest hint among the selected fields (CACHE_MAX_AGE).
+
+Versions live in the default cache, so ETags are opt-in
+(CRM_GRAPHQL_ETAGS) and need a backend shared by every process that reads
+or writes (Redis, Memcached); crm.checks warns about a process-local one.
+"""
+import hashlib
+import json
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+from .models import Customer, Order, OutboxEvent, Product
+
+VERSION_KEY = "crm:model-version:{}"
+
+# Max-age hints in seconds, keyed by "ParentType.fieldName"
+CACHE_MAX_AGE = {
+    "Query.hello": 3600,
+    "Query.allProducts": 60,
+    "Query.product": 60,
+    "Query.allCustomers": 30,
+    "Query.customer": 30,
+    "Query.allOrders": 10,
+    "Query.order": 10,
+    "Query.node": 10,
+    "Query.nodes": 10,
+    "Query.crmStats": 60,
+    "Query.changes": 0,
+}
+
+# Non-model GraphQL types whose data comes from these models
+TYPE_MODELS = {
+    "ChangeFeed": (OutboxEvent,),
+    "CRMStats": (Customer, Order),
+    "CustomerSegmentType": (Customer,),
+    "Node": (Customer, Product, Order),
+}
+
+VERSIONED_MODELS = (Customer, Product, Order, OutboxEvent)
+
+
+# -------------------- MODEL VERSIONS --------------------
+def bump_model_version(model):
+    key = VERSION_KEY.format(model._meta.label_lower)
+    try:
+        cache.incr(key)
+    except ValueError:
+        # Missing key: seed with a timestamp so a cache flush never
+        # reissues a version a client may still hold.
+        cache.set(key, time.time_ns(), timeout=None)
+
+
+def model_versions(models):
+    keys = {VERSION_KEY.format(model._meta.label_lower): model for model in models}
+    versions = cache.get_many(keys)
+    for key in keys.keys() - versions.keys():
+        cache.add(key, time.time_ns(), timeout=None)
+        versions[key] = cache.get(key)
+    return {keys[key]._meta.label_lower: versions[key] for key in sorted(keys)}
+
+
+# -------------------- SELECTION ANALYSIS --------------------
+def _models_for_type(graphql_type):
+    name = graphql_type.name
+    if name in TYPE_MODELS:
+        return TYPE_MODELS[name]
+    graphene_type = getattr(graphql_type, "graphene_type", None)
+    meta = getattr(graphene_type, "_meta", None)
+    node = getattr(meta, "node", None)
+    if node is not None:
+        meta = node._meta
+    model = getattr(meta, "model", None)
+    return (model,) if model is not None else ()
+
+
+def analyze_operation(schema, document, operation_name=None):
+    """
+    Returns (models, max_age) for the selected operation: every model whose
+    data may appear in the result, and the smallest max-age hint selected.
+    """
+    # Imported here: signal handlers import this module in every process,
+    # including jobs that never execute GraphQL.
+    from graphql import TypeInfo, TypeInfoVisitor, Visitor, get_named_type, visit
+
+    type_info = TypeInfo(schema)
+    models = set()
+    max_ages = []
+
+    class Collector(Visitor):
+        def enter_operation_definition(self, node, *args):
+            if operation_name and (node.name is None or node.name.value != operation_name):
+                return self.SKIP
+
+        def enter_field(self, node, *args):
+            parent = type_info.get_parent_type()
+            field_type = type_info.get_type()
+            if parent is not None:
+                hint = CACHE_MAX_AGE.get(f"{parent.name}.{node.name.value}")
+                if hint is not None:
+                    max_ages.append(hint)
+            if field_type is not None:
+                models.update(_models_for_type(get_named_type(field_type)))
+
+    visit(document, TypeInfoVisitor(type_info, Collector()))
+    max_age = min(max_ages, default=settings.CRM_GRAPHQL_DEFAULT_MAX_AGE)
+    return models, max_age
+
+
+def compute_etag(query, variables, operation_name, versions, scope=""):
+    digest = hashlib.sha256(
+        json.dumps([query, variables, operation_name, versions, scope], sort_keys=True, default=str).encode()
+    ).hexdigest()
+    return f'W/"{digest[:32]}"'
@@ -1,17 +1,29 @@
 from __future__ import absolute_import, unicode_literals
 import os
 from celery import Celery
+from celery.schedules import crontab
 
 # Set default Django settings
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'crm.settings')
 
 app = Celery('crm')
 
-# Use Redis as the broker
-app.conf.broker_url = 'redis://localhost:6379/0'
+# Use Redis as the broker, unless the environment names another
+app.conf.broker_url = os.environ.get('CELERY_BROKER_URL', 'redis://localhost:6379/0')
+
+# Chords (sharded report) need a result backend to collect subtask results
+app.conf.result_backend = os.environ.get('CELERY_RESULT_BACKEND', 'redis://localhost:6379/1')
 
 # Load configuration from Django settings
 app.config_from_object('django.conf:settings', namespace='CELERY')
 
 # Auto-discover tasks from installed apps
 app.autodiscover_tasks()
+
+
+@app.on_after_configure.connect
+def build_crontab_schedules(sender, **kwargs):
+    # Settings spell crontab schedules as dicts of crontab() fields
+    for entry in sender.conf.beat_schedule.values():
+        if isinstance(entry['schedule'], dict):
+            entry['schedule'] = crontab(**entry['schedule'])
@@ -0,0 +1,42 @@
+from django.conf import settings
+from django.core.checks import Warning, register
+
+PROCESS_LOCAL_CACHES = (
+    "django.core.cache.backends.dummy.DummyCache",
+    "django.core.cache.backends.locmem.LocMemCache",
+)
+
+
+def _process_local_cache():
+    return settings.CACHES["default"]["BACKEND"] in PROCESS_LOCAL_CACHES
+
+
+@register()
+def check_etag_cache(app_configs, **kwargs):
+    # Model versions (crm.caching) must be shared with every process that
+    # writes, or a web process keeps answering 304 after a worker's write.
+    if settings.CRM_GRAPHQL_ETAGS and _process_local_cache():
+        return [
+            Warning(
+                "CRM_GRAPHQL_ETAGS is on but the default cache is process-local.",
+                hint="Configure a shared default cache (Redis, Memcached) or turn CRM_GRAPHQL_ETAGS off.",
+                id="crm.W001",
+            )
+        ]
+    return []
+
+
+@register()
+def check_single_flight_cache(app_configs, **kwargs):
+    # Flight keys include model versions too: with process-local versions a
+    # read can join a flight that started before another process's write,
+    # and shared flights would only ever be shared within one process.
+    if settings.CRM_SINGLE_FLIGHT_ENABLED and _process_local_cache():
+        return [
+            Warning(
+                "CRM_SINGLE_FLIGHT_ENABLED is on but the default cache is process-local.",
+                hint="Configure a shared default cache (Redis, Memcached) or turn CRM_SINGLE_FLIGHT_ENABLED off.",
+                id="crm.W002",
+            )
+        ]
+    return []
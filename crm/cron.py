@@ -1,6 +1,4 @@
 from datetime import datetime
-from gql import gql, Client
-from gql.transport.requests import RequestsHTTPTransport
 
 def update_low_stock():
     """
@@ -11,6 +9,11 @@ def update_low_stock():
     log_file = "/tmp/low_stock_updates_log.txt"
 
     try:
+        # Imported here so loading this module (django-crontab does it for
+        # every job) doesn't pay for gql and requests.
+        from gql import gql, Client
+        from gql.transport.requests import RequestsHTTPTransport
+
         # Set up GraphQL client
         transport = RequestsHTTPTransport(
             url="http://localhost:8000/graphql",
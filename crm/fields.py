@@ -0,0 +1,331 @@
+from collections import namedtuple
+from functools import lru_cache, partial
+from operator import itemgetter
+
+import graphene
+from django.conf import settings
+from django.core.exceptions import FieldDoesNotExist, ValidationError
+from django.db.models import Count, OuterRef, Prefetch, Subquery
+from django.db.models.functions import Coalesce
+from django.db.models.query import ValuesListIterable
+from graphene.utils.str_converters import to_camel_case, to_snake_case
+from graphene_django import DjangoConnectionField, DjangoObjectType
+from graphene_django.filter import DjangoFilterConnectionField
+from graphql.execution.values import get_argument_values
+from graphql.language import FieldNode, FragmentSpreadNode, InlineFragmentNode
+from graphql_relay import cursor_to_offset, from_global_id
+
+from .archive import with_archived
+
+
+def to_pk(value, model, type_name):
+    """
+    `model` primary key from either a raw key or a global ID of `type_name`;
+    None for malformed values and global IDs of other types.
+    """
+    decoded = from_global_id(str(value))
+    if decoded.type and decoded.type != type_name:
+        return None
+    try:
+        return model._meta.pk.to_python(decoded.id if decoded.type else value)
+    except ValidationError:
+        return None
+
+
+# -------------------- COMPACT RECORDS --------------------
+@lru_cache(maxsize=None)
+def compact_record_class(model, fields):
+    """
+    Slotted tuple type standing in for `model` rows that only carry `fields`.
+    The first field must be the primary key.
+    """
+    base = namedtuple(f"{model.__name__}Record", fields)
+    return type(base.__name__, (base,), {"__slots__": (), "model": model, "pk": property(itemgetter(0))})
+
+
+class CompactRecordIterable(ValuesListIterable):
+    """
+    values_list() iterable that yields compact records instead of plain tuples.
+    """
+
+    def __iter__(self):
+        record = compact_record_class(self.queryset.model, tuple(self.queryset._fields))
+        return map(record._make, super().__iter__())
+
+
+class CompactNodeMixin:
+    """
+    Lets a DjangoObjectType accept compact records of its model as well as
+    model instances.
+    """
+
+    @classmethod
+    def is_type_of(cls, root, info):
+        if getattr(type(root), "model", None) is cls._meta.model and isinstance(root, tuple):
+            return True
+        return super().is_type_of(root, info)
+
+
+# -------------------- SELECTION ANALYSIS --------------------
+def _selections(selection_set, info):
+    """
+    Flattens fragments so only plain field nodes remain.
+    """
+    for selection in selection_set.selections if selection_set else ():
+        if isinstance(selection, FieldNode):
+            yield selection
+        elif isinstance(selection, InlineFragmentNode):
+            yield from _selections(selection.selection_set, info)
+        elif isinstance(selection, FragmentSpreadNode):
+            yield from _selections(info.fragments[selection.name.value].selection_set, info)
+
+
+def _children(field_nodes, name, info):
+    return [
+        child
+        for node in field_nodes
+        for child in _selections(node.selection_set, info)
+        if child.name.value == name
+    ]
+
+
+def selects_node_field(info, name):
+    """
+    True when the connection's nodes select the GraphQL field `name`.
+    """
+    nodes = _children(_children(info.field_nodes, "edges", info), "node", info)
+    return bool(_children(nodes, name, info))
+
+
+def compact_columns(info, node_type):
+    """
+    Returns the model columns needed to resolve the selected node fields,
+    or None when any selected field needs a model instance (relations,
+    custom resolvers, nested selections).
+    """
+    model = node_type._meta.model
+    graphql_names = {to_camel_case(name): name for name in node_type._meta.fields}
+    columns = [model._meta.pk.attname]
+
+    nodes = _children(_children(info.field_nodes, "edges", info), "node", info)
+    for field in (f for node in nodes for f in _selections(node.selection_set, info)):
+        name = field.name.value
+        if name == "__typename":
+            continue
+        python_name = graphql_names.get(name)
+        if python_name is None or field.selection_set is not None:
+            return None
+        resolver = getattr(node_type, f"resolve_{python_name}", None)
+        if resolver is not None and resolver != getattr(DjangoObjectType, f"resolve_{python_name}", None):
+            return None
+        try:
+            model_field = model._meta.get_field(python_name)
+        except FieldDoesNotExist:
+            return None
+        if model_field.is_relation or not model_field.concrete:
+            return None
+        if model_field.attname not in columns:
+            columns.append(model_field.attname)
+    return columns
+
+
+# -------------------- TOP-N NESTED CONNECTIONS --------------------
+def _prefetch_attr(accessor):
+    return f"_top_{accessor}"
+
+
+def _total_attr(accessor):
+    return f"_{accessor}_total"
+
+
+def page_start(args):
+    """
+    Offset of the first requested edge, combining `after` and `offset`
+    the same way DjangoConnectionField.resolve_connection does.
+    """
+    start = args.get("offset") or 0
+    if args.get("after"):
+        start += cursor_to_offset(args["after"]) + 1
+    return start
+
+
+def page_ordering(order_by):
+    ordering = [to_snake_case(order_by)] if order_by else []
+    return ordering + ["pk"]
+
+
+class PrefetchedPage:
+    """
+    Sequence view over one parent's prefetched window of related rows,
+    positioned at `start` within a relation of `total` rows.
+    """
+
+    def __init__(self, items, start, total):
+        self.items = items
+        self.start = start
+        self.total = total
+
+    def __len__(self):
+        return self.total
+
+    def __getitem__(self, key):
+        if isinstance(key, slice) and key.start is not None and key.start >= self.total:
+            return []
+        if isinstance(key, slice) and key.start is not None and key.start >= self.start and key.step is None:
+            stop = None if key.stop is None else key.stop - self.start
+            return self.items[key.start - self.start:stop]
+        raise IndexError("Only slices from the prefetched window are available.")
+
+
+class TopNConnectionField(DjangoConnectionField):
+    """
+    Nested connection over the `accessor` relation with an `orderBy`
+    argument. When the parent page was loaded by CompactFilterConnectionField
+    the requested window was prefetched for every parent in one windowed
+    query (ROW_NUMBER() OVER (PARTITION BY parent)); otherwise each parent
+    queries its own page.
+    """
+
+    def __init__(self, type_, accessor, *args, **kwargs):
+        kwargs.setdefault("order_by", graphene.String())
+        super().__init__(type_, *args, **kwargs)
+        self.accessor = accessor
+
+    def wrap_resolve(self, parent_resolver):
+        accessor = self.accessor
+
+        def resolver(root, info, **args):
+            items = getattr(root, _prefetch_attr(accessor), None)
+            if items is not None:
+                start = page_start(args)
+                total = getattr(root, _total_attr(accessor), None)
+                return PrefetchedPage(items, start, start + len(items) if total is None else total)
+            related = getattr(root, accessor)
+            if args.get("order_by"):
+                return related.order_by(*page_ordering(args["order_by"]))
+            # .all() keeps a prefetch_related() cache usable
+            return related.all()
+
+        return partial(
+            self.connection_resolver,
+            resolver,
+            self.connection_type,
+            self.get_manager(),
+            self.get_queryset_resolver(),
+            self.max_limit,
+            self.enforce_first_or_last,
+        )
+
+    @classmethod
+    def resolve_queryset(cls, connection, iterable, info, args):
+        if isinstance(iterable, PrefetchedPage):
+            return iterable
+        return super().resolve_queryset(connection, iterable, info, args)
+
+
+def _total_subquery(model, accessor):
+    relation = model._meta.get_field(accessor)
+    if relation.many_to_many:
+        rows = relation.through.objects.filter(**{relation.field.m2m_reverse_field_name(): OuterRef("pk")})
+        key = relation.field.m2m_reverse_field_name()
+    else:
+        rows = relation.related_model.objects.filter(**{relation.field.name: OuterRef("pk")})
+        key = relation.field.name
+    counts = rows.order_by().values(key).annotate(total=Count("*")).values("total")
+    return Coalesce(Subquery(counts), 0)
+
+
+def prefetch_top_n(qs, info, node_type):
+    """
+    For each selected TopNConnectionField on the page's nodes, prefetches
+    that page window for all parents with a single sliced Prefetch (which
+    Django turns into a ROW_NUMBER() window), plus a correlated count when
+    the nested totalCount is selected.
+    """
+    graphql_type = info.schema.get_type(node_type._meta.name)
+    graphql_names = {to_camel_case(name): name for name in node_type._meta.fields}
+    nodes = _children(_children(info.field_nodes, "edges", info), "node", info)
+
+    occurrences = {}
+    for field in (f for node in nodes for f in _selections(node.selection_set, info)):
+        field_def = graphene_field = None
+        name = graphql_names.get(field.name.value)
+        if name is not None:
+            graphene_field = node_type._meta.fields[name]
+            field_def = graphql_type.fields[field.name.value]
+        if isinstance(graphene_field, TopNConnectionField):
+            occurrences.setdefault(name, []).append((graphene_field, field_def, field))
+
+    for name, fields in occurrences.items():
+        graphene_field, field_def = fields[0][:2]
+        arguments = [get_argument_values(field_def, field, info.variable_values) for _, _, field in fields]
+        args = arguments[0]
+        if any(other != args for other in arguments[1:]) or args.get("last") or args.get("before"):
+            continue
+
+        max_limit = graphene_field.max_limit
+        first = args.get("first") or max_limit
+        if not first or first < 0 or (max_limit and first > max_limit):
+            continue
+
+        start = page_start(args)
+        related = graphene_field.node_type
+        window = related.get_queryset(related._meta.model.objects.all(), info).order_by(
+            *page_ordering(args.get("order_by"))
+        )
+        # One extra row per parent tells hasNextPage apart without counting
+        window = window[start:start + first + 1]
+        qs = qs.prefetch_related(Prefetch(graphene_field.accessor, queryset=window, to_attr=_prefetch_attr(graphene_field.accessor)))
+
+        if _children([field for _, _, field in fields], "totalCount", info):
+            qs = qs.annotate(**{_total_attr(graphene_field.accessor): _total_subquery(qs.model, graphene_field.accessor)})
+    return qs
+
+
+# -------------------- FIELD --------------------
+class CompactFilterConnectionField(DjangoFilterConnectionField):
+    """
+    DjangoFilterConnectionField that, when CRM_COMPACT_CONNECTIONS is on and
+    the node selection is scalar-only, fetches values_list() rows and resolves
+    them from compact records instead of instantiating models.
+    The node type must include CompactNodeMixin.
+
+    Nested TopNConnectionField selections are prefetched for the whole page.
+
+    With an `archive_model` the field takes `includeArchived`; when true the
+    same filters run against the archive and both are read as one UNION,
+    with the selected many-to-many relations prefetched for the page.
+    """
+
+    def __init__(self, type_, *args, archive_model=None, **kwargs):
+        if archive_model is not None:
+            kwargs.setdefault("include_archived", graphene.Boolean(default_value=False))
+        super().__init__(type_, *args, **kwargs)
+        self.archive_model = archive_model
+
+    def get_queryset_resolver(self):
+        return partial(super().get_queryset_resolver(), archive_model=self.archive_model)
+
+    @classmethod
+    def resolve_queryset(cls, connection, iterable, info, args, filtering_args, filterset_class, archive_model=None):
+        qs = super().resolve_queryset(connection, iterable, info, args, filtering_args, filterset_class)
+        if archive_model is not None and args.get("include_archived"):
+            archived = super().resolve_queryset(
+                connection, archive_model._default_manager.all(), info, args, filtering_args, filterset_class
+            )
+            prefetch = [
+                field.name for field in archive_model._meta.many_to_many
+                if selects_node_field(info, to_camel_case(field.name))
+            ]
+            return with_archived(qs, archived, prefetch)
+
+        qs = prefetch_top_n(qs, info, connection._meta.node)
+        if not settings.CRM_COMPACT_CONNECTIONS:
+            return qs
+
+        columns = compact_columns(info, connection._meta.node)
+        if columns is None:
+            return qs
+        qs = qs.values_list(*columns)
+        qs._iterable_class = CompactRecordIterable
+        return qs
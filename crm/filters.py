@@ -1,23 +1,37 @@
 import django_filters
-from .models import Customer, Product, Order
+import graphene
+from django.db.models import Exists, OuterRef
+from graphene_django.filter import ListFilter
+
+from .fields import to_pk
+from .models import Customer, CustomerSegment, Product, Order
+
+
+def parse_pks(model, values, type_name):
+    """
+    Converts raw pks or global IDs to typed pks, dropping invalid ones.
+    """
+    pks = (to_pk(value, model, type_name) for value in values)
+    return [pk for pk in pks if pk is not None]
 
 
 # -------------------- CUSTOMER FILTER --------------------
 class CustomerFilter(django_filters.FilterSet):
     name = django_filters.CharFilter(field_name="name", lookup_expr="icontains")
     email = django_filters.CharFilter(field_name="email", lookup_expr="icontains")
-    created_at__gte = django_filters.DateFilter(field_name="created_at", lookup_expr="gte")
-    created_at__lte = django_filters.DateFilter(field_name="created_at", lookup_expr="lte")
 
     # Challenge: custom filter for phone pattern
     phone_pattern = django_filters.CharFilter(method='filter_phone_pattern')
 
+    # RFM segment, as last computed by crm.segments
+    segment = django_filters.ChoiceFilter(field_name="segment__segment", choices=CustomerSegment.SEGMENT_CHOICES)
+
     def filter_phone_pattern(self, queryset, name, value):
         return queryset.filter(phone__startswith=value)
 
     class Meta:
         model = Customer
-        fields = ['name', 'email', 'created_at__gte', 'created_at__lte', 'phone_pattern']
+        fields = ['name', 'email', 'phone_pattern', 'segment']
 
 
 # -------------------- PRODUCT FILTER --------------------
@@ -48,17 +62,43 @@ class OrderFilter(django_filters.FilterSet):
     order_date__gte = django_filters.DateFilter(field_name="order_date", lookup_expr="gte")
     order_date__lte = django_filters.DateFilter(field_name="order_date", lookup_expr="lte")
 
-    # Related lookups
+    # Related lookups. M2M filters use correlated EXISTS subqueries rather
+    # than joins, so an order matching several products is returned once
+    # and totalCount needs no DISTINCT.
     customer_name = django_filters.CharFilter(field_name="customer__name", lookup_expr="icontains")
-    product_name = django_filters.CharFilter(field_name="products__name", lookup_expr="icontains")
+    product_name = django_filters.CharFilter(method='filter_product_name')
 
     # Challenge: filter orders that include a specific product ID
-    product_id = django_filters.NumberFilter(field_name="products__id")
+    product_id = django_filters.NumberFilter(method='filter_product_id')
+
+    # Multi-value filters (raw pks or global IDs)
+    product_ids__in = ListFilter(input_type=graphene.List(graphene.ID), method='filter_product_ids')
+    customer_ids__in = ListFilter(input_type=graphene.List(graphene.ID), method='filter_customer_ids')
+
+    def filter_products(self, queryset, **lookups):
+        # Through the queryset's own products table, so the same filters
+        # apply to ArchivedOrder when includeArchived is requested
+        products = queryset.model._meta.get_field("products")
+        links = products.remote_field.through.objects.filter(**{products.m2m_field_name(): OuterRef("pk")}, **lookups)
+        return queryset.filter(Exists(links))
+
+    def filter_product_name(self, queryset, name, value):
+        return self.filter_products(queryset, product__name__icontains=value)
+
+    def filter_product_id(self, queryset, name, value):
+        return self.filter_products(queryset, product_id=value)
+
+    def filter_product_ids(self, queryset, name, value):
+        return self.filter_products(queryset, product_id__in=parse_pks(Product, value, "ProductType"))
+
+    def filter_customer_ids(self, queryset, name, value):
+        return queryset.filter(customer_id__in=parse_pks(Customer, value, "CustomerType"))
 
     class Meta:
         model = Order
         fields = [
             'total_amount__gte', 'total_amount__lte',
             'order_date__gte', 'order_date__lte',
-            'customer_name', 'product_name', 'product_id'
+            'customer_name', 'product_name', 'product_id',
+            'product_ids__in', 'customer_ids__in',
         ]
@@ -0,0 +1,174 @@
+"""
+Minimal ASGI WebSocket handler serving GraphQL subscriptions.
+
+Speaks both `graphql-transport-ws` (graphql-ws library) and the legacy
+`graphql-ws` (subscriptions-transport-ws) subprotocols.
+"""
+import asyncio
+from functools import partial
+import json
+import logging
+
+from asgiref.sync import sync_to_async
+from graphql import ExecutionResult, GraphQLError, create_source_event_stream, execute, parse, validate
+
+logger = logging.getLogger(__name__)
+
+GRAPHQL_TRANSPORT_WS = "graphql-transport-ws"
+GRAPHQL_WS = "graphql-ws"
+
+# Server -> client message types per protocol
+MESSAGE_TYPES = {
+    GRAPHQL_TRANSPORT_WS: {"next": "next", "error": "error", "complete": "complete"},
+    GRAPHQL_WS: {"next": "data", "error": "error", "complete": "complete"},
+}
+
+
+async def subscribe(schema, query, variable_values=None, operation_name=None, context_value=None):
+    """
+    Like graphene's Schema.subscribe, but each event's selection is executed
+    in a worker thread: payload resolvers run synchronous ORM queries, which
+    Django refuses inside the event loop.
+    """
+    try:
+        document = parse(query)
+    except GraphQLError as error:
+        return ExecutionResult(data=None, errors=[error])
+    validation_errors = validate(schema.graphql_schema, document)
+    if validation_errors:
+        return ExecutionResult(data=None, errors=validation_errors)
+
+    stream = await create_source_event_stream(
+        schema.graphql_schema, document,
+        context_value=context_value, variable_values=variable_values, operation_name=operation_name,
+    )
+    if isinstance(stream, ExecutionResult):
+        return stream
+
+    execute_event = sync_to_async(
+        partial(
+            execute, schema.graphql_schema, document,
+            context_value=context_value, variable_values=variable_values, operation_name=operation_name,
+        )
+    )
+
+    async def results():
+        try:
+            async for event in stream:
+                yield await execute_event(root_value=event)
+        finally:
+            await stream.aclose()
+
+    return results()
+
+
+class GraphQLWSConsumer:
+    def __init__(self, schema):
+        self.schema = schema
+
+    async def __call__(self, scope, receive, send):
+        message = await receive()
+        if message["type"] != "websocket.connect":
+            return
+
+        protocol = next(
+            (p for p in scope.get("subprotocols", []) if p in MESSAGE_TYPES), None
+        )
+        if protocol is None:
+            await send({"type": "websocket.close", "code": 4406})
+            return
+        await send({"type": "websocket.accept", "subprotocol": protocol})
+
+        await Connection(self.schema, scope, protocol, send).run(receive)
+
+
+class Connection:
+    def __init__(self, schema, scope, protocol, send):
+        self.schema = schema
+        self.scope = scope
+        self.protocol = protocol
+        self.types = MESSAGE_TYPES[protocol]
+        self.operations = {}
+        self._send = send
+        self._send_lock = asyncio.Lock()
+
+    async def send(self, payload):
+        async with self._send_lock:
+            await self._send({"type": "websocket.send", "text": json.dumps(payload)})
+
+    async def run(self, receive):
+        try:
+            while True:
+                message = await receive()
+                if message["type"] == "websocket.disconnect":
+                    break
+                if message["type"] != "websocket.receive":
+                    continue
+                try:
+                    data = json.loads(message.get("text") or message.get("bytes") or "")
+                except ValueError:
+                    await self._send({"type": "websocket.close", "code": 4400})
+                    break
+                if not await self.handle(data):
+                    await self._send({"type": "websocket.close", "code": 1000})
+                    break
+        finally:
+            for task in list(self.operations.values()):
+                task.cancel()
+
+    async def handle(self, data):
+        """
+        Dispatches one client message; returns False when the socket should close.
+        """
+        kind = data.get("type")
+        op_id = data.get("id")
+
+        if kind == "connection_init":
+            await self.send({"type": "connection_ack"})
+        elif kind == "ping":
+            await self.send({"type": "pong"})
+        elif kind in ("subscribe", "start"):
+            if op_id in self.operations:
+                self.operations.pop(op_id).cancel()
+            task = asyncio.ensure_future(self.execute(op_id, data.get("payload") or {}))
+            self.operations[op_id] = task
+        elif kind in ("complete", "stop"):
+            task = self.operations.pop(op_id, None)
+            if task is not None:
+                task.cancel()
+        elif kind == "connection_terminate":
+            return False
+        return True
+
+    async def execute(self, op_id, payload):
+        try:
+            result = await subscribe(
+                self.schema,
+                payload.get("query", ""),
+                variable_values=payload.get("variables"),
+                operation_name=payload.get("operationName"),
+                context_value=self.scope,
+            )
+            if isinstance(result, ExecutionResult):
+                errors = [error.formatted for error in result.errors or []]
+                await self.send({"type": self.types["error"], "id": op_id, "payload": self.error_payload(errors)})
+                return
+
+            async for item in result:
+                await self.send({"type": self.types["next"], "id": op_id, "payload": item.formatted})
+            await self.send({"type": self.types["complete"], "id": op_id})
+        except Exception:
+            # The task has no one awaiting it: log the failure and end the
+            # operation with an error instead of leaving the client waiting
+            logger.exception("Subscription %r failed", op_id)
+            errors = [{"message": "Subscription failed."}]
+            await self.send({"type": self.types["error"], "id": op_id, "payload": self.error_payload(errors)})
+        finally:
+            if self.operations.get(op_id) is asyncio.current_task():
+                del self.operations[op_id]
+
+    def error_payload(self, errors):
+        # graphql-transport-ws sends a list of errors; the legacy protocol a single error
+        if self.protocol == GRAPHQL_TRANSPORT_WS:
+            return errors
+        return errors[0] if errors else {"message": "Subscription failed."}
@@ -0,0 +1,328 @@
+"""
+Product stock: taking and returning units without serializing every order
+on the product's row.
+
+An unsharded product keeps its units in Product.stock, taken with a single
+conditional UPDATE. A hot product can be split into StockShard buckets
+(set_stock_shards): takes pick a random bucket, so concurrent orders mostly
+lock different rows, and Product.stock becomes a snapshot of the buckets'
+sum refreshed by compact_product_stock().
+
+Reservations hold units for a checkout until they expire or are attached
+to an order; expired ones are returned by release_expired_reservations().
+"""
+from collections import Counter
+from datetime import timedelta
+from operator import attrgetter
+import random
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.db.models import Exists, F, OuterRef, Sum
+from django.utils import timezone
+
+from .caching import bump_model_version
+from .models import Product, StockReservation, StockShard
+from .pubsub import PRODUCT_SAVED, get_pubsub
+
+SHARD_COUNT_KEY = "crm:stock-shards:{}"
+
+
+class InsufficientStock(Exception):
+    def __init__(self, product_id, quantity):
+        super().__init__(f"Insufficient stock for product {product_id}.")
+        self.product_id = product_id
+        self.quantity = quantity
+
+
+class InvalidReservation(Exception):
+    def __init__(self, reservation_ids):
+        super().__init__(f"Invalid reservation ID: {', '.join(map(str, sorted(reservation_ids)))}")
+        self.reservation_ids = reservation_ids
+
+
+# -------------------- SHARD LAYOUT --------------------
+def shard_count(product_id):
+    """
+    Cached number of stock buckets for a product, 0 when unsharded. Only a
+    hint: a stale value makes the fast path miss and fall back to the
+    locked path, never take from the wrong place.
+    """
+    key = SHARD_COUNT_KEY.format(product_id)
+    count = cache.get(key)
+    if count is None:
+        count = StockShard.objects.filter(product_id=product_id).count()
+        cache.set(key, count, timeout=None)
+    return count
+
+
+def current_stock(product_ids):
+    """
+    {product_id: available units}: the buckets' sum for sharded products,
+    whose Product.stock is only a snapshot, else Product.stock.
+    """
+    stock = dict(Product.objects.filter(pk__in=product_ids).values_list("pk", "stock"))
+    stock.update(
+        StockShard.objects.filter(product_id__in=product_ids)
+        .order_by()
+        .values("product_id")
+        .annotate(total=Sum("count"))
+        .values_list("product_id", "total")
+    )
+    return stock
+
+
+def with_current_stock(products):
+    """
+    Sets each product's `stock` to its available units, e.g. before
+    recording it in an outbox event. Returns the products.
+    """
+    stock = current_stock([product.pk for product in products])
+    for product in products:
+        product.stock = stock.get(product.pk, product.stock)
+    return products
+
+
+def split_evenly(total, buckets):
+    return [total // buckets + (1 if i < total % buckets else 0) for i in range(buckets)]
+
+
+def set_stock_shards(product_id, buckets):
+    """
+    Moves a product's available units into `buckets` shards, or back into
+    Product.stock when `buckets` is 0 or 1.
+    """
+    buckets = buckets if buckets > 1 else 0
+    with transaction.atomic():
+        product = Product.objects.select_for_update().get(pk=product_id)
+        shards = list(StockShard.objects.select_for_update().filter(product_id=product_id).order_by("bucket"))
+        total = sum(shard.count for shard in shards) if shards else product.stock
+
+        StockShard.objects.filter(product_id=product_id).delete()
+        StockShard.objects.bulk_create(
+            [
+                StockShard(product_id=product_id, bucket=bucket, count=count)
+                for bucket, count in enumerate(split_evenly(total, buckets) if buckets else [])
+            ]
+        )
+        Product.objects.filter(pk=product_id).update(stock=total)
+        _stock_changed(product_id)
+        transaction.on_commit(
+            lambda: cache.set(SHARD_COUNT_KEY.format(product_id), buckets, timeout=None), robust=True
+        )
+    return total
+
+
+def compact_product_stock(product_id):
+    """
+    Rebalances a sharded product's buckets and refreshes its Product.stock
+    snapshot. Returns the available units, or None if it is not sharded.
+    """
+    with transaction.atomic():
+        shards = list(StockShard.objects.select_for_update().filter(product_id=product_id).order_by("bucket"))
+        if not shards:
+            return None
+        total = sum(shard.count for shard in shards)
+        for shard, count in zip(shards, split_evenly(total, len(shards))):
+            shard.count = count
+        StockShard.objects.bulk_update(shards, ["count"])
+        if Product.objects.filter(pk=product_id).exclude(stock=total).update(stock=total):
+            _stock_changed(product_id)
+    return total
+
+
+# -------------------- TAKING AND RETURNING --------------------
+def _unsharded(product_id):
+    return Product.objects.filter(
+        ~Exists(StockShard.objects.filter(product_id=OuterRef("pk"))), pk=product_id
+    )
+
+
+def _notify_stock_changed(product_id, delta):
+    bump_model_version(Product)
+    stock = current_stock([product_id]).get(product_id)
+    if stock is not None:
+        get_pubsub().publish(PRODUCT_SAVED, {"id": product_id, "stock": stock, "previous": stock - delta})
+
+
+def _stock_changed(product_id, delta=0):
+    # update() sends no post_save, and bucket changes none at all: bump the
+    # cache version and feed lowStockProduct subscribers once the change
+    # commits, with the summed stock for sharded products and the stock
+    # before this change of `delta` units.
+    transaction.on_commit(lambda: _notify_stock_changed(product_id, delta), robust=True)
+
+
+def take_stock(product_id, quantity=1):
+    """
+    Removes `quantity` units from a product or raises InsufficientStock.
+    Call inside the transaction that uses the units.
+    """
+    buckets = shard_count(product_id)
+    if buckets:
+        start = random.randrange(buckets)
+        for offset in range(buckets):
+            bucket = (start + offset) % buckets
+            if StockShard.objects.filter(product_id=product_id, bucket=bucket, count__gte=quantity).update(
+                count=F("count") - quantity
+            ):
+                _stock_changed(product_id, -quantity)
+                return
+    elif _unsharded(product_id).filter(stock__gte=quantity).update(stock=F("stock") - quantity):
+        _stock_changed(product_id, -quantity)
+        return
+    _adjust_locked(product_id, -quantity)
+
+
+def return_stock(product_id, quantity):
+    """
+    Puts `quantity` units back, into a random bucket when sharded.
+    """
+    buckets = shard_count(product_id)
+    if buckets:
+        if StockShard.objects.filter(product_id=product_id, bucket=random.randrange(buckets)).update(
+            count=F("count") + quantity
+        ):
+            _stock_changed(product_id, quantity)
+            return
+    elif _unsharded(product_id).update(stock=F("stock") + quantity):
+        _stock_changed(product_id, quantity)
+        return
+    _adjust_locked(product_id, quantity)
+
+
+def _adjust_locked(product_id, delta):
+    """
+    Slow path: locks every bucket (or the product row) and applies `delta`,
+    spreading a take over several buckets when no single one can cover it.
+    Buckets are locked in bucket order, as compaction does.
+    """
+    with transaction.atomic():
+        shards = list(StockShard.objects.select_for_update().filter(product_id=product_id).order_by("bucket"))
+        cache.set(SHARD_COUNT_KEY.format(product_id), len(shards), timeout=None)
+
+        if not shards:
+            product = Product.objects.select_for_update().filter(pk=product_id).first()
+            if product is None or product.stock + delta < 0:
+                raise InsufficientStock(product_id, -delta)
+            Product.objects.filter(pk=product_id).update(stock=F("stock") + delta)
+            _stock_changed(product_id, delta)
+            return
+
+        if sum(shard.count for shard in shards) + delta < 0:
+            raise InsufficientStock(product_id, -delta)
+        if delta > 0:
+            min(shards, key=attrgetter("count")).count += delta
+        else:
+            needed = -delta
+            for shard in sorted(shards, key=attrgetter("count"), reverse=True):
+                taken = min(shard.count, needed)
+                shard.count -= taken
+                needed -= taken
+        StockShard.objects.bulk_update(shards, ["count"])
+        _stock_changed(product_id, delta)
+
+
+# -------------------- RESERVATIONS --------------------
+def reserve_stock(product_id, quantity=1, ttl=None, customer_id=None):
+    """
+    Takes `quantity` units and holds them for `customer_id` for `ttl`
+    seconds (CRM_STOCK_RESERVATION_TTL) or until attached to their order.
+    """
+    ttl = settings.CRM_STOCK_RESERVATION_TTL if ttl is None else ttl
+    with transaction.atomic():
+        take_stock(product_id, quantity)
+        return StockReservation.objects.create(
+            product_id=product_id,
+            customer_id=customer_id,
+            quantity=quantity,
+            expires_at=timezone.now() + timedelta(seconds=ttl),
+        )
+
+
+def take_for_order(order, product_ids, reservation_ids=()):
+    """
+    Consumes one unit of each product for `order`. One of the customer's
+    live reservations per product is attached and covers that unit; units
+    it holds beyond it go back to stock. Raises InvalidReservation for ids
+    that are not the order's customer's reservations of these products.
+    Call inside the order's transaction. Returns the ids of the products
+    whose stock changed.
+    """
+    product_ids = set(product_ids)
+    owned = list(
+        StockReservation.objects.select_for_update()
+        .filter(pk__in=reservation_ids, customer_id=order.customer_id, product_id__in=product_ids)
+        .order_by("pk")
+    )
+    foreign = set(reservation_ids) - {reservation.pk for reservation in owned}
+    if foreign:
+        raise InvalidReservation(foreign)
+
+    # Expired or already attached ones fall back to taking stock
+    now = timezone.now()
+    reservations = {}
+    for reservation in owned:
+        if reservation.order_id is None and reservation.expires_at > now:
+            reservations.setdefault(reservation.product_id, reservation)
+    StockReservation.objects.filter(pk__in=[r.pk for r in reservations.values()]).update(
+        order=order, quantity=1, expires_at=None
+    )
+
+    changed = set()
+    # Sorted so concurrent multi-product orders lock rows in the same order
+    for product_id in sorted(product_ids):
+        reservation = reservations.get(product_id)
+        if reservation is None:
+            take_stock(product_id, 1)
+        elif reservation.quantity > 1:
+            return_stock(product_id, reservation.quantity - 1)
+        else:
+            continue
+        changed.add(product_id)
+    return changed
+
+
+def release_order_reservations(order_ids):
+    """
+    Deletes the reservations attached to these orders, e.g. before the
+    orders are archived, returning any units they held beyond the one unit
+    of each product an order consumed. Call inside the deleting transaction.
+    """
+    reservations = list(StockReservation.objects.select_for_update().filter(order_id__in=order_ids))
+    held = Counter()
+    for reservation in reservations:
+        held[reservation.order_id, reservation.product_id] += reservation.quantity
+    surplus = Counter()
+    for (_, product_id), quantity in held.items():
+        surplus[product_id] += quantity - 1
+    for product_id in sorted(surplus):
+        if surplus[product_id]:
+            return_stock(product_id, surplus[product_id])
+    StockReservation.objects.filter(pk__in=[r.pk for r in reservations]).delete()
+    return len(reservations)
+
+
+def release_expired_reservations(batch_size=None):
+    """
+    Returns the units of expired, unattached reservations to stock and
+    deletes them. Returns the number of reservations released.
+    """
+    batch_size = batch_size or settings.CRM_STOCK_RELEASE_BATCH_SIZE
+    released = 0
+    while True:
+        with transaction.atomic():
+            qs = StockReservation.objects.filter(order__isnull=True, expires_at__lte=timezone.now())
+            if connection.features.has_select_for_update_skip_locked:
+                qs = qs.select_for_update(skip_locked=True)
+            expired = list(qs.order_by("expires_at")[:batch_size])
+            quantities = Counter()
+            for reservation in expired:
+                quantities[reservation.product_id] += reservation.quantity
+            for product_id in sorted(quantities):
+                return_stock(product_id, quantities[product_id])
+            StockReservation.objects.filter(pk__in=[r.pk for r in expired]).delete()
+        released += len(expired)
+        if len(expired) < batch_size:
+            return released
@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from crm.ratelimit import LocalMemoryStore, get_store
+
+
+class Command(BaseCommand):
+    help = "Prints the GraphQL admission counters (admitted / rejected requests)."
+
+    def handle(self, *args, **options):
+        store = get_store()
+        if isinstance(store, LocalMemoryStore):
+            self.stderr.write(
+                "CRM_RATE_LIMIT_STORE is per process; counters are only shared with crm.ratelimit.CacheStore."
+            )
+        for name, value in store.counters().items():
+            self.stdout.write(f"{name}: {value}")
@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+
+from crm.benchmarks import SCENARIOS
+
+
+class Command(BaseCommand):
+    help = "Runs a CRM performance benchmark scenario against the configured database."
+
+    def add_arguments(self, parser):
+        parser.add_argument("scenario", choices=sorted(SCENARIOS))
+        parser.add_argument("--rows", type=int, default=100000, help="Orders to seed before measuring.")
+        parser.add_argument("--workers", type=int, default=4, help="Parallel workers, where applicable.")
+        parser.add_argument("--shard-size", type=int, default=None, help="Report shard size override.")
+        parser.add_argument("--customers", type=int, default=1000000, help="Customers for the segments scenario.")
+        parser.add_argument("--buckets", type=int, default=None, help="Stock shards for the inventory scenario.")
+        parser.add_argument("--repeat", type=int, default=5, help="Timed repetitions; the best run is reported.")
+
+    def handle(self, *args, **options):
+        scenario = SCENARIOS[options.pop("scenario")]
+        for line in scenario(**options):
+            self.stdout.write(line)
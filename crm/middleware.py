@@ -0,0 +1,48 @@
+import math
+
+from django.conf import settings
+from django.http import JsonResponse
+from graphene_django.settings import graphene_settings
+
+from .ratelimit import AdmissionGate, client_key, get_store, request_cost
+
+
+def too_many_requests(message, retry_after):
+    response = JsonResponse({"errors": [{"message": message}]}, status=429)
+    response["Retry-After"] = str(max(1, math.ceil(retry_after)))
+    return response
+
+
+class GraphQLAdmissionMiddleware:
+    """
+    Rate limits and admission control for requests under
+    CRM_RATE_LIMIT_PATH_PREFIX (see crm.ratelimit). Rejected requests get
+    429 with Retry-After before the GraphQL view runs.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.gate = AdmissionGate(settings.CRM_MAX_CONCURRENT_REQUESTS)
+
+    def __call__(self, request):
+        if not request.path.startswith(settings.CRM_RATE_LIMIT_PATH_PREFIX):
+            return self.get_response(request)
+
+        store = get_store()
+        burst = settings.CRM_RATE_LIMIT_BURST
+        cost = min(request_cost(graphene_settings.SCHEMA.graphql_schema, request), burst)
+        allowed, retry_after = store.consume(client_key(request), cost, settings.CRM_RATE_LIMIT_RATE, burst)
+        if not allowed:
+            store.incr("rejected_rate")
+            return too_many_requests("Rate limit exceeded.", retry_after)
+
+        if not self.gate.acquire():
+            store.incr("rejected_overload")
+            return too_many_requests("Server is busy, retry later.", settings.CRM_ADMISSION_RETRY_AFTER)
+        store.incr("admitted")
+        try:
+            response = self.get_response(request)
+        finally:
+            self.gate.release()
+        response["X-RateLimit-Cost"] = str(cost)
+        return response
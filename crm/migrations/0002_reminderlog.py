@@ -0,0 +1,28 @@
+# Generated by Django 5.2.7 on 2026-10-19 19:25
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('crm', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReminderLog',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('reminder_date', models.DateField()),
+                ('order_count', models.PositiveIntegerField(default=0)),
+                ('sent_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('customer', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='reminder_logs', to='crm.customer')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('customer', 'reminder_date'), name='unique_customer_reminder_per_day')],
+            },
+        ),
+    ]
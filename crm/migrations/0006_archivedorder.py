@@ -0,0 +1,30 @@
+# Generated by Django 5.2.7 on 2026-10-19 19:50
+
+import django.db.models.deletion
+import django.utils.timezone
+from decimal import Decimal
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('crm', '0005_order_date_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivedOrder',
+            fields=[
+                ('id', models.BigIntegerField(primary_key=True, serialize=False)),
+                ('total_amount', models.DecimalField(decimal_places=2, default=Decimal('0.00'), max_digits=12)),
+                ('order_date', models.DateTimeField()),
+                ('archived_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('customer', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='archived_orders', to='crm.customer')),
+                ('products', models.ManyToManyField(related_name='archived_orders', to='crm.product')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['order_date', 'id'], name='archived_order_date_id_idx')],
+            },
+        ),
+    ]
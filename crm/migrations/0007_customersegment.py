@@ -0,0 +1,30 @@
+# Generated by Django 5.2.7 on 2026-10-19 19:56
+
+import django.db.models.deletion
+import django.utils.timezone
+from decimal import Decimal
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('crm', '0006_archivedorder'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CustomerSegment',
+            fields=[
+                ('customer', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='segment', serialize=False, to='crm.customer')),
+                ('segment', models.CharField(choices=[('champions', 'Champions'), ('loyal', 'Loyal'), ('new', 'New'), ('promising', 'Promising'), ('at_risk', 'At risk'), ('hibernating', 'Hibernating'), ('prospect', 'Prospect')], db_index=True, max_length=20)),
+                ('recency_days', models.PositiveIntegerField(blank=True, null=True)),
+                ('frequency', models.PositiveIntegerField(default=0)),
+                ('monetary', models.DecimalField(decimal_places=2, default=Decimal('0.00'), max_digits=14)),
+                ('r_score', models.PositiveSmallIntegerField(default=0)),
+                ('f_score', models.PositiveSmallIntegerField(default=0)),
+                ('m_score', models.PositiveSmallIntegerField(default=0)),
+                ('computed_at', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.7 on 2026-10-19 20:09
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('crm', '0007_customersegment'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='reminderlog',
+            name='claim_token',
+            field=models.UUIDField(blank=True, db_index=True, editable=False, null=True),
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 5.2.7 on 2026-10-19 20:10
+
+from django.db import migrations, models
+
+
+def number_relayed_events(apps, schema_editor):
+    # Already relayed events keep their id order as feed order
+    OutboxEvent = apps.get_model('crm', 'OutboxEvent')
+    relayed = OutboxEvent.objects.filter(relayed_at__isnull=False).order_by('id')
+    for sequence, event_id in enumerate(relayed.values_list('id', flat=True).iterator(), 1):
+        OutboxEvent.objects.filter(id=event_id).update(sequence=sequence)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('crm', '0008_reminderlog_claim_token'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='outboxevent',
+            name='sequence',
+            field=models.BigIntegerField(blank=True, null=True, unique=True),
+        ),
+        migrations.RunPython(number_relayed_events, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.7 on 2026-10-19 20:37
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('crm', '0010_stockreservation_customer'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='customer',
+            name='name',
+            field=models.CharField(max_length=100),
+        ),
+    ]
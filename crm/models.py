@@ -1,5 +1,6 @@
 # crm/models.py
 from django.db import models
+from django.core.serializers.json import DjangoJSONEncoder
 from django.core.validators import MinValueValidator, RegexValidator, EmailValidator
 from django.utils import timezone
 from decimal import Decimal
@@ -22,6 +23,14 @@ class Product(models.Model):
     price = models.DecimalField(max_digits=10, decimal_places=2, validators=[MinValueValidator(Decimal('0.01'))])
     stock = models.PositiveIntegerField(default=0)
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Stock as loaded, so saves can tell lowStockProduct subscribers
+        # whether it crossed their threshold (crm.signals)
+        instance._loaded_stock = dict(zip(field_names, values)).get("stock")
+        return instance
+
     def __str__(self):
         return self.name
 
@@ -31,5 +40,154 @@ class Order(models.Model):
     total_amount = models.DecimalField(max_digits=12, decimal_places=2, default=Decimal('0.00'))
     order_date = models.DateTimeField(default=timezone.now)
 
+    class Meta:
+        indexes = [
+            # Date ranges and newest-first pages (admin, reminders) without a sort
+            models.Index(fields=['order_date', 'id'], name='order_date_id_idx'),
+        ]
+
     def __str__(self):
         return f"Order {self.pk} - {self.customer}"
+
+
+class ReminderLog(models.Model):
+    """
+    One row per customer per reminder day; the unique constraint makes
+    reminder dispatch idempotent across reruns.
+    """
+    customer = models.ForeignKey(Customer, related_name='reminder_logs', on_delete=models.CASCADE)
+    reminder_date = models.DateField()
+    order_count = models.PositiveIntegerField(default=0)
+    sent_at = models.DateTimeField(default=timezone.now)
+    # Set by the run that inserted the row: only that run sends the reminder
+    claim_token = models.UUIDField(blank=True, null=True, editable=False, db_index=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['customer', 'reminder_date'], name='unique_customer_reminder_per_day'),
+        ]
+
+    def __str__(self):
+        return f"Reminder {self.reminder_date} - customer {self.customer_id}"
+
+
+class OutboxEvent(models.Model):
+    """
+    Transactional outbox: written in the same transaction as the change it
+    describes. The relay numbers events in `sequence` as it publishes them;
+    that gap-free, commit-ordered number is the change-feed cursor (ids are
+    taken at insert time and can commit out of order).
+    """
+    aggregate_type = models.CharField(max_length=50)
+    aggregate_id = models.BigIntegerField()
+    event_type = models.CharField(max_length=50)
+    payload = models.JSONField(encoder=DjangoJSONEncoder)
+    created_at = models.DateTimeField(default=timezone.now)
+    relayed_at = models.DateTimeField(blank=True, null=True)
+    sequence = models.BigIntegerField(blank=True, null=True, unique=True)
+
+    class Meta:
+        ordering = ['id']
+        indexes = [
+            models.Index(fields=['id'], condition=models.Q(relayed_at__isnull=True), name='outbox_pending_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.event_type} {self.aggregate_type}:{self.aggregate_id}"
+
+
+class StockShard(models.Model):
+    """
+    One of N stock buckets for a hot product. While a product has shards,
+    they hold its available units and Product.stock is a snapshot of their
+    sum, refreshed by compaction (crm.inventory).
+    """
+    product = models.ForeignKey(Product, related_name='stock_shards', on_delete=models.CASCADE)
+    bucket = models.PositiveSmallIntegerField()
+    count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['product', 'bucket'], name='unique_product_stock_bucket'),
+        ]
+
+    def __str__(self):
+        return f"Product {self.product_id} bucket {self.bucket}: {self.count}"
+
+
+class StockReservation(models.Model):
+    """
+    Units taken from a product's stock for a customer and held until
+    `expires_at`. Only that customer's orders can attach it, which clears
+    the expiry; expired, unattached reservations are returned to stock by
+    the compaction job.
+    """
+    product = models.ForeignKey(Product, related_name='reservations', on_delete=models.CASCADE)
+    # SET_NULL: a deleted customer's holds still expire and return to stock
+    customer = models.ForeignKey(
+        Customer, related_name='reservations', blank=True, null=True, on_delete=models.SET_NULL
+    )
+    quantity = models.PositiveIntegerField(default=1)
+    order = models.ForeignKey(Order, related_name='reservations', blank=True, null=True, on_delete=models.CASCADE)
+    created_at = models.DateTimeField(default=timezone.now)
+    expires_at = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['expires_at'], condition=models.Q(order__isnull=True), name='reservation_pending_idx'),
+        ]
+
+    def __str__(self):
+        return f"Reservation {self.pk} - {self.quantity} x product {self.product_id}"
+
+
+class ArchivedOrder(models.Model):
+    """
+    An order moved out of the hot Order table by the archival task, keeping
+    its original id. Columns up to order_date mirror Order so the two can
+    be read together with a UNION.
+    """
+    id = models.BigIntegerField(primary_key=True)
+    customer = models.ForeignKey(Customer, related_name='archived_orders', on_delete=models.CASCADE)
+    total_amount = models.DecimalField(max_digits=12, decimal_places=2, default=Decimal('0.00'))
+    order_date = models.DateTimeField()
+    products = models.ManyToManyField(Product, related_name='archived_orders')
+    archived_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['order_date', 'id'], name='archived_order_date_id_idx'),
+        ]
+
+    def __str__(self):
+        return f"Archived order {self.pk} - customer {self.customer_id}"
+
+
+class CustomerSegment(models.Model):
+    """
+    A customer's latest RFM (recency, frequency, monetary) metrics and
+    quintile scores, 5 best, recomputed in bulk by crm.segments. Customers
+    without orders score 0 and are 'prospect'.
+    """
+    SEGMENT_CHOICES = [
+        ('champions', 'Champions'),
+        ('loyal', 'Loyal'),
+        ('new', 'New'),
+        ('promising', 'Promising'),
+        ('at_risk', 'At risk'),
+        ('hibernating', 'Hibernating'),
+        ('prospect', 'Prospect'),
+    ]
+
+    customer = models.OneToOneField(Customer, primary_key=True, related_name='segment', on_delete=models.CASCADE)
+    segment = models.CharField(max_length=20, choices=SEGMENT_CHOICES, db_index=True)
+    recency_days = models.PositiveIntegerField(blank=True, null=True)
+    frequency = models.PositiveIntegerField(default=0)
+    monetary = models.DecimalField(max_digits=14, decimal_places=2, default=Decimal('0.00'))
+    r_score = models.PositiveSmallIntegerField(default=0)
+    f_score = models.PositiveSmallIntegerField(default=0)
+    m_score = models.PositiveSmallIntegerField(default=0)
+    computed_at = models.DateTimeField(default=timezone.now)
+
+    def __str__(self):
+        return f"Customer {self.customer_id} - {self.segment}"
@@ -0,0 +1,114 @@
+from datetime import datetime
+import json
+
+from django.conf import settings
+from django.core import serializers
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.db.models import F, Max
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from .caching import bump_model_version
+from .models import OutboxEvent
+
+OUTBOX_LOG_FILE = "/tmp/crm_outbox_log.txt"
+
+
+# -------------------- WRITING --------------------
+def record_events(instances, event_type):
+    """
+    Appends one outbox event per instance. Call inside the transaction
+    that wrote the instances so the events commit (or roll back) with them.
+    """
+    events = [
+        OutboxEvent(
+            aggregate_type=instance._meta.model_name,
+            aggregate_id=instance.pk,
+            event_type=event_type,
+            payload=row["fields"] | {"id": instance.pk},
+        )
+        for instance, row in zip(instances, serializers.serialize("python", instances))
+    ]
+    # bulk_create sends no post_save, so bump the change version here
+    transaction.on_commit(lambda: bump_model_version(OutboxEvent), robust=True)
+    return OutboxEvent.objects.bulk_create(events)
+
+
+def record_event(instance, event_type):
+    return record_events([instance], event_type)[0]
+
+
+# -------------------- READING --------------------
+def events_since(since=None, limit=100):
+    """
+    Relayed events after cursor `since`, in sequence order. Events appear
+    once the relay has numbered them.
+    """
+    qs = OutboxEvent.objects.filter(sequence__isnull=False)
+    if since is not None:
+        qs = qs.filter(sequence__gt=since)
+    return list(qs.order_by("sequence")[:limit])
+
+
+# -------------------- RELAY --------------------
+def log_publisher(events):
+    """
+    Default publisher: appends each event as a JSON line to OUTBOX_LOG_FILE.
+    """
+    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    with open(OUTBOX_LOG_FILE, "a") as f:
+        for event in events:
+            line = json.dumps(
+                {
+                    "cursor": event.sequence,
+                    "type": event.event_type,
+                    "aggregate": event.aggregate_type,
+                    "id": event.aggregate_id,
+                    "payload": event.payload,
+                },
+                cls=DjangoJSONEncoder,
+            )
+            f.write(f"[{timestamp}] {line}\n")
+
+
+def relay_pending(batch_size=None, publisher=None):
+    """
+    Numbers the oldest unrelayed events with the next feed sequences and,
+    once that commits, publishes them and marks them relayed. Returns the
+    number of events handed to the publisher.
+
+    The relay only sees committed events, so an event whose transaction
+    commits late gets a later sequence instead of leaving a gap behind a
+    feed reader's cursor. Concurrent relays wait on each other's row locks;
+    the unique sequence rejects any overlap that slips through.
+
+    Nothing is published from a transaction that may still roll back.
+    Delivery is at least once: events whose publish failed keep their
+    sequence and are published again, first, by the next relay.
+    """
+    batch_size = batch_size or settings.CRM_OUTBOX_RELAY_BATCH_SIZE
+    publisher = publisher or import_string(settings.CRM_OUTBOX_PUBLISHER)
+
+    with transaction.atomic():
+        qs = OutboxEvent.objects.select_for_update().filter(relayed_at__isnull=True)
+        events = list(qs.order_by(F("sequence").asc(nulls_last=True), "id")[:batch_size])
+        if not events:
+            return 0
+        unnumbered = [event for event in events if event.sequence is None]
+        if unnumbered:
+            last = OutboxEvent.objects.aggregate(last=Max("sequence"))["last"] or 0
+            for offset, event in enumerate(unnumbered, 1):
+                event.sequence = last + offset
+            OutboxEvent.objects.bulk_update(unnumbered, ["sequence"])
+            transaction.on_commit(lambda: bump_model_version(OutboxEvent), robust=True)
+        transaction.on_commit(lambda: _publish(events, publisher))
+    return len(events)
+
+
+def _publish(events, publisher):
+    publisher(events)
+    now = timezone.now()
+    OutboxEvent.objects.filter(pk__in=[event.pk for event in events]).update(relayed_at=now)
+    for event in events:
+        event.relayed_at = now
@@ -0,0 +1,261 @@
+"""
+On-demand profiling of single GraphQL requests.
+
+A staff user, or a client sending one of CRM_PROFILING_API_KEYS, asks for a
+profile with the `X-CRM-Profile: 1` header or a `profile=1` query param.
+The request then runs under a sampling profiler while every SQL statement
+is logged against the resolver path that issued it. Results are written to
+CRM_PROFILING_DIR as <id>.speedscope.json (open in https://speedscope.app)
+and <id>.sql.json, and served by ProfileView; the response carries the id
+in X-CRM-Profile-Id. Other requests only pay for the header check.
+"""
+from contextvars import ContextVar
+import json
+import os
+from pathlib import Path
+import sys
+import threading
+import time
+import uuid
+
+from django.conf import settings
+from django.db import connections
+from django.http import FileResponse, Http404, JsonResponse
+from django.views import View
+
+PROFILE_HEADER = "X-CRM-Profile"
+PROFILE_ID_HEADER = "X-CRM-Profile-Id"
+PROFILE_ID_LENGTH = 32
+ARTIFACTS = {"speedscope": "speedscope.json", "sql": "sql.json"}
+
+# (ParentType.field, response path) of the resolver running on this context
+current_resolver = ContextVar("crm_current_resolver", default=(None, None))
+
+
+# -------------------- ACCESS --------------------
+def can_profile(request):
+    if not settings.CRM_PROFILING_ENABLED:
+        return False
+    if request.user.is_authenticated and request.user.is_staff:
+        return True
+    api_key = request.headers.get(settings.CRM_RATE_LIMIT_KEY_HEADER)
+    return bool(api_key) and api_key in settings.CRM_PROFILING_API_KEYS
+
+
+def profiling_requested(request):
+    flag = request.headers.get(PROFILE_HEADER) or request.GET.get("profile")
+    return flag in ("1", "true") and can_profile(request)
+
+
+# -------------------- SAMPLING --------------------
+class StackSampler(threading.Thread):
+    """
+    Records the call stack of `thread_id` every `interval` seconds. Each
+    sample is weighted by the time since the previous one, so slices where
+    the GIL held the sampler back are not under-counted.
+    """
+
+    def __init__(self, thread_id, interval):
+        super().__init__(name="crm-profiler", daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.frames = []
+        self.frame_index = {}
+        self.samples = []
+        self.weights = []
+        self._stop_event = threading.Event()
+
+    def run(self):
+        last = self.started = time.perf_counter()
+        while not self._stop_event.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            now = time.perf_counter()
+            if frame is not None:
+                self.samples.append(self._stack(frame))
+                self.weights.append(now - last)
+            last = now
+        self.ended = last
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+    def _stack(self, frame):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            key = (code.co_name, code.co_filename, code.co_firstlineno)
+            index = self.frame_index.get(key)
+            if index is None:
+                index = self.frame_index[key] = len(self.frames)
+                self.frames.append({"name": code.co_name, "file": code.co_filename, "line": code.co_firstlineno})
+            stack.append(index)
+            frame = frame.f_back
+        stack.reverse()
+        return stack
+
+    def speedscope(self, name):
+        return {
+            "$schema": "https://www.speedscope.app/file-format-schema.json",
+            "exporter": "crm.profiling",
+            "name": name,
+            "activeProfileIndex": 0,
+            "shared": {"frames": self.frames},
+            "profiles": [
+                {
+                    "type": "sampled",
+                    "name": name,
+                    "unit": "seconds",
+                    "startValue": 0,
+                    "endValue": sum(self.weights),
+                    "samples": self.samples,
+                    "weights": self.weights,
+                }
+            ],
+        }
+
+
+# -------------------- SQL BY RESOLVER --------------------
+class ResolverPathMiddleware:
+    """
+    Graphene middleware publishing the running resolver's path to SQL capture.
+    """
+
+    def resolve(self, next, root, info, **args):
+        token = current_resolver.set(
+            (f"{info.parent_type.name}.{info.field_name}", ".".join(str(key) for key in info.path.as_list()))
+        )
+        try:
+            return next(root, info, **args)
+        finally:
+            current_resolver.reset(token)
+
+
+class SQLCapture:
+    """
+    connection.execute_wrapper recording each statement, its duration and
+    the resolver that was running when it was issued.
+    """
+
+    def __init__(self):
+        self.queries = []
+
+    def __call__(self, execute, sql, params, many, context):
+        resolver, path = current_resolver.get()
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries.append(
+                {
+                    "resolver": resolver,
+                    "path": path,
+                    "alias": context["connection"].alias,
+                    "sql": sql,
+                    "params": [str(param) for param in params or ()] if not many else "<executemany>",
+                    "ms": round((time.perf_counter() - started) * 1000, 3),
+                }
+            )
+
+    def by_resolver(self):
+        summary = {}
+        for query in self.queries:
+            entry = summary.setdefault(query["resolver"] or "(outside resolvers)", {"queries": 0, "ms": 0.0})
+            entry["queries"] += 1
+            entry["ms"] = round(entry["ms"] + query["ms"], 3)
+        return summary
+
+
+# -------------------- REQUEST PROFILE --------------------
+# The switch interval is process-wide: the first profiled request lowers it
+# and the last one to finish restores it.
+_switch_interval_lock = threading.Lock()
+_switch_interval_users = 0
+_saved_switch_interval = None
+
+
+def _lower_switch_interval(interval):
+    global _switch_interval_users, _saved_switch_interval
+    with _switch_interval_lock:
+        if not _switch_interval_users:
+            _saved_switch_interval = sys.getswitchinterval()
+            sys.setswitchinterval(min(_saved_switch_interval, interval))
+        _switch_interval_users += 1
+
+
+def _restore_switch_interval():
+    global _switch_interval_users
+    with _switch_interval_lock:
+        _switch_interval_users -= 1
+        if not _switch_interval_users:
+            sys.setswitchinterval(_saved_switch_interval)
+
+
+class RequestProfiler:
+    """
+    Context manager profiling the current thread's request and writing its
+    artifacts on exit.
+    """
+
+    resolver_middleware = ResolverPathMiddleware()
+
+    def __init__(self, request):
+        self.request = request
+        self.profile_id = uuid.uuid4().hex
+        self.sql = SQLCapture()
+        self.sampler = StackSampler(threading.get_ident(), settings.CRM_PROFILING_INTERVAL)
+
+    def __enter__(self):
+        self._wrappers = [connection.execute_wrapper(self.sql) for connection in connections.all()]
+        for wrapper in self._wrappers:
+            wrapper.__enter__()
+        # The sampler only runs when the request thread yields the GIL
+        _lower_switch_interval(self.sampler.interval)
+        self.sampler.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.sampler.stop()
+        _restore_switch_interval()
+        for wrapper in reversed(self._wrappers):
+            wrapper.__exit__(*exc_info)
+        self.write()
+
+    def write(self):
+        directory = Path(settings.CRM_PROFILING_DIR)
+        directory.mkdir(parents=True, exist_ok=True)
+        name = f"{self.request.method} {self.request.path}"
+        wall_ms = round((self.sampler.ended - self.sampler.started) * 1000, 3)
+        artifacts = {
+            "speedscope": self.sampler.speedscope(name),
+            "sql": {
+                "request": name,
+                "wall_ms": wall_ms,
+                "queries": len(self.sql.queries),
+                "by_resolver": self.sql.by_resolver(),
+                "log": self.sql.queries,
+            },
+        }
+        for kind, suffix in ARTIFACTS.items():
+            path = directory / f"{self.profile_id}.{suffix}"
+            with open(path, "w") as f:
+                json.dump(artifacts[kind], f)
+            os.chmod(path, 0o600)
+
+
+# -------------------- RETRIEVAL --------------------
+class ProfileView(View):
+    """
+    Serves a stored profile: ?format=speedscope (default) or ?format=sql.
+    """
+
+    def get(self, request, profile_id):
+        if not can_profile(request):
+            return JsonResponse({"errors": [{"message": "Profiling is not allowed."}]}, status=403)
+        suffix = ARTIFACTS.get(request.GET.get("format", "speedscope"))
+        if suffix is None or len(profile_id) != PROFILE_ID_LENGTH or not profile_id.isalnum():
+            raise Http404
+        path = Path(settings.CRM_PROFILING_DIR) / f"{profile_id}.{suffix}"
+        if not path.exists():
+            raise Http404
+        return FileResponse(open(path, "rb"), content_type="application/json")
@@ -0,0 +1,97 @@
+"""
+Pub/sub used to push model changes to GraphQL subscriptions.
+
+Publishers call `get_pubsub().publish(channel, message)` from sync code
+(signal handlers); subscribers iterate `get_pubsub().subscribe(channel)`
+inside the ASGI event loop. The backend is chosen by CRM_PUBSUB_BACKEND.
+"""
+import asyncio
+import json
+import threading
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+ORDER_CREATED = "crm.order.created"  # {"id"}
+PRODUCT_SAVED = "crm.product.saved"  # {"id", "stock", "previous"}; previous is None when unknown
+
+_pubsub = None
+_pubsub_lock = threading.Lock()
+
+
+def get_pubsub():
+    global _pubsub
+    if _pubsub is None:
+        with _pubsub_lock:
+            if _pubsub is None:
+                _pubsub = import_string(settings.CRM_PUBSUB_BACKEND)()
+    return _pubsub
+
+
+def _offer(queue, message):
+    # Slow consumers lose their oldest undelivered messages rather than
+    # letting the queue grow without bound.
+    if queue.full():
+        queue.get_nowait()
+    queue.put_nowait(message)
+
+
+# -------------------- IN-PROCESS --------------------
+class InMemoryPubSub:
+    """
+    Delivers messages to subscribers in the same process. Safe to publish
+    from any thread; each subscriber gets a bounded asyncio.Queue.
+    """
+
+    def __init__(self, queue_size=1000):
+        self.queue_size = queue_size
+        self._subscribers = {}
+        self._lock = threading.Lock()
+
+    def publish(self, channel, message):
+        with self._lock:
+            subscribers = list(self._subscribers.get(channel, ()))
+        for loop, queue in subscribers:
+            loop.call_soon_threadsafe(_offer, queue, message)
+
+    async def subscribe(self, channel):
+        entry = (asyncio.get_running_loop(), asyncio.Queue(self.queue_size))
+        with self._lock:
+            self._subscribers.setdefault(channel, set()).add(entry)
+        try:
+            while True:
+                yield await entry[1].get()
+        finally:
+            with self._lock:
+                self._subscribers[channel].discard(entry)
+
+
+# -------------------- REDIS --------------------
+class RedisPubSub:
+    """
+    Fans messages out through Redis so subscriptions served by one process
+    see writes made by any other. Requires the `redis` package.
+    """
+
+    def __init__(self, url=None):
+        import redis
+
+        self.url = url or settings.CRM_PUBSUB_REDIS_URL
+        self._client = redis.Redis.from_url(self.url)
+
+    def publish(self, channel, message):
+        self._client.publish(channel, json.dumps(message))
+
+    async def subscribe(self, channel):
+        import redis.asyncio
+
+        client = redis.asyncio.Redis.from_url(self.url)
+        pubsub = client.pubsub()
+        await pubsub.subscribe(channel)
+        try:
+            async for item in pubsub.listen():
+                if item["type"] == "message":
+                    yield json.loads(item["data"])
+        finally:
+            await pubsub.unsubscribe(channel)
+            await client.aclose()
@@ -0,0 +1,315 @@
+"""
+Admission control for the GraphQL endpoints.
+
+Every client (an API key from CRM_RATE_LIMIT_API_KEYS, else IP) has a token bucket refilled at
+CRM_RATE_LIMIT_RATE tokens/s up to CRM_RATE_LIMIT_BURST. A request spends
+its operation cost: mutations cost more (MUTATION_COSTS, plus
+MUTATION_ITEM_COSTS per item of a bulk mutation's input list), and queries pay
+per CRM_RATE_LIMIT_NODES_PER_TOKEN connection nodes they can return, so a
+wide allOrders page costs more than a single lookup.
+
+Buckets and counters live in a pluggable store (CRM_RATE_LIMIT_STORE):
+LocalMemoryStore is exact but per process; CacheStore shares state through
+the Django cache for multi-process deployments.
+"""
+from functools import lru_cache
+import hashlib
+import json
+import math
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.module_loading import import_string
+from graphene_django.settings import graphene_settings
+from graphql import (
+    FieldNode, FragmentDefinitionNode, FragmentSpreadNode, GraphQLError, InlineFragmentNode, OperationType,
+    get_named_type, get_operation_ast, parse, value_from_ast_untyped,
+)
+
+# Token cost per top-level mutation field; others cost CRM_RATE_LIMIT_MUTATION_COST
+MUTATION_COSTS = {
+    "updateLowStockProducts": 20,
+}
+
+# Mutations that also pay per item of a list argument: field -> (argument, tokens per item)
+MUTATION_ITEM_COSTS = {
+    "bulkCreateCustomers": ("inputs", 1),
+}
+
+COUNTER_NAMES = ("admitted", "rejected_rate", "rejected_overload")
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store():
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = import_string(settings.CRM_RATE_LIMIT_STORE)()
+    return _store
+
+
+# -------------------- STORES --------------------
+class LocalMemoryStore:
+    """
+    Exact token buckets in this process's memory. Limits apply per worker
+    process, so the effective rate scales with the number of workers.
+    """
+
+    max_keys = 10000
+
+    def __init__(self):
+        self._buckets = {}
+        self._counters = dict.fromkeys(COUNTER_NAMES, 0)
+        self._lock = threading.Lock()
+
+    def consume(self, key, cost, rate, burst):
+        """
+        Takes `cost` tokens from `key`'s bucket. Returns (allowed, retry_after).
+        """
+        now = time.monotonic()
+        with self._lock:
+            tokens, stamp = self._buckets.get(key, (burst, now))
+            tokens = min(burst, tokens + (now - stamp) * rate)
+            if tokens >= cost:
+                self._buckets[key] = (tokens - cost, now)
+                allowed, retry_after = True, 0
+            else:
+                self._buckets[key] = (tokens, now)
+                allowed, retry_after = False, (cost - tokens) / rate
+            if len(self._buckets) > self.max_keys:
+                self._prune(now, rate, burst)
+        return allowed, retry_after
+
+    def _prune(self, now, rate, burst):
+        # A bucket that has refilled completely is the same as no bucket
+        self._buckets = {
+            key: (tokens, stamp)
+            for key, (tokens, stamp) in self._buckets.items()
+            if tokens + (now - stamp) * rate < burst
+        }
+
+    def incr(self, name):
+        with self._lock:
+            self._counters[name] += 1
+
+    def counters(self):
+        with self._lock:
+            return dict(self._counters)
+
+
+class CacheStore:
+    """
+    Token buckets shared through the Django cache, kept in GCRA form: a
+    bucket is one integer, the time (in microseconds) at which it will be
+    full again, pushed forward by each request with an atomic incr(). The
+    key expires at that time, so a missing key is a full bucket.
+
+    The cache API has no compare-and-set, so this is approximate: expiry
+    rounds up to whole seconds on most backends and concurrent requests may
+    expire a key a little early, refilling up to about a second's worth of
+    tokens ahead of time. Bursts stay bounded by `burst`, unlike fixed windows.
+    """
+
+    prefix = "crm:ratelimit"
+
+    def consume(self, key, cost, rate, burst):
+        slot = f"{self.prefix}:{key}"
+        now = int(time.time() * 1e6)
+        step = int(cost / rate * 1e6)
+        if cache.add(slot, now + step, timeout=math.ceil(step / 1e6)):
+            return True, 0
+        try:
+            full_at = cache.incr(slot, step)
+        except ValueError:  # expired between add() and incr()
+            cache.set(slot, now + step, timeout=math.ceil(step / 1e6))
+            return True, 0
+        # A key outliving its (rounded) expiry holds a time already passed
+        full_at = max(full_at, now + step)
+        wait = (full_at - now) / 1e6 - burst / rate
+        if wait > 0:
+            try:
+                cache.incr(slot, -step)  # rejected: the tokens were not spent
+            except ValueError:
+                pass
+            return False, wait
+        cache.touch(slot, timeout=math.ceil((full_at - now) / 1e6))
+        return True, 0
+
+    def incr(self, name):
+        key = f"{self.prefix}:counter:{name}"
+        cache.add(key, 0, timeout=None)
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.set(key, 1, timeout=None)
+
+    def counters(self):
+        keys = {f"{self.prefix}:counter:{name}": name for name in COUNTER_NAMES}
+        values = cache.get_many(keys)
+        return {name: values.get(key, 0) for key, name in keys.items()}
+
+
+# -------------------- CONCURRENCY --------------------
+class AdmissionGate:
+    """
+    Caps in-flight requests at `limit`. Requests over the cap are shed at
+    once instead of queued: a queued request would hold its worker thread
+    (under ASGI, one of the few sync threads) doing nothing.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.active = 0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            if self.active >= self.limit:
+                return False
+            self.active += 1
+            return True
+
+    def release(self):
+        with self._lock:
+            self.active -= 1
+
+
+# -------------------- COST --------------------
+def client_key(request):
+    # Only known keys get their own bucket: any other value is the caller's
+    # choice, and rotating it would escape the per-IP limit.
+    api_key = request.headers.get(settings.CRM_RATE_LIMIT_KEY_HEADER)
+    if api_key and api_key in settings.CRM_RATE_LIMIT_API_KEYS:
+        return "key:" + hashlib.sha256(api_key.encode()).hexdigest()[:32]
+    return "ip:" + request.META.get("REMOTE_ADDR", "")
+
+
+def graphql_operations(request):
+    """
+    (query, variables, operationName) for each operation in the request;
+    a batch body is a JSON list of them.
+    """
+    if request.method == "GET":
+        data = request.GET.dict()
+    elif request.content_type == "application/json":
+        try:
+            data = json.loads(request.body or b"null")
+        except ValueError:
+            return []
+    else:
+        data = request.POST.dict()
+
+    operations = []
+    for entry in data if isinstance(data, list) else [data]:
+        if isinstance(entry, dict) and isinstance(entry.get("query"), str):
+            variables = entry.get("variables")
+            if isinstance(variables, str):
+                try:
+                    variables = json.loads(variables)
+                except ValueError:
+                    variables = None
+            operations.append((entry["query"], variables if isinstance(variables, dict) else {}, entry.get("operationName")))
+    return operations
+
+
+@lru_cache(maxsize=256)
+def _parse(query):
+    return parse(query)
+
+
+def mutation_cost(field, variables):
+    name = field.name.value
+    cost = MUTATION_COSTS.get(name, settings.CRM_RATE_LIMIT_MUTATION_COST)
+    if name in MUTATION_ITEM_COSTS:
+        argument_name, per_item = MUTATION_ITEM_COSTS[name]
+        for argument in field.arguments or ():
+            if argument.name.value == argument_name:
+                items = value_from_ast_untyped(argument.value, variables)
+                # GraphQL coerces a single value to a one-item list
+                cost += per_item * (len(items) if isinstance(items, list) else 1)
+    return cost
+
+
+def operation_cost(schema, query, variables=None, operation_name=None):
+    """
+    Tokens an operation spends. Unparseable operations cost 1: the view
+    rejects them without doing any work.
+    """
+    try:
+        document = _parse(query)
+    except GraphQLError:
+        return 1
+    operation_ast = get_operation_ast(document, operation_name)
+    if operation_ast is None:
+        return 1
+    if operation_ast.operation == OperationType.MUTATION:
+        return sum(
+            mutation_cost(selection, variables)
+            for selection in operation_ast.selection_set.selections
+            if hasattr(selection, "name")
+        ) or 1
+
+    # Nodes a query may return: each connection's page size times the
+    # page sizes of the connections it is nested in. Fragments count where
+    # they are spread, as crm.fields expands them.
+    max_limit = graphene_settings.RELAY_CONNECTION_MAX_LIMIT or 100
+    fragments = {
+        definition.name.value: definition
+        for definition in document.definitions
+        if isinstance(definition, FragmentDefinitionNode)
+    }
+    fragment_nodes = {}
+
+    def page_size(node):
+        limit = max_limit
+        for argument in node.arguments or ():
+            if argument.name.value in ("first", "last"):
+                value = value_from_ast_untyped(argument.value, variables)
+                if isinstance(value, int) and value > 0:
+                    limit = min(value, max_limit)
+        return limit
+
+    def count(parent_type, selection_set, spreading=frozenset()):
+        # Nodes per object of `parent_type`; scaled up by the caller
+        total = 0
+        for selection in selection_set.selections if selection_set else ():
+            if isinstance(selection, FieldNode):
+                field = getattr(parent_type, "fields", {}).get(selection.name.value)
+                if field is None:
+                    continue
+                field_type = get_named_type(field.type)
+                children = count(field_type, selection.selection_set, spreading)
+                if field_type.name.endswith("Connection"):
+                    limit = page_size(selection)
+                    total += limit + limit * children
+                else:
+                    total += children
+            elif isinstance(selection, InlineFragmentNode):
+                condition = selection.type_condition
+                fragment_type = schema.get_type(condition.name.value) if condition else parent_type
+                total += count(fragment_type, selection.selection_set, spreading)
+            elif isinstance(selection, FragmentSpreadNode):
+                name = selection.name.value
+                if name in spreading or name not in fragments:
+                    continue  # invalid: validation rejects it
+                if name not in fragment_nodes:
+                    fragment = fragments[name]
+                    fragment_nodes[name] = count(
+                        schema.get_type(fragment.type_condition.name.value), fragment.selection_set, spreading | {name}
+                    )
+                total += fragment_nodes[name]
+        return total
+
+    root_type = schema.query_type if operation_ast.operation == OperationType.QUERY else schema.subscription_type
+    nodes = count(root_type, operation_ast.selection_set)
+    return max(1, math.ceil(nodes / settings.CRM_RATE_LIMIT_NODES_PER_TOKEN))
+
+
+def request_cost(schema, request):
+    operations = graphql_operations(request)
+    return sum(operation_cost(schema, *operation) for operation in operations) or 1
@@ -1,34 +1,121 @@
 import graphene
+from collections import defaultdict
+from asgiref.sync import sync_to_async
 from graphene_django import DjangoObjectType
+from django.conf import settings
 from django.db import transaction, IntegrityError
+from django.db.models import Count, Sum
 from django.core.validators import validate_email, RegexValidator
 from django.core.exceptions import ValidationError as DjangoValidationError
 from django.utils import timezone
 from decimal import Decimal
-from graphene_django.filter import DjangoFilterConnectionField
-from .filters import CustomerFilter, ProductFilter, OrderFilter
+from graphene import relay
+from graphql_relay import from_global_id
+from .archive import archived_in_bulk
+from .fields import CompactFilterConnectionField, CompactNodeMixin, TopNConnectionField, selects_node_field, to_pk
+from .filters import CustomerFilter, ProductFilter, OrderFilter, parse_pks
+from .inventory import InsufficientStock, InvalidReservation, reserve_stock, return_stock, take_for_order, with_current_stock
+from .outbox import events_since, record_event, record_events
+from .pubsub import ORDER_CREATED, PRODUCT_SAVED, get_pubsub
 
 
-from .models import Customer,  Order
+from .models import ArchivedOrder, Customer, CustomerSegment, Order, OutboxEvent, StockReservation
 from crm.models import Product
 
 # -------------------- TYPES --------------------
-class CustomerType(DjangoObjectType):
+class CountableConnection(graphene.relay.Connection):
+    class Meta:
+        abstract = True
+
+    total_count = graphene.Int()
+
+    def resolve_total_count(root, info):
+        return root.length
+
+
+class CustomerType(CompactNodeMixin, DjangoObjectType):
+    orders = TopNConnectionField("crm.schema.OrderType", accessor="orders")
+
     class Meta:
         model = Customer
         fields = "__all__"
+        interfaces = (relay.Node,)
+        use_connection = True
+        connection_class = CountableConnection
 
 
-class ProductType(DjangoObjectType):
+class CustomerSegmentType(DjangoObjectType):
+    class Meta:
+        model = CustomerSegment
+        exclude = ("customer",)
+        # Plain strings, as taken by the allCustomers `segment` filter
+        convert_choices_to_enum = False
+
+
+class ProductType(CompactNodeMixin, DjangoObjectType):
+    orders = TopNConnectionField("crm.schema.OrderType", accessor="orders")
+
     class Meta:
         model = Product
-        fields = "__all__"
+        exclude = ("reservations", "stock_shards")
+        interfaces = (relay.Node,)
+        use_connection = True
+        connection_class = CountableConnection
 
 
-class OrderType(DjangoObjectType):
+class OrderType(CompactNodeMixin, DjangoObjectType):
+    archived = graphene.Boolean(description="True for orders read from the archive (includeArchived).")
+
     class Meta:
         model = Order
-        fields = "__all__"
+        exclude = ("reservations",)
+        interfaces = (relay.Node,)
+        use_connection = True
+        connection_class = CountableConnection
+
+    @classmethod
+    def get_node(cls, info, id):
+        return super().get_node(info, id) or next(iter(cls.get_archived_nodes(info, [id]).values()), None)
+
+    @classmethod
+    def get_archived_nodes(cls, info, pks):
+        # Archived orders keep their global IDs (see crm.archive)
+        return archived_in_bulk(Order, ArchivedOrder.objects.all(), pks)
+
+    def resolve_archived(root, info):
+        return getattr(root, "archived", False)
+
+    def resolve_products(root, info, **kwargs):
+        if getattr(root, "archived", False):
+            prefetched = getattr(root, "archived_related", {}).get("products")
+            if prefetched is not None:
+                return prefetched
+            return Product.objects.filter(archived_orders=root.pk)
+        return root.products.all()
+
+
+class StockReservationType(DjangoObjectType):
+    class Meta:
+        model = StockReservation
+        fields = ("id", "product", "quantity", "expires_at")
+
+
+class ChangeEventType(DjangoObjectType):
+    class Meta:
+        model = OutboxEvent
+        fields = ("id", "sequence", "aggregate_type", "aggregate_id", "event_type", "payload", "created_at")
+
+
+class CRMStats(graphene.ObjectType):
+    total_customers = graphene.Int()
+    total_orders = graphene.Int()
+    total_revenue = graphene.Decimal()
+
+
+class ChangeFeed(graphene.ObjectType):
+    events = graphene.List(ChangeEventType)
+    cursor = graphene.Int(description="Pass as `since` to fetch the next page.")
+    has_more = graphene.Boolean()
 
 
 # -------------------- INPUT TYPES --------------------
@@ -48,6 +135,7 @@ class OrderInput(graphene.InputObjectType):
     customer_id = graphene.ID(required=True)
     product_ids = graphene.List(graphene.ID, required=True)
     order_date = graphene.types.datetime.DateTime(required=False)
+    reservation_ids = graphene.List(graphene.ID, required=False)
 
 
 # -------------------- MUTATIONS --------------------
@@ -90,11 +178,13 @@ class CreateCustomer(graphene.Mutation):
 
         # Create customer
         try:
-            customer = Customer.objects.create(
-                name=input.name,
-                email=input.email,
-                phone=input.phone
-            )
+            with transaction.atomic():
+                customer = Customer.objects.create(
+                    name=input.name,
+                    email=input.email,
+                    phone=input.phone
+                )
+                record_event(customer, "created")
         except Exception as exc:
             errors.append(f"Failed to create customer: {str(exc)}")
             return CreateCustomer(customer=None, message=None, errors=errors)
@@ -157,6 +247,7 @@ class BulkCreateCustomers(graphene.Mutation):
                         phone=data.phone
                     )
                     created.append(c)
+                record_events(created, "created")
         except IntegrityError as exc:
             errors.append(f"Database error: {str(exc)}")
 
@@ -191,11 +282,13 @@ class CreateProduct(graphene.Mutation):
             return CreateProduct(product=None, errors=errors)
 
         try:
-            product = Product.objects.create(
-                name=input.name,
-                price=price,
-                stock=stock
-            )
+            with transaction.atomic():
+                product = Product.objects.create(
+                    name=input.name,
+                    price=price,
+                    stock=stock
+                )
+                record_event(product, "created")
         except Exception as exc:
             errors.append(f"Failed to create product: {str(exc)}")
             return CreateProduct(product=None, errors=errors)
@@ -217,7 +310,7 @@ class CreateOrder(graphene.Mutation):
 
         # Validate customer
         try:
-            customer = Customer.objects.get(pk=input.customer_id)
+            customer = Customer.objects.get(pk=to_pk(input.customer_id, Customer, "CustomerType"))
         except Customer.DoesNotExist:
             errors.append("Invalid customer ID.")
             return CreateOrder(order=None, errors=errors)
@@ -230,7 +323,7 @@ class CreateOrder(graphene.Mutation):
         products = []
         for pid in input.product_ids:
             try:
-                p = Product.objects.get(pk=pid)
+                p = Product.objects.get(pk=to_pk(pid, Product, "ProductType"))
                 products.append(p)
             except Product.DoesNotExist:
                 errors.append(f"Invalid product ID: {pid}")
@@ -250,12 +343,61 @@ class CreateOrder(graphene.Mutation):
                 )
                 order.products.set(products)
                 order.save()
+                record_event(order, "created")
+                if settings.CRM_ORDERS_TAKE_STOCK:
+                    reservation_ids = parse_pks(StockReservation, input.reservation_ids or [], "StockReservationType")
+                    changed = take_for_order(order, [p.pk for p in products], reservation_ids)
+                    if changed:
+                        stocked = with_current_stock(list(Product.objects.filter(pk__in=changed).order_by("pk")))
+                        record_events(stocked, "updated")
+        except (InsufficientStock, InvalidReservation) as exc:
+            errors.append(str(exc))
+            return CreateOrder(order=None, errors=errors)
         except Exception as exc:
             errors.append(f"Failed to create order: {str(exc)}")
             return CreateOrder(order=None, errors=errors)
 
         return CreateOrder(order=order, errors=None)
 
+class ReserveStock(graphene.Mutation):
+    """
+    Holds units of a product for a customer for CRM_STOCK_RESERVATION_TTL
+    seconds; pass the reservation's id in that customer's createOrder
+    reservationIds to use it.
+    """
+
+    class Arguments:
+        customer_id = graphene.ID(required=True)
+        product_id = graphene.ID(required=True)
+        quantity = graphene.Int(default_value=1)
+
+    reservation = graphene.Field(StockReservationType)
+    errors = graphene.List(graphene.String)
+
+    @classmethod
+    def mutate(cls, root, info, customer_id, product_id, quantity=1):
+        if quantity < 1:
+            return ReserveStock(reservation=None, errors=["Quantity must be positive."])
+        try:
+            customer = Customer.objects.get(pk=to_pk(customer_id, Customer, "CustomerType"))
+        except Customer.DoesNotExist:
+            return ReserveStock(reservation=None, errors=["Invalid customer ID."])
+        try:
+            product = Product.objects.get(pk=to_pk(product_id, Product, "ProductType"))
+        except Product.DoesNotExist:
+            return ReserveStock(reservation=None, errors=[f"Invalid product ID: {product_id}"])
+
+        try:
+            with transaction.atomic():
+                reservation = reserve_stock(product.pk, quantity, customer_id=customer.pk)
+                with_current_stock([product])
+                record_event(reservation, "created")
+                record_event(product, "updated")
+        except InsufficientStock as exc:
+            return ReserveStock(reservation=None, errors=[str(exc)])
+        return ReserveStock(reservation=reservation, errors=None)
+
+
 class UpdateLowStockProducts(graphene.Mutation):
     """
     Finds products with stock < 10, restocks them by +10,
@@ -272,10 +414,13 @@ class UpdateLowStockProducts(graphene.Mutation):
         low_stock_products = Product.objects.filter(stock__lt=10)
         updated = []
 
-        for product in low_stock_products:
-            product.stock += 10
-            product.save()
-            updated.append(product)
+        with transaction.atomic():
+            for product in low_stock_products:
+                # Added in place: a read-modify-write save() would lose
+                # units taken by concurrent orders.
+                return_stock(product.pk, 10)
+                updated.append(product)
+            record_events(with_current_stock(updated), "updated")
 
         message = f"Updated {len(updated)} low-stock products."
         return UpdateLowStockProducts(updated_products=updated, message=message)
@@ -286,6 +431,7 @@ class Mutation(graphene.ObjectType):
     bulk_create_customers = BulkCreateCustomers.Field()
     create_product = CreateProduct.Field()
     create_order = CreateOrder.Field()
+    reserve_stock = ReserveStock.Field()
     update_low_stock_products = UpdateLowStockProducts.Field()  # ✅ add this line
 
 
@@ -299,26 +445,92 @@ class Mutation(graphene.ObjectType):
 class Query(graphene.ObjectType):
     hello = graphene.String(default_value="Hello from CRM!")
     # Filterable connections
-    all_customers = DjangoFilterConnectionField(CustomerType, filterset_class=CustomerFilter, order_by=graphene.String())
-    all_products = DjangoFilterConnectionField(ProductType, filterset_class=ProductFilter, order_by=graphene.String())
-    all_orders = DjangoFilterConnectionField(OrderType, filterset_class=OrderFilter, order_by=graphene.String())
+    all_customers = CompactFilterConnectionField(CustomerType, filterset_class=CustomerFilter, order_by=graphene.String())
+    all_products = CompactFilterConnectionField(ProductType, filterset_class=ProductFilter, order_by=graphene.String())
+    all_orders = CompactFilterConnectionField(
+        OrderType, filterset_class=OrderFilter, order_by=graphene.String(), archive_model=ArchivedOrder
+    )
+
+    # Relay node lookups by global ID
+    node = relay.Node.Field()
+    nodes = graphene.List(relay.Node, ids=graphene.List(graphene.NonNull(graphene.ID), required=True))
 
-    # Single item resolvers
+    # Single item resolvers (raw pk or global ID)
     customer = graphene.Field(CustomerType, id=graphene.ID(required=True))
     product = graphene.Field(ProductType, id=graphene.ID(required=True))
     order = graphene.Field(OrderType, id=graphene.ID(required=True))
 
+    # Totals over recent orders, or all of history with includeArchived
+    crm_stats = graphene.Field(CRMStats, include_archived=graphene.Boolean(default_value=False))
+
+    # Change feed over the relayed outbox, ordered by the gap-free relay sequence
+    changes = graphene.Field(ChangeFeed, since=graphene.Int(), limit=graphene.Int(default_value=100))
+
     def resolve_customer(root, info, id):
-        return Customer.objects.get(pk=id)
+        return Customer.objects.filter(pk=to_pk(id, Customer, "CustomerType")).first()
 
     def resolve_product(root, info, id):
-        return Product.objects.get(pk=id)
+        return Product.objects.filter(pk=to_pk(id, Product, "ProductType")).first()
 
     def resolve_order(root, info, id):
-        return Order.objects.get(pk=id)
+        return Order.objects.filter(pk=to_pk(id, Order, "OrderType")).first()
+
+    def resolve_nodes(root, info, ids):
+        """
+        Groups global IDs by type and loads each type with one in_bulk()
+        query, then any archived ones; results keep input order, with null
+        for unknown IDs.
+        """
+        keys = []
+        pks_by_type = defaultdict(set)
+        for global_id in ids:
+            decoded = from_global_id(global_id)
+            graphql_type = info.schema.get_type(decoded.type) if decoded.type else None
+            node_type = getattr(graphql_type, "graphene_type", None)
+            if node_type is None or relay.Node not in getattr(node_type._meta, "interfaces", ()):
+                keys.append(None)
+                continue
+            try:
+                pk = node_type._meta.model._meta.pk.to_python(decoded.id)
+            except DjangoValidationError:
+                keys.append(None)
+                continue
+            keys.append((node_type, pk))
+            pks_by_type[node_type].add(pk)
+
+        found = {
+            node_type: node_type.get_queryset(node_type._meta.model.objects, info).in_bulk(pks)
+            for node_type, pks in pks_by_type.items()
+        }
+        for node_type, pks in pks_by_type.items():
+            missing = pks - found[node_type].keys()
+            if missing and hasattr(node_type, "get_archived_nodes"):
+                found[node_type].update(node_type.get_archived_nodes(info, missing))
+        return [found[key[0]].get(key[1]) if key else None for key in keys]
+
+    def resolve_crm_stats(root, info, include_archived=False):
+        models = (Order, ArchivedOrder) if include_archived else (Order,)
+        orders, revenue = 0, Decimal("0.00")
+        for model in models:
+            totals = model.objects.aggregate(orders=Count("id"), revenue=Sum("total_amount"))
+            orders += totals["orders"]
+            revenue += totals["revenue"] or 0
+        return CRMStats(
+            total_customers=Customer.objects.count(), total_orders=orders, total_revenue=revenue.quantize(Decimal("0.01"))
+        )
+
+    def resolve_changes(root, info, since=None, limit=100):
+        limit = max(1, min(limit, 1000))
+        events = events_since(since, limit + 1)
+        has_more = len(events) > limit
+        events = events[:limit]
+        cursor = events[-1].sequence if events else since
+        return ChangeFeed(events=events, cursor=cursor, has_more=has_more)
     
     def resolve_all_customers(root, info, order_by=None, **kwargs):
         qs = Customer.objects.all()
+        if selects_node_field(info, "segment"):
+            qs = qs.select_related("segment")
         if order_by:
             qs = qs.order_by(order_by)
         return qs
@@ -326,5 +538,38 @@ class Query(graphene.ObjectType):
 
 
 
+# -------------------- SUBSCRIPTIONS --------------------
+# Payloads are loaded with their relations up front: resolvers run inside the
+# event loop, where lazy ORM access is not allowed.
+@sync_to_async
+def load_product(pk):
+    return Product.objects.prefetch_related("orders").filter(pk=pk).first()
+
+
+@sync_to_async
+def load_order(pk):
+    return Order.objects.select_related("customer").prefetch_related("products").filter(pk=pk).first()
+
+
+class Subscription(graphene.ObjectType):
+    low_stock_product = graphene.Field(ProductType, threshold=graphene.Int(default_value=10))
+    order_created = graphene.Field(OrderType)
+
+    async def subscribe_low_stock_product(root, info, threshold=10):
+        # Only when stock drops below the threshold, not on every save below it
+        async for message in get_pubsub().subscribe(PRODUCT_SAVED):
+            previous = message.get("previous")
+            if message["stock"] < threshold and (previous is None or previous >= threshold):
+                product = await load_product(message["id"])
+                if product is not None:
+                    yield product
+
+    async def subscribe_order_created(root, info):
+        async for message in get_pubsub().subscribe(ORDER_CREATED):
+            order = await load_order(message["id"])
+            if order is not None:
+                yield order
+
+
 # -------------------- EXPORT SCHEMA --------------------
-schema = graphene.Schema(query=Query, mutation=Mutation)
+schema = graphene.Schema(query=Query, mutation=Mutation, subscription=Subscription)
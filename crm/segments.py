@@ -0,0 +1,197 @@
+"""
+Customer segmentation by RFM: recency of the last order, order frequency
+and monetary value, over the live Order table (archived history is left
+out, see crm.archive).
+
+compute_segments() walks customers in id chunks of CRM_SEGMENT_CHUNK_SIZE,
+reading each chunk's metrics with one grouped aggregate, into compact typed
+arrays. Scores are quintiles over the customers who have ordered (recency
+inverted, so the most recent score 5) and are computed in one vectorized
+pass with NumPy when it is installed, else in a pure-Python pass giving the
+same results. Segments follow from the R and F scores (SEGMENT_RULES) and
+are upserted into CustomerSegment chunk by chunk.
+"""
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import Counter
+from decimal import Decimal
+import math
+
+from django.conf import settings
+from django.db.models import Count, Max, Sum
+from django.utils import timezone
+
+from .caching import bump_model_version
+from .models import Customer, CustomerSegment, Order
+
+try:
+    import numpy
+except ImportError:  # pragma: no cover - optional speedup
+    numpy = None
+
+QUINTILES = (0.2, 0.4, 0.6, 0.8)
+
+# First match wins: (segment, R from, R to, F from, F to)
+SEGMENT_RULES = (
+    ("champions", 4, 5, 4, 5),
+    ("loyal", 3, 5, 3, 5),
+    ("new", 4, 5, 1, 2),
+    ("promising", 3, 3, 1, 2),
+    ("at_risk", 1, 2, 3, 5),
+    ("hibernating", 1, 2, 1, 2),
+)
+SEGMENTS = tuple(rule[0] for rule in SEGMENT_RULES) + ("prospect",)
+
+SCORE_FIELDS = ["segment", "recency_days", "frequency", "monetary", "r_score", "f_score", "m_score", "computed_at"]
+
+
+# -------------------- METRICS --------------------
+class RFMMetrics:
+    """
+    Per-customer metrics in parallel typed arrays; recency is in days and
+    NaN for customers without orders.
+    """
+
+    def __init__(self):
+        self.customer_ids = array("q")
+        self.recency = array("d")
+        self.frequency = array("q")
+        self.monetary = array("d")
+
+    def __len__(self):
+        return len(self.customer_ids)
+
+
+def collect_metrics(now=None, chunk_size=None):
+    now = now or timezone.now()
+    chunk_size = chunk_size or settings.CRM_SEGMENT_CHUNK_SIZE
+    metrics = RFMMetrics()
+    last_id = 0
+    while True:
+        ids = list(Customer.objects.filter(id__gt=last_id).order_by("id").values_list("id", flat=True)[:chunk_size])
+        if not ids:
+            return metrics
+        totals = {
+            customer_id: rest
+            for customer_id, *rest in Order.objects.filter(customer_id__gte=ids[0], customer_id__lte=ids[-1])
+            .order_by()
+            .values("customer_id")
+            .annotate(last=Max("order_date"), frequency=Count("id"), monetary=Sum("total_amount"))
+            .values_list("customer_id", "last", "frequency", "monetary")
+        }
+        for customer_id in ids:
+            last, frequency, monetary = totals.get(customer_id, (None, 0, 0))
+            metrics.customer_ids.append(customer_id)
+            metrics.recency.append((now - last).total_seconds() / 86400 if last else math.nan)
+            metrics.frequency.append(frequency)
+            metrics.monetary.append(float(monetary or 0))
+        last_id = ids[-1]
+
+
+# -------------------- SCORING --------------------
+def score_metrics(metrics):
+    """
+    (r, f, m, segment) score arrays aligned with `metrics`; segment holds
+    indexes into SEGMENTS.
+    """
+    if numpy is not None:
+        return _score_vectorized(metrics)
+    return _score_python(metrics)
+
+
+def _score_vectorized(metrics):
+    recency = numpy.frombuffer(metrics.recency, dtype=numpy.float64)
+    frequency = numpy.frombuffer(metrics.frequency, dtype=numpy.int64).astype(numpy.float64)
+    monetary = numpy.frombuffer(metrics.monetary, dtype=numpy.float64)
+    ordered = frequency > 0
+    if not ordered.any():
+        zeros = numpy.zeros(len(metrics), dtype=numpy.int8)
+        return zeros, zeros, zeros, numpy.full(len(metrics), len(SEGMENTS) - 1, dtype=numpy.int8)
+
+    def edges(values):
+        # "lower" picks actual values, as the pure-Python pass does
+        return numpy.quantile(values[ordered], QUINTILES, method="lower")
+
+    r = numpy.where(ordered, 5 - numpy.searchsorted(edges(recency), recency, side="left"), 0).astype(numpy.int8)
+    f = numpy.where(ordered, numpy.searchsorted(edges(frequency), frequency, side="right") + 1, 0).astype(numpy.int8)
+    m = numpy.where(ordered, numpy.searchsorted(edges(monetary), monetary, side="right") + 1, 0).astype(numpy.int8)
+
+    segment = numpy.full(len(metrics), len(SEGMENTS) - 1, dtype=numpy.int8)
+    for index in reversed(range(len(SEGMENT_RULES))):
+        _, r_from, r_to, f_from, f_to = SEGMENT_RULES[index]
+        segment[(r >= r_from) & (r <= r_to) & (f >= f_from) & (f <= f_to)] = index
+    return r, f, m, segment
+
+
+def _score_python(metrics):
+    ordered = [i for i, frequency in enumerate(metrics.frequency) if frequency > 0]
+
+    def edges(values):
+        ranked = sorted(values[i] for i in ordered)
+        return [ranked[int(q * (len(ranked) - 1))] for q in QUINTILES] if ranked else []
+
+    recency_edges, frequency_edges, monetary_edges = (
+        edges(metrics.recency), edges(metrics.frequency), edges(metrics.monetary)
+    )
+    scores = array("b"), array("b"), array("b"), array("b")
+    for recency, frequency, monetary in zip(metrics.recency, metrics.frequency, metrics.monetary):
+        if not frequency:
+            row = (0, 0, 0, len(SEGMENTS) - 1)
+        else:
+            r_score = 5 - bisect_left(recency_edges, recency)
+            f_score = bisect_right(frequency_edges, frequency) + 1
+            segment = next(
+                index for index, (_, r_from, r_to, f_from, f_to) in enumerate(SEGMENT_RULES)
+                if r_from <= r_score <= r_to and f_from <= f_score <= f_to
+            )
+            row = (r_score, f_score, bisect_right(monetary_edges, monetary) + 1, segment)
+        for column, value in zip(scores, row):
+            column.append(value)
+    return scores
+
+
+# -------------------- STORAGE --------------------
+def store_segments(metrics, scores, computed_at, chunk_size=None):
+    chunk_size = chunk_size or settings.CRM_SEGMENT_CHUNK_SIZE
+    for start in range(0, len(metrics), chunk_size):
+        end = start + chunk_size
+        columns = zip(
+            metrics.customer_ids[start:end].tolist(),
+            metrics.recency[start:end].tolist(),
+            metrics.frequency[start:end].tolist(),
+            metrics.monetary[start:end].tolist(),
+            *(score[start:end].tolist() for score in scores),
+        )
+        CustomerSegment.objects.bulk_create(
+            [
+                CustomerSegment(
+                    customer_id=customer_id,
+                    segment=SEGMENTS[segment],
+                    recency_days=None if math.isnan(recency) else int(recency),
+                    frequency=frequency,
+                    monetary=Decimal(f"{monetary:.2f}"),
+                    r_score=r,
+                    f_score=f,
+                    m_score=m,
+                    computed_at=computed_at,
+                )
+                for customer_id, recency, frequency, monetary, r, f, m, segment in columns
+            ],
+            update_conflicts=True,
+            unique_fields=["customer"],
+            update_fields=SCORE_FIELDS,
+        )
+
+
+def compute_segments(chunk_size=None):
+    """
+    Recomputes every customer's CustomerSegment. Returns the number of
+    customers per segment.
+    """
+    now = timezone.now()
+    metrics = collect_metrics(now, chunk_size)
+    scores = score_metrics(metrics)
+    store_segments(metrics, scores, now, chunk_size)
+    # Segments are read as part of Customer (crm.caching.TYPE_MODELS)
+    bump_model_version(Customer)
+    return dict(Counter(SEGMENTS[index] for index in scores[3].tolist()))
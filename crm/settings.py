@@ -11,7 +11,7 @@ https://docs.djangoproject.com/en/5.2/ref/settings/
 """
 
 from pathlib import Path
-from celery.schedules import crontab
+
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
 
@@ -48,6 +48,8 @@ GRAPHENE = {
     'SCHEMA': 'alx_backend_graphql.schema.schema'
 }
 
+# django-crontab runs jobs under the lightweight jobs profile
+CRONTAB_DJANGO_SETTINGS_MODULE = 'alx_backend_graphql.settings_jobs'
 CRONJOBS = [
     ('*/5 * * * *', 'crm.cron.log_crm_heartbeat'),  # if you already have this
     ('0 */12 * * *', 'crm.cron.update_low_stock'),   # ✅ every 12 hours
@@ -55,13 +57,114 @@ CRONJOBS = [
 CELERY_BEAT_SCHEDULE = {
     'generate-crm-report': {
         'task': 'crm.tasks.generate_crm_report',
-        'schedule': crontab(day_of_week='mon', hour=6, minute=0),
+        # crontab() fields, converted by crm/celery.py so settings never import celery
+        'schedule': {'day_of_week': 'mon', 'hour': 6, 'minute': 0},
+    },
+    'relay-outbox-events': {
+        'task': 'crm.tasks.relay_outbox_events',
+        'schedule': 10.0,
+    },
+    'compact-stock-shards': {
+        'task': 'crm.tasks.compact_stock_shards',
+        'schedule': 30.0,
+    },
+    'archive-old-orders': {
+        'task': 'crm.tasks.archive_old_orders',
+        'schedule': {'hour': 3, 'minute': 30},
+    },
+    'compute-customer-segments': {
+        'task': 'crm.tasks.compute_customer_segments',
+        'schedule': {'hour': 4, 'minute': 0},
     },
 }
 
+# Number of consecutive Order ids aggregated by each report subtask
+CRM_REPORT_SHARD_SIZE = 50000
+
+# Order reminders: look-back window, customers per subtask, subtask rate limit
+CRM_REMINDER_WINDOW_DAYS = 7
+CRM_REMINDER_BATCH_SIZE = 500
+CRM_REMINDER_RATE_LIMIT = '20/s'
+
+# Outbox relay: events per batch and the callable that publishes a batch
+CRM_OUTBOX_RELAY_BATCH_SIZE = 500
+CRM_OUTBOX_PUBLISHER = 'crm.outbox.log_publisher'
+
+# Pub/sub feeding GraphQL subscriptions; use crm.pubsub.RedisPubSub across processes
+CRM_PUBSUB_BACKEND = 'crm.pubsub.InMemoryPubSub'
+CRM_PUBSUB_REDIS_URL = 'redis://localhost:6379/2'
+
+# Resolve scalar-only connection pages from values_list() records instead of
+# model instances (crm.fields); off by default
+CRM_COMPACT_CONNECTIONS = False
+
+# Threads executing consecutive read operations of one /graphql/batch/ request
+CRM_GRAPHQL_BATCH_WORKERS = 4
+
+# GraphQL responses: compress (br/gzip) from this size
+CRM_GRAPHQL_COMPRESS_MIN_BYTES = 1024
+
+# Cache-Control max-age for GET queries selecting no field with a hint (crm.caching)
+CRM_GRAPHQL_DEFAULT_MAX_AGE = 0
+
+# ETags on GET queries (crm.caching). Model versions live in the default
+# cache, so only turn this on with a cache shared by web and worker processes.
+CRM_GRAPHQL_ETAGS = False
+
+# Inventory (crm.inventory): whether createOrder takes one unit of each product
+# (off: orders never fail for lack of stock; on: they fail with "Insufficient
+# stock"), reservation hold time in seconds, expired reservations released per batch
+CRM_ORDERS_TAKE_STOCK = False
+CRM_STOCK_RESERVATION_TTL = 600
+CRM_STOCK_RELEASE_BATCH_SIZE = 500
+
+# Order archival (crm.archive): orders older than this many days move to
+# ArchivedOrder nightly, in batches; reads opt in with includeArchived.
+CRM_ORDER_ARCHIVE_AFTER_DAYS = 730
+CRM_ORDER_ARCHIVE_BATCH_SIZE = 1000
+
+# RFM segmentation (crm.segments): customers per grouped aggregate query and
+# per upsert batch. Scoring is vectorized with NumPy when it is installed.
+CRM_SEGMENT_CHUNK_SIZE = 20000
+
+# GraphQL admission control (crm.ratelimit): per-client token buckets (one of
+# these API keys in the key header, else IP), operation costs, and a per-process
+# in-flight cap; requests over it get 429 with this Retry-After (seconds) at once.
+# Use crm.ratelimit.CacheStore to share buckets across processes.
+CRM_RATE_LIMIT_PATH_PREFIX = '/graphql'
+CRM_RATE_LIMIT_STORE = 'crm.ratelimit.LocalMemoryStore'
+CRM_RATE_LIMIT_KEY_HEADER = 'X-API-Key'
+CRM_RATE_LIMIT_API_KEYS = []
+CRM_RATE_LIMIT_RATE = 10
+CRM_RATE_LIMIT_BURST = 100
+CRM_RATE_LIMIT_MUTATION_COST = 5
+CRM_RATE_LIMIT_NODES_PER_TOKEN = 100
+CRM_MAX_CONCURRENT_REQUESTS = 32
+CRM_ADMISSION_RETRY_AFTER = 1
+
+# On-demand request profiling (crm.profiling): staff or these API keys only
+CRM_PROFILING_ENABLED = True
+CRM_PROFILING_API_KEYS = []
+CRM_PROFILING_DIR = '/tmp/crm_profiles'
+CRM_PROFILING_INTERVAL = 0.001
+
+# Identical concurrent GraphQL reads share one execution (crm.singleflight).
+# SHARED also coalesces across processes through a lock in the default cache.
+# Off by default: flights are keyed on model versions, so they need a shared
+# default cache once more than one process writes (check crm.W002).
+CRM_SINGLE_FLIGHT_ENABLED = False
+CRM_SINGLE_FLIGHT_SHARED = False
+CRM_SINGLE_FLIGHT_TIMEOUT = 5.0
+CRM_SINGLE_FLIGHT_POLL_INTERVAL = 0.02
+
+# Admin changelists of unfiltered tables at least this large show the
+# database's row estimate instead of running COUNT(*) (crm.admin)
+CRM_ADMIN_ESTIMATED_COUNT_ABOVE = 100000
+
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
+    'crm.middleware.GraphQLAdmissionMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -0,0 +1,46 @@
+from django.db import transaction
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+
+from .caching import VERSIONED_MODELS, bump_model_version
+from .models import Order, Product
+from .pubsub import ORDER_CREATED, PRODUCT_SAVED, get_pubsub
+
+
+# Publish only once the write commits, so subscribers never see rows that
+# roll back and Order's products are already set when the event arrives.
+# Callbacks are robust: a pub/sub or cache outage is logged, not raised
+# into a request whose write has already committed.
+# `previous` is the stock the instance was loaded with (None when unknown),
+# so subscribers can react to threshold crossings rather than every save.
+@receiver(post_save, sender=Product)
+def publish_product_saved(sender, instance, created, **kwargs):
+    previous = None if created else getattr(instance, "_loaded_stock", None)
+    message = {"id": instance.pk, "stock": instance.stock, "previous": previous}
+    instance._loaded_stock = instance.stock
+    transaction.on_commit(lambda: get_pubsub().publish(PRODUCT_SAVED, message), robust=True)
+
+
+@receiver(post_save, sender=Order)
+def publish_order_created(sender, instance, created, **kwargs):
+    if created:
+        message = {"id": instance.pk}
+        transaction.on_commit(lambda: get_pubsub().publish(ORDER_CREATED, message), robust=True)
+
+
+# Cache versions are bumped after commit too: a reader that sees the new
+# version is guaranteed to also see the new rows.
+# Connected per model so other models keep Django's fast-delete path.
+def bump_version_on_write(sender, **kwargs):
+    transaction.on_commit(lambda: bump_model_version(sender), robust=True)
+
+
+for model in VERSIONED_MODELS:
+    post_save.connect(bump_version_on_write, sender=model, dispatch_uid=f"crm-version-save-{model._meta.label_lower}")
+    post_delete.connect(bump_version_on_write, sender=model, dispatch_uid=f"crm-version-delete-{model._meta.label_lower}")
+
+
+@receiver(m2m_changed, sender=Order.products.through)
+def bump_versions_on_order_products(sender, action, **kwargs):
+    if action.startswith("post_"):
+        transaction.on_commit(lambda: (bump_model_version(Order), bump_model_version(Product)), robust=True)
@@ -0,0 +1,155 @@
+"""
+Single-flight execution of identical concurrent GraphQL reads.
+
+Requests carrying the same query operation (same normalized document,
+variables and operation name), from the same user, against the same model
+versions (crm.caching), share one execution: the first to arrive runs it
+and the others wait for its encoded response instead of repeating the SQL.
+Because versions are part of the key, a request that starts after a write
+commits never receives a result computed before it.
+
+Flights are coalesced per process with threading primitives. With
+CRM_SINGLE_FLIGHT_SHARED the leader of each process also takes a lock in
+the Django cache, so at most one process runs a given read while the
+others poll for its published response.
+"""
+from functools import lru_cache
+import hashlib
+import json
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from graphql import GraphQLError, OperationType, get_operation_ast, parse, print_ast
+
+from .caching import analyze_operation, model_versions
+
+COUNTER_NAMES = ("leaders", "followers", "shared_hits")
+
+_flights = None
+_flights_lock = threading.Lock()
+
+
+def get_flights():
+    global _flights
+    if _flights is None:
+        with _flights_lock:
+            if _flights is None:
+                _flights = SingleFlight()
+    return _flights
+
+
+# -------------------- KEYS --------------------
+@lru_cache(maxsize=256)
+def read_operation(schema, query, operation_name):
+    """
+    (normalized document, models it reads) for a query operation, or None
+    for mutations, subscriptions and documents that do not parse.
+    """
+    try:
+        document = parse(query)
+    except GraphQLError:
+        return None
+    operation_ast = get_operation_ast(document, operation_name)
+    if operation_ast is None or operation_ast.operation != OperationType.QUERY:
+        return None
+    models, _ = analyze_operation(schema, document, operation_name)
+    return print_ast(document), tuple(sorted(models, key=lambda model: model._meta.label_lower))
+
+
+def flight_key(normalized, variables, operation_name, models, scope="", variant=()):
+    """
+    Key shared by requests that must get byte-identical responses; `variant`
+    carries view options that change the encoding.
+    """
+    digest = hashlib.sha256(
+        json.dumps(
+            [normalized, variables, operation_name, model_versions(models), scope, variant],
+            sort_keys=True, default=str,
+        ).encode()
+    ).hexdigest()
+    return f"crm:flight:{digest[:40]}"
+
+
+# -------------------- FLIGHTS --------------------
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.failed = False
+
+
+class SingleFlight:
+    """
+    Runs fn() once per key among concurrent callers in this process.
+    Followers wait up to CRM_SINGLE_FLIGHT_TIMEOUT seconds; if the leader
+    fails or is slower than that they run fn() themselves.
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+        self._counters = dict.fromkeys(COUNTER_NAMES, 0)
+
+    def do(self, key, fn, shared=False):
+        """
+        Returns (result, coalesced): coalesced is True when another
+        request's execution was reused.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+            self._counters["leaders" if leader else "followers"] += 1
+
+        if not leader:
+            if call.done.wait(settings.CRM_SINGLE_FLIGHT_TIMEOUT) and not call.failed:
+                return call.result, True
+            return fn(), False
+
+        try:
+            call.result, coalesced = self._shared(key, fn) if shared else (fn(), False)
+        except BaseException:
+            call.failed = True
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result, coalesced
+
+    def _shared(self, key, fn):
+        lock_key, result_key = f"{key}:lock", f"{key}:result"
+        timeout = settings.CRM_SINGLE_FLIGHT_TIMEOUT
+        if cache.add(lock_key, 1, timeout=max(1, round(timeout))):
+            try:
+                result = fn()
+                cache.set(result_key, result, timeout=max(1, round(timeout)))
+                return result, False
+            finally:
+                cache.delete(lock_key)
+
+        # Another process is running it: poll for its response while it
+        # still holds the lock, and run it here if it never arrives.
+        # The lock is read before the result: the leader publishes first.
+        deadline = time.monotonic() + timeout
+        while True:
+            locked = cache.get(lock_key) is not None
+            result = cache.get(result_key)
+            if result is not None:
+                with self._lock:
+                    self._counters["shared_hits"] += 1
+                return result, True
+            if not locked or time.monotonic() >= deadline:
+                return fn(), False
+            time.sleep(settings.CRM_SINGLE_FLIGHT_POLL_INTERVAL)
+
+    def in_flight(self):
+        with self._lock:
+            return len(self._calls)
+
+    def counters(self):
+        with self._lock:
+            return dict(self._counters)
@@ -1,54 +1,226 @@
-from celery import shared_task
-from datetime import datetime
-import requests  # ✅ Added import
+from celery import chord, shared_task
+from datetime import datetime, timedelta
+from decimal import Decimal
+import uuid
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, Max, Min, Sum
+from django.utils import timezone
+
+from .archive import archive_orders_before
+from .celery import app  # noqa: F401 - producers must enqueue through the configured app
+from .inventory import compact_product_stock, release_expired_reservations
+from .models import ArchivedOrder, Customer, Order, ReminderLog, StockShard
+from .outbox import relay_pending
+from .segments import compute_segments
+
+REPORT_LOG_FILE = "/tmp/crm_report_log.txt"
+REMINDER_LOG_FILE = "/tmp/order_reminders_log.txt"
+
+
+# -------------------- REPORT SHARDS --------------------
+def order_id_shards(shard_size=None):
+    """
+    Splits the order id space, live and archived, into contiguous
+    (start, end) ranges, end exclusive, of at most `shard_size` ids each.
+    """
+    shard_size = shard_size or settings.CRM_REPORT_SHARD_SIZE
+    bounds = [
+        model.objects.aggregate(lo=Min("id"), hi=Max("id")) for model in (Order, ArchivedOrder)
+    ]
+    lows = [b["lo"] for b in bounds if b["lo"] is not None]
+    if not lows:
+        return []
+    lo, hi = min(lows), max(b["hi"] for b in bounds if b["hi"] is not None)
+    return [(start, min(start + shard_size, hi + 1)) for start in range(lo, hi + 1, shard_size)]
+
+
+def aggregate_order_range(start, end):
+    """
+    Counts orders, live and archived, and sums their totals for ids in
+    [start, end). Revenue is returned as a string so it survives
+    serialization exactly.
+    """
+    orders, revenue = 0, Decimal("0.00")
+    for model in (Order, ArchivedOrder):
+        totals = model.objects.filter(id__gte=start, id__lt=end).aggregate(
+            orders=Count("id"), revenue=Sum("total_amount")
+        )
+        orders += totals["orders"]
+        revenue += Decimal(totals["revenue"] or 0)
+    return {"orders": orders, "revenue": str(revenue.quantize(Decimal("0.01")))}
+
+
+def combine_partials(partials):
+    """
+    Reduces shard results into a single (orders, revenue) pair using Decimals.
+    """
+    orders = 0
+    revenue = Decimal("0.00")
+    for partial in partials:
+        orders += partial["orders"]
+        revenue += Decimal(partial["revenue"])
+    return orders, revenue
+
+
+# -------------------- TASKS --------------------
+@shared_task
+def aggregate_order_shard(start, end):
+    return aggregate_order_range(start, end)
+
+
+@shared_task
+def combine_report_shards(partials, timestamp):
+    """
+    Chord callback: merges shard aggregates and logs the weekly report line.
+    """
+    orders, revenue = combine_partials(partials)
+    customers = Customer.objects.count()
+
+    with open(REPORT_LOG_FILE, "a") as f:
+        f.write(f"{timestamp} - Report: {customers} customers, {orders} orders, {revenue:.2f} revenue\n")
+
+    return {"customers": customers, "orders": orders, "revenue": str(revenue)}
+
 
 @shared_task
-def generate_crm_report():
+def generate_crm_report(shard_size=None):
     """
-    Generates a weekly CRM report via GraphQL and logs the results.
+    Generates a weekly CRM report and logs the results.
+
+    The Order table is fanned out into id-range shards (CRM_REPORT_SHARD_SIZE)
+    aggregated in parallel, and combine_report_shards reduces them.
     """
     timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    log_file = "/tmp/crm_report_log.txt"
-    graphql_url = "http://localhost:8000/graphql"
 
     try:
-        # GraphQL query
-        query = """
-        {
-          allCustomers {
-            totalCount
-          }
-          allOrders {
-            totalCount
-            edges {
-              node {
-                totalAmount
-              }
-            }
-          }
-        }
-        """
-
-        # Execute GraphQL request
-        response = requests.post(graphql_url, json={"query": query})
-        response.raise_for_status()
-        data = response.json().get("data", {})
-
-        # Extract values
-        customers = data.get("allCustomers", {}).get("totalCount", 0)
-        orders_data = data.get("allOrders", {})
-        orders = orders_data.get("totalCount", 0)
-
-        # Compute total revenue
-        total_revenue = 0
-        for edge in orders_data.get("edges", []):
-            node = edge.get("node", {})
-            total_revenue += float(node.get("totalAmount", 0))
-
-        # Log results
-        with open(log_file, "a") as f:
-            f.write(f"{timestamp} - Report: {customers} customers, {orders} orders, {total_revenue:.2f} revenue\n")
+        shards = order_id_shards(shard_size)
+        if not shards:
+            return combine_report_shards([], timestamp)
+
+        header = [aggregate_order_shard.s(start, end) for start, end in shards]
+        return chord(header)(combine_report_shards.s(timestamp)).id
 
     except Exception as e:
-        with open(log_file, "a") as f:
+        with open(REPORT_LOG_FILE, "a") as f:
             f.write(f"{timestamp} - Error generating CRM report: {e}\n")
+
+
+# -------------------- ORDER REMINDERS --------------------
+@shared_task(rate_limit=settings.CRM_REMINDER_RATE_LIMIT)
+def send_reminder_batch(reminder_date, batch):
+    """
+    Sends one reminder per customer in `batch` ([customer_id, order_count]
+    pairs) unless a ReminderLog already exists for that customer and day.
+
+    Rows are claimed by inserting them with this run's token; a concurrent
+    or redelivered run of the same batch loses the insert on the unique
+    constraint and sends nothing for those customers.
+    """
+    reminder_date = datetime.strptime(reminder_date, "%Y-%m-%d").date()
+    counts = dict(batch)
+    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    token = uuid.uuid4()
+
+    with transaction.atomic():
+        ReminderLog.objects.bulk_create(
+            [
+                ReminderLog(customer_id=cid, reminder_date=reminder_date, order_count=counts[cid], claim_token=token)
+                for cid in counts
+            ],
+            ignore_conflicts=True,
+        )
+        pending = list(
+            ReminderLog.objects.filter(claim_token=token).order_by("customer_id").values_list("customer_id", flat=True)
+        )
+
+    emails = dict(Customer.objects.filter(id__in=pending).values_list("id", "email"))
+    with open(REMINDER_LOG_FILE, "a") as f:
+        for cid in pending:
+            f.write(f"[{timestamp}] Reminder for Customer: {emails.get(cid)}, Orders: {counts[cid]}\n")
+
+    return len(pending)
+
+
+@shared_task
+def send_order_reminders(days=None, batch_size=None):
+    """
+    Groups recent orders per customer and dispatches rate-limited
+    send_reminder_batch subtasks for customers not yet reminded today.
+    """
+    days = days or settings.CRM_REMINDER_WINDOW_DAYS
+    batch_size = batch_size or settings.CRM_REMINDER_BATCH_SIZE
+    today = timezone.localdate()
+    since = timezone.now() - timedelta(days=days)
+
+    pending = (
+        Order.objects.filter(order_date__gte=since)
+        .exclude(customer__reminder_logs__reminder_date=today)
+        .values("customer_id")
+        .annotate(order_count=Count("id"))
+        .order_by("customer_id")
+        .values_list("customer_id", "order_count")
+    )
+
+    dispatched = 0
+    batch = []
+    for row in pending.iterator(chunk_size=batch_size):
+        batch.append(list(row))
+        if len(batch) == batch_size:
+            send_reminder_batch.delay(today.isoformat(), batch)
+            dispatched += 1
+            batch = []
+    if batch:
+        send_reminder_batch.delay(today.isoformat(), batch)
+        dispatched += 1
+
+    return dispatched
+
+
+# -------------------- OUTBOX RELAY --------------------
+@shared_task
+def relay_outbox_events(batch_size=None):
+    """
+    Drains the outbox in batches, publishing events in cursor order.
+    """
+    batch_size = batch_size or settings.CRM_OUTBOX_RELAY_BATCH_SIZE
+    total = 0
+    while True:
+        relayed = relay_pending(batch_size)
+        total += relayed
+        if relayed < batch_size:
+            return total
+
+
+# -------------------- INVENTORY --------------------
+@shared_task
+def compact_stock_shards():
+    """
+    Returns expired reservations to stock, then rebalances each sharded
+    product's buckets and refreshes its Product.stock snapshot.
+    """
+    released = release_expired_reservations()
+    product_ids = StockShard.objects.values_list("product_id", flat=True).distinct().order_by("product_id")
+    compacted = sum(compact_product_stock(product_id) is not None for product_id in product_ids)
+    return {"released": released, "compacted": compacted}
+
+
+# -------------------- ARCHIVAL --------------------
+@shared_task
+def archive_old_orders(days=None, batch_size=None):
+    """
+    Moves orders older than `days` (CRM_ORDER_ARCHIVE_AFTER_DAYS) to
+    ArchivedOrder. Returns the number of orders moved.
+    """
+    days = settings.CRM_ORDER_ARCHIVE_AFTER_DAYS if days is None else days
+    return archive_orders_before(timezone.now() - timedelta(days=days), batch_size)
+
+
+# -------------------- SEGMENTATION --------------------
+@shared_task
+def compute_customer_segments(chunk_size=None):
+    """
+    Recomputes every customer's RFM scores and segment (crm.segments).
+    Returns the number of customers per segment.
+    """
+    return compute_segments(chunk_size)
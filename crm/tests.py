@@ -1,3 +1,1517 @@
-from django.test import TestCase
+from collections import Counter
+from datetime import datetime, timedelta, timezone as dt_timezone
+from decimal import Decimal
+from pathlib import Path
+import asyncio
+import gzip
+import json
+import math
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from asgiref.sync import async_to_sync
+from celery.backends.cache import CacheBackend
+from django.contrib.auth.models import AnonymousUser
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.db.models import Count, Sum
+from django.http import HttpResponse
+from django.test import Client, RequestFactory, TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.utils import timezone
+from graphene.utils.str_converters import to_camel_case
+from graphql import FieldNode, parse, visit, Visitor
+from graphql_relay import to_global_id
+
+from alx_backend_graphql.schema import schema
+from .admin import estimated_row_count
+from .archive import archive_orders_before
+from .celery import app as celery_app
+from .caching import bump_model_version
+from .checks import check_etag_cache, check_single_flight_cache
+from .graphql_ws import GRAPHQL_TRANSPORT_WS, Connection, subscribe
+from .filters import CustomerFilter, OrderFilter, ProductFilter
+from .inventory import (
+    InsufficientStock, InvalidReservation, compact_product_stock, release_expired_reservations, reserve_stock, return_stock,
+    set_stock_shards, take_for_order, take_stock,
+)
+from .models import (
+    ArchivedOrder, Customer, CustomerSegment, Order, OutboxEvent, Product, ReminderLog, StockReservation, StockShard,
+)
+from .outbox import record_event, relay_pending
+from .profiling import RequestProfiler
+from .pubsub import PRODUCT_SAVED, get_pubsub
+from .middleware import GraphQLAdmissionMiddleware
+from .ratelimit import CacheStore, LocalMemoryStore, client_key, operation_cost
+from . import segments
+from .segments import RFMMetrics, compute_segments, store_segments
+from .tasks import aggregate_order_range, combine_partials, generate_crm_report, order_id_shards, send_reminder_batch
+from .views import CRMGraphQLView, compress_response, negotiate_encoding
+
+
+def run(query, variables=None):
+    result = schema.execute(query, variable_values=variables)
+    assert not result.errors, result.errors
+    return result.data
+
+
+# -------------------- ORDER FILTERS --------------------
+class OrderFilterExistsTests(TestCase):
+    """
+    M2M order filters must count each order once and use EXISTS, not joins.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = Customer.objects.create(name="Alice", email="alice@example.com")
+        cls.bob = Customer.objects.create(name="Bob", email="bob@example.com")
+        cls.widget_a = Product.objects.create(name="Widget A", price=Decimal("1.00"))
+        cls.widget_b = Product.objects.create(name="Widget B", price=Decimal("2.00"))
+        cls.gadget = Product.objects.create(name="Gadget", price=Decimal("3.00"))
+
+        orders = Order.objects.bulk_create(
+            [Order(customer=cls.alice if i % 2 else cls.bob) for i in range(1000)]
+        )
+        links = []
+        for i, order in enumerate(orders):
+            links.append(Order.products.through(order=order, product=cls.widget_a))
+            links.append(Order.products.through(order=order, product=cls.widget_b))
+            if i % 4 == 0:
+                links.append(Order.products.through(order=order, product=cls.gadget))
+        Order.products.through.objects.bulk_create(links)
+
+    def total_count(self, filters):
+        return run(f"{{ allOrders({filters}) {{ totalCount }} }}")["allOrders"]["totalCount"]
+
+    def test_product_name_matching_several_products_counts_orders_once(self):
+        self.assertEqual(self.total_count('productName: "widget"'), 1000)
+        self.assertEqual(self.total_count('productName: "gadget"'), 250)
+
+    def test_product_name_page_has_no_duplicates(self):
+        data = run('{ allOrders(productName: "widget", first: 100) { edges { node { id } } } }')
+        ids = [edge["node"]["id"] for edge in data["allOrders"]["edges"]]
+        self.assertEqual(len(ids), 100)
+        self.assertEqual(len(set(ids)), 100)
+
+    def test_product_id(self):
+        self.assertEqual(self.total_count(f"productId: {self.gadget.pk}"), 250)
+
+    def test_product_ids_in_accepts_raw_and_global_ids(self):
+        ids = [str(self.widget_a.pk), to_global_id("ProductType", self.gadget.pk)]
+        self.assertEqual(self.total_count(f'productIds_In: ["{ids[0]}", "{ids[1]}"]'), 1000)
+        self.assertEqual(self.total_count(f'productIds_In: ["{self.gadget.pk}", "junk"]'), 250)
+        self.assertEqual(self.total_count("productIds_In: []"), 0)
+
+    def test_customer_ids_in(self):
+        self.assertEqual(self.total_count(f'customerIds_In: ["{self.alice.pk}"]'), 500)
+        self.assertEqual(self.total_count(f'customerIds_In: ["{self.alice.pk}", "{self.bob.pk}"]'), 1000)
+
+    def test_m2m_filters_use_exists_without_distinct(self):
+        for filters in ('productName: "widget"', f"productId: {self.gadget.pk}", f'productIds_In: ["{self.gadget.pk}"]'):
+            with self.subTest(filters=filters), CaptureQueriesContext(connection) as queries:
+                self.total_count(filters)
+            for query in queries.captured_queries:
+                outer, _, subquery = query["sql"].upper().partition("EXISTS")
+                self.assertTrue(subquery)
+                self.assertNotIn("DISTINCT", outer)
+                self.assertNotIn("JOIN", outer)
+
+    def test_exists_plan_searches_through_table_index(self):
+        if connection.vendor != "sqlite":
+            self.skipTest("EXPLAIN QUERY PLAN output is SQLite specific.")
+        with CaptureQueriesContext(connection) as queries:
+            self.total_count(f'productIds_In: ["{self.gadget.pk}"]')
+        with connection.cursor() as cursor:
+            cursor.execute("EXPLAIN QUERY PLAN " + queries.captured_queries[-1]["sql"])
+            plan = " | ".join(row[-1] for row in cursor.fetchall())
+        self.assertIn("SEARCH", plan)
+        self.assertIn("crm_order_products", plan)
+        self.assertNotIn("SCAN crm_order_products", plan)
+
+
+# -------------------- COLD START --------------------
+IMPORT_BUDGETS_ENV = "CRM_CHECK_IMPORT_BUDGETS"
+
+
+class ImportTimeBudgetTests(TestCase):
+    """
+    Startup of job entry points, measured with `python -X importtime` in a
+    fresh interpreter. The module checks are exact and always run; the
+    wall-clock budgets (best-of-3 totals) depend on the machine, so they only
+    run with CRM_CHECK_IMPORT_BUDGETS=1.
+    """
+
+    JOBS_SETTINGS = "alx_backend_graphql.settings_jobs"
+    HEAVY_MODULES = ("celery", "gql", "requests", "graphene", "graphql", "django.contrib.admin")
+    BUDGETS_MS = {"import django; django.setup()": 400, "import crm.cron": 100}
+
+    def import_profile(self, code, settings_module=JOBS_SETTINGS):
+        env = dict(os.environ, DJANGO_SETTINGS_MODULE=settings_module)
+        result = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", code],
+            capture_output=True, text=True, env=env, cwd=Path(__file__).resolve().parents[1], check=True,
+        )
+        total_us, modules = 0, set()
+        for line in result.stderr.splitlines():
+            match = re.match(r"import time:\s+\d+ \|\s+(\d+) \| (\s*)(\S+)", line)
+            if match:
+                modules.add(match.group(3))
+                if not match.group(2):
+                    total_us += int(match.group(1))
+        return total_us / 1000, modules
+
+    def assert_no_heavy_modules(self, code):
+        _, modules = self.import_profile(code)
+        self.assertFalse(modules & set(self.HEAVY_MODULES), modules & set(self.HEAVY_MODULES))
+
+    def test_jobs_profile_setup(self):
+        self.assert_no_heavy_modules("import django; django.setup()")
+
+    def test_cron_module_defers_gql(self):
+        self.assert_no_heavy_modules("import crm.cron")
+
+    @skipUnless(os.environ.get(IMPORT_BUDGETS_ENV), f"set {IMPORT_BUDGETS_ENV}=1 to check import time budgets")
+    def test_import_time_budgets(self):
+        for code, budget_ms in self.BUDGETS_MS.items():
+            with self.subTest(code=code):
+                best_ms = min(self.import_profile(code)[0] for _ in range(3))
+                self.assertLess(best_ms, budget_ms, f"{code!r} imports took {best_ms:.0f} ms")
+
+
+# -------------------- SINGLE FLIGHT --------------------
+@override_settings(CRM_SINGLE_FLIGHT_ENABLED=True)
+class SingleFlightTests(TransactionTestCase):
+    """
+    Identical reads arriving together must run their SQL once, when enabled.
+    """
+
+    QUERY = "{ allProducts { totalCount } allCustomers { totalCount } }"
+
+    def setUp(self):
+        Customer.objects.create(name="Alice", email="alice@example.com")
+        Product.objects.create(name="Widget", price=Decimal("1.00"))
+
+    def post(self, statements, delay=0):
+        def record(execute, sql, params, many, context):
+            statements.append(sql)
+            time.sleep(delay)  # keep the first request in flight while the rest arrive
+            return execute(sql, params, many, context)
+
+        with connection.execute_wrapper(record):
+            return Client().post("/graphql/", {"query": self.QUERY}, content_type="application/json")
+
+    def test_concurrent_identical_reads_execute_once(self):
+        single = []
+        expected = self.post(single).content
+        self.assertTrue(single)
+
+        clients = 8
+        barrier = threading.Barrier(clients)
+        statements, bodies = [], []
+
+        def request():
+            barrier.wait()
+            try:
+                bodies.append(self.post(statements, delay=0.1).content)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=request) for _ in range(clients)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(bodies, [expected] * clients)
+        self.assertEqual(len(statements), len(single))
+
+    def test_flight_key_separates_what_must_not_be_shared(self):
+        view = CRMGraphQLView(schema=schema)
+
+        def key(query, variables=None):
+            request = RequestFactory().post("/graphql/")
+            request.user = AnonymousUser()
+            return view.get_flight_key(request, {"query": query, "variables": variables})
+
+        query = "query($n: String) { allProducts(name: $n) { totalCount } }"
+        self.assertEqual(key(query, {"n": "a"}), key("query($n: String){allProducts(name:$n){totalCount}}", {"n": "a"}))
+        self.assertNotEqual(key(query, {"n": "a"}), key(query, {"n": "b"}))
+        self.assertIsNone(key('mutation { createProduct(input: {name: "x", price: 1}) { product { id } } }'))
+
+        before = key(query, {"n": "a"})
+        bump_model_version(Product)
+        self.assertNotEqual(key(query, {"n": "a"}), before)
+
+    def test_check_warns_about_process_local_cache(self):
+        self.assertEqual([warning.id for warning in check_single_flight_cache(None)], ["crm.W002"])
+        with override_settings(CRM_SINGLE_FLIGHT_ENABLED=False):
+            self.assertIsNone(CRMGraphQLView(schema=schema).get_flight_key(RequestFactory().post("/graphql/"), {}))
+            self.assertEqual(check_single_flight_cache(None), [])
+        shared = {"default": {"BACKEND": "django.core.cache.backends.redis.RedisCache", "LOCATION": "redis://"}}
+        with override_settings(CACHES=shared):
+            self.assertEqual(check_single_flight_cache(None), [])
+
+
+# -------------------- SQL REGRESSIONS --------------------
+SQL_SNAPSHOT = Path(__file__).resolve().parent / "snapshots" / "schema_sql.json"
+UPDATE_SNAPSHOT_ENV = "CRM_UPDATE_SQL_SNAPSHOT"
+
+ORDER_NODE = "id totalAmount orderDate customer { name } products { edges { node { name } } }"
+
+# Every Query and Mutation field with a typical selection, and every filter
+# argument of CustomerFilter, ProductFilter and OrderFilter. Variable values
+# starting with "@" name a seeded row (see SchemaSQLRegressionTests.refs).
+OPERATIONS = {
+    "hello": ("{ hello }", None),
+    "allCustomers": ("{ allCustomers(first: 20) { totalCount edges { node { id name email phone } } } }", None),
+    "allCustomers.orders": (
+        "{ allCustomers(first: 10) { edges { node { name orders(first: 3, orderBy: \"-orderDate\") "
+        "{ totalCount edges { node { id totalAmount } } } } } } }",
+        None,
+    ),
+    "allCustomers.segment": (
+        "{ allCustomers(first: 20) { edges { node { name segment { segment rScore fScore mScore } } } } }", None
+    ),
+    "allCustomers(name)": ('{ allCustomers(name: "bench 1") { totalCount } }', None),
+    "allCustomers(email)": ('{ allCustomers(email: "example.com") { totalCount } }', None),
+    "allCustomers(phonePattern)": ('{ allCustomers(phonePattern: "+1555") { totalCount } }', None),
+    "allCustomers(segment)": ('{ allCustomers(segment: "champions") { totalCount edges { node { id } } } }', None),
+    "allProducts": ("{ allProducts(first: 20) { totalCount edges { node { id name price stock } } } }", None),
+    "allProducts.orders": (
+        "{ allProducts(first: 10) { edges { node { name orders(first: 5) { totalCount edges { node { id } } } } } } }",
+        None,
+    ),
+    "allProducts(name)": ('{ allProducts(name: "widget") { totalCount } }', None),
+    "allProducts(price_Gte)": ("{ allProducts(price_Gte: 5) { totalCount } }", None),
+    "allProducts(price_Lte)": ("{ allProducts(price_Lte: 5) { totalCount } }", None),
+    "allProducts(stock_Gte)": ("{ allProducts(stock_Gte: 10) { totalCount } }", None),
+    "allProducts(stock_Lte)": ("{ allProducts(stock_Lte: 10) { totalCount } }", None),
+    "allProducts(lowStock)": ("{ allProducts(lowStock: true) { totalCount edges { node { id stock } } } }", None),
+    "allOrders": (f"{{ allOrders(first: 20) {{ totalCount edges {{ node {{ {ORDER_NODE} }} }} }} }}", None),
+    "allOrders(includeArchived)": (
+        "{ allOrders(first: 20, includeArchived: true) { totalCount edges { node { id archived totalAmount "
+        "products { edges { node { name } } } } } } }",
+        None,
+    ),
+    "allOrders(totalAmount_Gte)": ("{ allOrders(totalAmount_Gte: 10) { totalCount } }", None),
+    "allOrders(totalAmount_Lte)": ("{ allOrders(totalAmount_Lte: 10) { totalCount } }", None),
+    "allOrders(orderDate_Gte)": ('{ allOrders(orderDate_Gte: "2024-12-01") { totalCount } }', None),
+    "allOrders(orderDate_Lte)": ('{ allOrders(orderDate_Lte: "2024-12-01") { totalCount } }', None),
+    "allOrders(customerName)": ('{ allOrders(customerName: "bench 1") { totalCount } }', None),
+    "allOrders(productName)": ('{ allOrders(productName: "widget", first: 20) { totalCount edges { node { id } } } }', None),
+    "allOrders(productId)": ("query($id: Decimal) { allOrders(productId: $id) { totalCount } }", {"id": "@product"}),
+    "allOrders(productIds_In)": (
+        "query($ids: [ID]) { allOrders(productIds_In: $ids) { totalCount } }", {"ids": ["@product", "@product_gid"]}
+    ),
+    "allOrders(customerIds_In)": (
+        "query($ids: [ID]) { allOrders(customerIds_In: $ids) { totalCount } }", {"ids": ["@customer"]}
+    ),
+    "node": (
+        "query($id: ID!) { node(id: $id) { id ... on OrderType { totalAmount customer { name } } } }",
+        {"id": "@order_gid"},
+    ),
+    "nodes": (
+        "query($ids: [ID!]!) { nodes(ids: $ids) { id ... on CustomerType { name } ... on ProductType { name } } }",
+        {"ids": ["@customer_gid", "@product_gid", "@order_gid"]},
+    ),
+    "customer": ("query($id: ID!) { customer(id: $id) { name email segment { segment } } }", {"id": "@customer"}),
+    "product": ("query($id: ID!) { product(id: $id) { name price stock } }", {"id": "@product_gid"}),
+    "order": (f"query($id: ID!) {{ order(id: $id) {{ {ORDER_NODE} }} }}", {"id": "@order"}),
+    "crmStats": ("{ crmStats { totalCustomers totalOrders totalRevenue } }", None),
+    "crmStats(includeArchived)": ("{ crmStats(includeArchived: true) { totalOrders totalRevenue } }", None),
+    "changes": ("{ changes(limit: 10) { cursor hasMore events { id eventType aggregateId } } }", None),
+    "createCustomer": (
+        'mutation { createCustomer(input: {name: "New", email: "new@example.com", phone: "+15550000000"}) '
+        "{ customer { id } message errors } }",
+        None,
+    ),
+    "bulkCreateCustomers": (
+        'mutation { bulkCreateCustomers(inputs: [{name: "A", email: "a@example.com"}, '
+        '{name: "B", email: "b@example.com"}]) { customers { id } errors } }',
+        None,
+    ),
+    "createProduct": (
+        'mutation { createProduct(input: {name: "New", price: 2.5, stock: 3}) { product { id } errors } }', None
+    ),
+    "createOrder": (
+        "mutation($customer: ID!, $products: [ID]!) { createOrder(input: {customerId: $customer, "
+        "productIds: $products}) { order { id totalAmount } errors } }",
+        {"customer": "@customer_gid", "products": ["@product", "@product_2"]},
+    ),
+    "reserveStock": (
+        "mutation($customer: ID!, $id: ID!) { reserveStock(customerId: $customer, productId: $id, quantity: 2) "
+        "{ reservation { id quantity } errors } }",
+        {"customer": "@customer_gid", "id": "@product"},
+    ),
+    "updateLowStockProducts": ("mutation { updateLowStockProducts { updatedProducts { id stock } message } }", None),
+}
+
+SQL_LITERAL_RE = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+SQL_IN_LIST_RE = re.compile(r"\bIN \((?:\?, )*\?\)")
+SAVEPOINT_RE = re.compile(r'"s\d+_x\d+"')  # thread id and counter
+EXPLAINED_STATEMENTS = ("SELECT", "WITH", "UPDATE", "DELETE", "INSERT")
+
+
+def normalize_sql(sql):
+    sql = SQL_LITERAL_RE.sub("?", SAVEPOINT_RE.sub('"savepoint"', sql))
+    return SQL_IN_LIST_RE.sub("IN (...)", sql)
+
+
+def explain(sql):
+    """
+    SQLite's query plan for `sql` as indented detail lines, with subquery
+    numbers masked.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute("EXPLAIN QUERY PLAN " + sql)
+        rows = cursor.fetchall()
+    depth, lines = {0: -1}, []
+    for node_id, parent, _, detail in rows:
+        depth[node_id] = depth.get(parent, -1) + 1
+        lines.append("  " * depth[node_id] + re.sub(r"\b\d+\b", "N", detail))
+    return lines
+
+
+def full_scans(statements):
+    """
+    Plan lines scanning a whole table or index, rather than a subquery.
+    """
+    tables = set(connection.introspection.table_names())
+    return Counter(
+        line.strip()
+        for statement in statements
+        for line in statement["plan"] or ()
+        if line.strip().startswith("SCAN ") and line.split()[1] in tables
+    )
+
+
+# createOrder's stock take and compact pages are opt-in; snapshot the
+# opt-in paths (CompactConnectionTests compares pages with the default)
+@override_settings(CRM_ORDERS_TAKE_STOCK=True, CRM_COMPACT_CONNECTIONS=True)
+class SchemaSQLRegressionTests(TestCase):
+    """
+    Runs every operation in OPERATIONS against a seeded database and
+    compares its SQL statements and SQLite query plans with the committed
+    snapshot (crm/snapshots/schema_sql.json). More statements (an N+1) or a
+    new full scan fails with a targeted message; any other plan change
+    fails as a snapshot mismatch. After an intended change, update the
+    snapshot entries of the operations it changed with
+
+        CRM_UPDATE_SQL_SNAPSHOT=1 python manage.py test crm.tests.SchemaSQLRegressionTests
+
+    (or CRM_UPDATE_SQL_SNAPSHOT=createOrder,reserveStock for just those),
+    which lists each rewritten operation, and review its diff in the same
+    commit. Other backends only compare statement counts.
+    """
+
+    maxDiff = None
+
+    @classmethod
+    def setUpTestData(cls):
+        start = datetime(2025, 1, 1, tzinfo=dt_timezone.utc)
+        customers = Customer.objects.bulk_create(
+            [
+                Customer(name=f"Bench {i}", email=f"bench{i}@example.com", phone=f"+1555{i:07d}" if i % 3 else None)
+                for i in range(30)
+            ]
+        )
+        products = Product.objects.bulk_create(
+            [Product(name=f"Widget {i}", price=Decimal(i + 1), stock=5 if i % 4 == 0 else 50) for i in range(10)]
+        )
+        orders = Order.objects.bulk_create(
+            [
+                Order(customer=customers[i % 30], total_amount=Decimal(i % 40), order_date=start - timedelta(days=i))
+                for i in range(200)
+            ]
+        )
+        Order.products.through.objects.bulk_create(
+            [
+                Order.products.through(order=order, product=products[(i + k) % 10])
+                for i, order in enumerate(orders)
+                for k in (0, 3)
+            ]
+        )
+        archived = ArchivedOrder.objects.bulk_create(
+            [
+                ArchivedOrder(
+                    id=1000000 + i, customer=customers[i], total_amount=Decimal(i),
+                    order_date=start - timedelta(days=1000 + i),
+                )
+                for i in range(20)
+            ]
+        )
+        ArchivedOrder.products.through.objects.bulk_create(
+            [ArchivedOrder.products.through(archivedorder=order, product=products[0]) for order in archived]
+        )
+        OutboxEvent.objects.bulk_create(
+            [
+                OutboxEvent(
+                    aggregate_type="order", aggregate_id=order.pk, event_type="created", payload={},
+                    sequence=i + 1, relayed_at=start,
+                )
+                for i, order in enumerate(orders[:15])
+            ]
+        )
+        compute_segments()
+
+        cls.refs = {
+            "customer": str(customers[1].pk),
+            "customer_gid": to_global_id("CustomerType", customers[1].pk),
+            "product": str(products[1].pk),
+            "product_2": str(products[2].pk),
+            "product_gid": to_global_id("ProductType", products[1].pk),
+            "order": str(orders[0].pk),
+            "order_gid": to_global_id("OrderType", orders[0].pk),
+        }
+
+    def variables(self, value):
+        if isinstance(value, dict):
+            return {key: self.variables(item) for key, item in value.items()}
+        if isinstance(value, list):
+            return [self.variables(item) for item in value]
+        if isinstance(value, str) and value.startswith("@"):
+            return self.refs[value[1:]]
+        return value
+
+    def capture(self, name):
+        """
+        Normalized statements and plans of one operation, run in a savepoint
+        that is rolled back so operations do not see each other's writes.
+        """
+        document, variables = OPERATIONS[name]
+        cache.clear()  # cached hints (e.g. stock shard counts) would skip queries
+        with transaction.atomic():
+            with CaptureQueriesContext(connection) as queries:
+                result = schema.execute(document, variable_values=self.variables(variables))
+            transaction.set_rollback(True)
+
+        self.assertFalse(result.errors, result.errors)
+        data = result.data[next(iter(result.data))]
+        self.assertFalse(isinstance(data, dict) and data.get("errors"), data)
+
+        statements = []
+        for query in queries.captured_queries:
+            sql = query["sql"]
+            explained = connection.vendor == "sqlite" and sql.lstrip().upper().startswith(EXPLAINED_STATEMENTS)
+            statements.append({"sql": normalize_sql(sql), "plan": explain(sql) if explained else None})
+        return statements
+
+    def test_operations_match_sql_snapshot(self):
+        actual = {name: self.capture(name) for name in OPERATIONS}
+        sqlite_version = connection.Database.sqlite_version if connection.vendor == "sqlite" else None
+        if os.environ.get(UPDATE_SNAPSHOT_ENV):
+            self.update_snapshot(actual, sqlite_version, os.environ[UPDATE_SNAPSHOT_ENV])
+
+        snapshot = json.loads(SQL_SNAPSHOT.read_text())
+        hint = f"; if intended, rerun with {UPDATE_SNAPSHOT_ENV}=1 and commit the snapshot diff"
+        self.assertEqual(sorted(snapshot["operations"]), sorted(actual), "catalog and snapshot differ" + hint)
+        for name, statements in actual.items():
+            expected = snapshot["operations"][name]
+            with self.subTest(operation=name):
+                self.assertLessEqual(
+                    len(statements), len(expected),
+                    f"{name} issues {len(statements)} SQL statements, snapshot has {len(expected)}" + hint,
+                )
+                if connection.vendor != "sqlite":
+                    continue
+                new_scans = full_scans(statements) - full_scans(expected)
+                self.assertFalse(new_scans, f"{name} has new full scans: {dict(new_scans)}" + hint)
+                if sqlite_version == snapshot["sqlite_version"]:
+                    self.assertEqual(statements, expected, f"{name} SQL or plans changed" + hint)
+
+    def update_snapshot(self, actual, sqlite_version, names):
+        """
+        Rewrites the snapshot entries of the comma-separated operation
+        `names`, or with "1" of every operation that changed, was added or
+        was removed, and reports them so each change is reviewed with the
+        commit that causes it.
+        """
+        snapshot = json.loads(SQL_SNAPSHOT.read_text()) if SQL_SNAPSHOT.exists() else {"operations": {}}
+        operations = snapshot["operations"]
+        if names == "1":
+            names = {name for name in actual.keys() | operations.keys() if actual.get(name) != operations.get(name)}
+            snapshot["sqlite_version"] = sqlite_version
+        else:
+            names = set(names.split(","))
+            unknown = names - actual.keys() - operations.keys()
+            self.assertFalse(unknown, f"not in OPERATIONS or the snapshot: {sorted(unknown)}")
+            self.assertEqual(
+                snapshot.get("sqlite_version"), sqlite_version,
+                f"the snapshot was taken with another SQLite; update every operation with {UPDATE_SNAPSHOT_ENV}=1",
+            )
+
+        report = []
+        for name in sorted(names):
+            before = operations.pop(name, None)
+            if name in actual:
+                operations[name] = actual[name]
+            counts = (len(statements) if statements is not None else "-" for statements in (before, actual.get(name)))
+            report.append("{}: {} -> {} statements".format(name, *counts))
+        SQL_SNAPSHOT.parent.mkdir(exist_ok=True)
+        SQL_SNAPSHOT.write_text(json.dumps(snapshot, indent=2, sort_keys=True) + "\n")
+        sys.stderr.write(f"\nUpdated {SQL_SNAPSHOT}:\n" + "".join(f"  {line}\n" for line in report or ["no changes"]))
+        self.skipTest(f"updated {len(report)} operations in {SQL_SNAPSHOT}")
+
+    def test_catalog_covers_schema_and_filters(self):
+        top_level, arguments = set(), set()
+
+        class Collector(Visitor):
+            def enter_operation_definition(self, node, *args):
+                for selection in node.selection_set.selections:
+                    if isinstance(selection, FieldNode):
+                        top_level.add(selection.name.value)
+
+            def enter_argument(self, node, *args):
+                arguments.add(node.name.value)
+
+        for document, _ in OPERATIONS.values():
+            visit(parse(document), Collector())
+
+        graphql_schema = schema.graphql_schema
+        fields = set(graphql_schema.query_type.fields) | set(graphql_schema.mutation_type.fields)
+        self.assertFalse(fields - top_level, "operations missing from OPERATIONS")
+
+        filters = {
+            to_camel_case(name)
+            for filterset in (CustomerFilter, ProductFilter, OrderFilter)
+            for name in filterset.base_filters
+        }
+        self.assertFalse(filters - arguments, "filters missing from OPERATIONS")
+
+
+# -------------------- CRM REPORT --------------------
+class CRMReportTests(TestCase):
+    """
+    Shard partials of the weekly report add up to single-query totals.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        customer = Customer.objects.create(name="Report", email="report@example.com")
+        orders = Order.objects.bulk_create(
+            [
+                Order(
+                    customer=customer, total_amount=Decimal(f"{i}.{i:02d}"),
+                    order_date=datetime(2020 + i % 6, 1, 1, tzinfo=dt_timezone.utc),
+                )
+                for i in range(1, 17)
+            ]
+        )
+        # A gap in the id space leaves some shards empty
+        Order.objects.filter(id__in=[order.id for order in orders[5:11]]).delete()
+        archive_orders_before(datetime(2023, 1, 1, tzinfo=dt_timezone.utc))
+
+    def expected(self):
+        orders, revenue = 0, Decimal("0.00")
+        for model in (Order, ArchivedOrder):
+            totals = model.objects.aggregate(orders=Count("id"), revenue=Sum("total_amount"))
+            orders += totals["orders"]
+            revenue += totals["revenue"] or 0
+        return orders, revenue
+
+    def test_partials_match_single_query_totals(self):
+        self.assertTrue(ArchivedOrder.objects.exists())
+        expected = self.expected()
+        self.assertEqual(expected[0], 10)
+        for shard_size in (1, 3, 4, 7, 1000):
+            with self.subTest(shard_size=shard_size):
+                shards = order_id_shards(shard_size)
+                self.assertTrue(all(end - start <= shard_size for start, end in shards))
+                partials = [aggregate_order_range(start, end) for start, end in shards]
+                self.assertEqual(combine_partials(json.loads(json.dumps(partials))), expected)
+                if shard_size == 3:
+                    self.assertIn({"orders": 0, "revenue": "0.00"}, partials)
+
+    def test_generate_report_runs_chord(self):
+        # Run the chord in-process, storing results in memory instead of Redis
+        celery_app.conf.task_always_eager = True
+        self.addCleanup(setattr, celery_app.conf, "task_always_eager", False)
+        backend = CacheBackend(app=celery_app, backend="memory")
+        with mock.patch.object(celery_app._local, "backend", backend, create=True):
+            with tempfile.NamedTemporaryFile("r") as log, mock.patch("crm.tasks.REPORT_LOG_FILE", log.name):
+                generate_crm_report.apply(kwargs={"shard_size": 3})
+                line = log.read()
+        orders, revenue = self.expected()
+        self.assertIn(f"Report: 1 customers, {orders} orders, {revenue:.2f} revenue", line)
+
+    def test_empty_tables(self):
+        Order.objects.all().delete()
+        ArchivedOrder.objects.all().delete()
+        self.assertEqual(order_id_shards(3), [])
+        self.assertEqual(combine_partials([]), (0, Decimal("0.00")))
+        with tempfile.NamedTemporaryFile("r") as log, mock.patch("crm.tasks.REPORT_LOG_FILE", log.name):
+            self.assertEqual(generate_crm_report(), {"customers": 1, "orders": 0, "revenue": "0.00"})
+
+
+# -------------------- ORDER REMINDERS --------------------
+class ReminderBatchTests(TestCase):
+    """
+    A reminder is sent only by the run whose insert claimed its log row.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.customers = Customer.objects.bulk_create(
+            [Customer(name=f"Reminded {i}", email=f"reminded{i}@example.com") for i in range(3)]
+        )
+
+    def setUp(self):
+        log = tempfile.NamedTemporaryFile("w+", suffix=".txt", delete=False)
+        log.close()
+        self.addCleanup(os.unlink, log.name)
+        patcher = mock.patch("crm.tasks.REMINDER_LOG_FILE", log.name)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.log_path = Path(log.name)
+
+    def send(self, customers):
+        return send_reminder_batch("2025-01-01", [[customer.pk, 2] for customer in customers])
+
+    def test_duplicate_run_sends_nothing(self):
+        self.assertEqual(self.send(self.customers), 3)
+        self.assertEqual(self.send(self.customers), 0)
+        self.assertEqual(len(self.log_path.read_text().splitlines()), 3)
+        self.assertEqual(ReminderLog.objects.count(), 3)
+
+    def test_rows_claimed_by_another_run_are_skipped(self):
+        # Another worker committed its claim for the first customer between
+        # this run's dispatch and its insert.
+        ReminderLog.objects.create(customer=self.customers[0], reminder_date=datetime(2025, 1, 1).date())
+        self.assertEqual(self.send(self.customers), 2)
+        sent = self.log_path.read_text()
+        self.assertNotIn(self.customers[0].email, sent)
+        self.assertIn(self.customers[1].email, sent)
+
+
+# -------------------- OUTBOX --------------------
+class OutboxTests(TestCase):
+    """
+    Events commit with their mutation, reach the change feed in relay
+    order, and are published only once the relay commits.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.customer = Customer.objects.create(name="Outbox", email="outbox@example.com")
+        cls.product = Product.objects.create(name="Outboxed", price=Decimal("5.00"), stock=10)
+
+    def relay(self, publisher=lambda events: None):
+        with self.captureOnCommitCallbacks(execute=True):
+            return relay_pending(publisher=publisher)
+
+    def changes(self, since=None):
+        result = schema.execute(
+            "query ($since: Int) { changes(since: $since) { cursor events { sequence aggregateId } } }",
+            variables={"since": since},
+        )
+        self.assertIsNone(result.errors)
+        return result.data["changes"]
+
+    def test_event_rolls_back_with_failed_mutation(self):
+        def record_then_fail(instance, event_type):
+            record_event(instance, event_type)
+            raise RuntimeError("boom")
+
+        with mock.patch("crm.schema.record_event", record_then_fail):
+            result = schema.execute(
+                "mutation ($input: OrderInput!) { createOrder(input: $input) { order { id } errors } }",
+                variables={
+                    "input": {
+                        "customerId": to_global_id("CustomerType", self.customer.pk),
+                        "productIds": [to_global_id("ProductType", self.product.pk)],
+                    }
+                },
+            )
+        self.assertIsNone(result.errors)
+        self.assertEqual(result.data["createOrder"]["errors"], ["Failed to create order: boom"])
+        self.assertFalse(Order.objects.exists())
+        self.assertFalse(OutboxEvent.objects.exists())
+
+    def test_publish_waits_for_the_relay_to_commit(self):
+        event = record_event(self.customer, "updated")
+        published = []
+        with self.captureOnCommitCallbacks(execute=True):
+            with self.assertRaisesMessage(RuntimeError, "rolled back"), transaction.atomic():
+                relay_pending(publisher=published.extend)
+                raise RuntimeError("rolled back")
+        self.assertEqual(published, [])
+        event.refresh_from_db()
+        self.assertEqual((event.sequence, event.relayed_at), (None, None))
+
+        def fail(events):
+            raise ConnectionError("broker down")
+
+        with self.assertRaises(ConnectionError):
+            self.relay(fail)
+        event.refresh_from_db()
+        self.assertEqual((event.sequence, event.relayed_at), (1, None))
+
+        # The next relay publishes it again, with the same sequence
+        self.assertEqual(self.relay(published.extend), 1)
+        self.assertEqual([e.sequence for e in published], [1])
+        event.refresh_from_db()
+        self.assertIsNotNone(event.relayed_at)
+        self.assertEqual(self.relay(published.extend), 0)
+
+    def test_late_commit_follows_the_cursor(self):
+        first = record_event(self.customer, "updated")
+        self.assertEqual(self.changes()["events"], [])
+        self.assertEqual(self.relay(), 1)
+
+        # A transaction holding a lower id commits after a later insert has
+        # been relayed and read; it still lands after the reader's cursor.
+        OutboxEvent.objects.create(
+            id=first.id + 2, aggregate_type="product", aggregate_id=self.product.pk,
+            event_type="updated", payload={},
+        )
+        self.assertEqual(self.relay(), 1)
+        feed = self.changes()
+        self.assertEqual([event["sequence"] for event in feed["events"]], [1, 2])
+        OutboxEvent.objects.create(
+            id=first.id + 1, aggregate_type="customer", aggregate_id=self.customer.pk,
+            event_type="updated", payload={},
+        )
+        self.assertEqual(self.relay(), 1)
+        self.assertEqual(
+            self.changes(feed["cursor"])["events"], [{"sequence": 3, "aggregateId": self.customer.pk}]
+        )
+
+
+# -------------------- SUBSCRIPTIONS --------------------
+class SubscriptionTests(TestCase):
+    """
+    Subscription payloads resolve any selection depth, lowStockProduct fires
+    on threshold crossings, a failing operation ends with an error frame,
+    and a failing publish never fails the write that triggered it.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        customer = Customer.objects.create(name="Subscriber", email="subscriber@example.com")
+        cls.product = Product.objects.create(name="Scarce", price=Decimal("3.00"), stock=2)
+        order = Order.objects.create(
+            customer=customer, total_amount=Decimal("3.00"), order_date=datetime(2025, 1, 1, tzinfo=dt_timezone.utc)
+        )
+        order.products.add(cls.product)
+
+    def test_low_stock_payload_resolves_nested_connections(self):
+        query = """
+            subscription { lowStockProduct(threshold: 5) {
+                name orders { edges { node { customer { name } } } }
+            } }
+        """
+
+        async def first_event():
+            results = await subscribe(schema, query)
+            waiting = asyncio.ensure_future(results.__anext__())
+            await asyncio.sleep(0)
+            get_pubsub().publish(PRODUCT_SAVED, {"id": self.product.pk, "stock": self.product.stock})
+            try:
+                return await asyncio.wait_for(waiting, 5)
+            finally:
+                await results.aclose()
+
+        result = async_to_sync(first_event)()
+        self.assertIsNone(result.errors)
+        self.assertEqual(
+            result.data["lowStockProduct"],
+            {"name": "Scarce", "orders": {"edges": [{"node": {"customer": {"name": "Subscriber"}}}]}},
+        )
+
+    def test_low_stock_fires_only_when_crossing_the_threshold(self):
+        sentinel = Product.objects.create(name="Sentinel", price=Decimal("1.00"))
+        published = []
+        with mock.patch("crm.signals.get_pubsub") as get_pubsub_mock:
+            get_pubsub_mock.return_value.publish.side_effect = lambda channel, message: published.append(message)
+            with self.captureOnCommitCallbacks(execute=True):
+                product = Product.objects.get(pk=self.product.pk)
+                for name, stock in (("Renamed", 2), ("Restocked", 8), ("Sold", 4)):
+                    product.name, product.stock = name, stock
+                    product.save()
+        self.assertEqual([(message["previous"], message["stock"]) for message in published], [(2, 2), (2, 8), (8, 4)])
+
+        async def events():
+            results = await subscribe(schema, "subscription { lowStockProduct(threshold: 5) { name } }")
+            waiting = asyncio.ensure_future(results.__anext__())
+            await asyncio.sleep(0)
+            for message in published + [{"id": sentinel.pk, "stock": 0, "previous": None}]:
+                get_pubsub().publish(PRODUCT_SAVED, message)
+            names = [(await asyncio.wait_for(waiting, 5)).data["lowStockProduct"]["name"]]
+            while names[-1] != "Sentinel":
+                names.append((await asyncio.wait_for(results.__anext__(), 5)).data["lowStockProduct"]["name"])
+            await results.aclose()
+            return names
+
+        # Only the 8 -> 4 save crosses the threshold (the product is read as "Sold")
+        self.assertEqual(async_to_sync(events)(), ["Sold", "Sentinel"])
+
+    def test_failing_operation_sends_an_error_frame(self):
+        sent = []
+
+        async def send(message):
+            sent.append(json.loads(message["text"]))
+
+        async def run_operation():
+            ws = Connection(schema, {}, GRAPHQL_TRANSPORT_WS, send)
+            with mock.patch("crm.graphql_ws.subscribe", side_effect=RuntimeError("boom")):
+                await ws.handle({"type": "subscribe", "id": "1", "payload": {"query": "subscription { orderCreated { id } }"}})
+                await asyncio.gather(*ws.operations.values())
+            return ws
+
+        with self.assertLogs("crm.graphql_ws", level="ERROR") as logs:
+            ws = async_to_sync(run_operation)()
+        self.assertEqual(sent, [{"type": "error", "id": "1", "payload": [{"message": "Subscription failed."}]}])
+        self.assertIn("RuntimeError: boom", logs.output[0])
+        self.assertEqual(ws.operations, {})
+
+    def test_publish_failure_does_not_fail_the_write(self):
+        with mock.patch("crm.signals.get_pubsub", side_effect=ConnectionError("pub/sub down")):
+            with self.assertLogs(level="ERROR"), self.captureOnCommitCallbacks(execute=True):
+                Product.objects.filter(pk=self.product.pk).get().save()
+        self.assertTrue(Product.objects.filter(pk=self.product.pk).exists())
+
+
+# -------------------- COMPACT CONNECTIONS --------------------
+class CompactConnectionTests(TestCase):
+    """
+    Compact (values_list) and model-backed connection pages return the same data.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        customer = Customer.objects.create(name="Compact", email="compact@example.com")
+        products = Product.objects.bulk_create(
+            [Product(name=f"Compact {i}", price=Decimal(i + 1), stock=i) for i in range(4)]
+        )
+        order = Order.objects.create(customer=customer, total_amount=Decimal("3.00"), order_date=timezone.now())
+        order.products.set(products[:2])
+
+    def page(self, query, compact):
+        with override_settings(CRM_COMPACT_CONNECTIONS=compact):
+            with CaptureQueriesContext(connection) as queries:
+                data = run(query)
+        return data, [q["sql"] for q in queries]
+
+    def test_scalar_page_matches_model_page(self):
+        query = """
+            { allProducts(first: 2, after: "YXJyYXljb25uZWN0aW9uOjA=") {
+                totalCount pageInfo { hasNextPage } edges { cursor node { __typename id name price } }
+            } }
+        """
+        compact, compact_sql = self.page(query, True)
+        model, model_sql = self.page(query, False)
+        self.assertEqual(compact, model)
+        self.assertEqual([edge["node"]["name"] for edge in compact["allProducts"]["edges"]], ["Compact 1", "Compact 2"])
+        self.assertFalse(any('"crm_product"."stock"' in sql for sql in compact_sql))
+        self.assertTrue(any('"crm_product"."stock"' in sql for sql in model_sql))
+
+    def test_relation_selection_falls_back_to_models(self):
+        query = """
+            { allProducts { edges { node { id name orders { edges { node { totalAmount } } } } } } }
+        """
+        compact, compact_sql = self.page(query, True)
+        model, model_sql = self.page(query, False)
+        self.assertEqual(compact, model)
+        self.assertEqual(compact_sql, model_sql)
+        self.assertEqual(len(compact["allProducts"]["edges"][0]["node"]["orders"]["edges"]), 1)
+
+
+# -------------------- BATCHED GRAPHQL --------------------
+class BatchGraphQLTests(TestCase):
+    """
+    A malformed entry fails on its own; the rest of the batch still runs.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        Customer.objects.create(name="Batched", email="batched@example.com")
+
+    def test_malformed_entries_get_their_own_errors(self):
+        response = Client().post(
+            "/graphql/batch/",
+            [
+                "not an object",
+                {"id": "bad-variables", "query": "{ allCustomers { totalCount } }", "variables": "{"},
+                {"id": "no-query"},
+                {"id": "ok", "query": "{ allCustomers { totalCount } }"},
+            ],
+            content_type="application/json",
+        )
+        self.assertEqual(response.status_code, 400)
+        results = json.loads(response.content)
+        self.assertEqual([result["status"] for result in results], [400, 400, 400, 200])
+        self.assertEqual([result["id"] for result in results], [None, "bad-variables", "no-query", "ok"])
+        self.assertIn("errors", results[0])
+        self.assertEqual(results[3]["data"], {"allCustomers": {"totalCount": 1}})
+
+
+# -------------------- COMPRESSION --------------------
+class CompressionTests(TestCase):
+    """
+    Accept-Encoding negotiation and compression of large JSON responses.
+    """
+
+    def negotiate(self, accept_encoding, with_brotli=True):
+        request = RequestFactory().get("/graphql/", HTTP_ACCEPT_ENCODING=accept_encoding)
+        with mock.patch("crm.views.brotli", mock.Mock() if with_brotli else None):
+            return negotiate_encoding(request)
+
+    def test_negotiation_follows_q_values(self):
+        cases = [
+            ("gzip, deflate, br", "br", "gzip"),
+            ("gzip;q=1.0, br;q=0.5", "gzip", "gzip"),
+            ("br;q=0.8, gzip;q=0.8", "br", "gzip"),
+            ("br, gzip;q=0", "br", None),
+            ("*", "br", "gzip"),
+            ("*;q=0.5, gzip;q=0", "br", None),
+            ("identity", None, None),
+            ("", None, None),
+        ]
+        for accept_encoding, with_brotli, without_brotli in cases:
+            with self.subTest(accept_encoding=accept_encoding):
+                self.assertEqual(self.negotiate(accept_encoding), with_brotli)
+                self.assertEqual(self.negotiate(accept_encoding, with_brotli=False), without_brotli)
+
+    def compress(self, body, accept_encoding):
+        request = RequestFactory().get("/graphql/", HTTP_ACCEPT_ENCODING=accept_encoding)
+        with mock.patch("crm.views.brotli", None):
+            return compress_response(request, HttpResponse(body, content_type="application/json"))
+
+    @override_settings(CRM_GRAPHQL_COMPRESS_MIN_BYTES=100)
+    def test_bodies_from_the_threshold_are_compressed(self):
+        body = json.dumps({"data": {"names": ["customer"] * 20}}).encode()
+        response = self.compress(body, "gzip")
+        self.assertEqual(response["Content-Encoding"], "gzip")
+        self.assertEqual(response["Vary"], "Accept-Encoding")
+        self.assertEqual(int(response["Content-Length"]), len(response.content))
+        self.assertEqual(gzip.decompress(response.content), body)
+
+        small = self.compress(b'{"data": {}}', "gzip")
+        self.assertEqual(small.content, b'{"data": {}}')
+        self.assertFalse(small.has_header("Content-Encoding"))
+        self.assertFalse(small.has_header("Vary"))
+
+    @override_settings(CRM_GRAPHQL_COMPRESS_MIN_BYTES=100)
+    def test_identity_fallback_still_varies(self):
+        body = json.dumps({"data": {"names": ["customer"] * 20}}).encode()
+        response = self.compress(body, "gzip;q=0, identity")
+        self.assertEqual(response.content, body)
+        self.assertFalse(response.has_header("Content-Encoding"))
+        self.assertEqual(response["Vary"], "Accept-Encoding")
+
+    @override_settings(CRM_GRAPHQL_COMPRESS_MIN_BYTES=0)
+    def test_graphql_view_compresses(self):
+        with mock.patch("crm.views.brotli", None):
+            response = Client().post(
+                "/graphql/", {"query": "{ allCustomers { totalCount } }"},
+                content_type="application/json", HTTP_ACCEPT_ENCODING="gzip",
+            )
+        self.assertEqual(response["Content-Encoding"], "gzip")
+        self.assertEqual(json.loads(gzip.decompress(response.content)), {"data": {"allCustomers": {"totalCount": 0}}})
+
+
+# -------------------- HTTP CACHING --------------------
+class ETagTests(TestCase):
+    """
+    ETags are opt-in, since model versions are only as shared as the cache.
+    """
+
+    query = {"query": "{ allProducts { totalCount } }"}
+
+    def test_no_etag_by_default(self):
+        response = Client().get("/graphql/", self.query)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn("ETag", response)
+        self.assertIn("Cache-Control", response)
+
+    @override_settings(CRM_GRAPHQL_ETAGS=True)
+    def test_matching_etag_gets_304(self):
+        etag = Client().get("/graphql/", self.query)["ETag"]
+        response = Client().get("/graphql/", self.query, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+    @override_settings(CRM_GRAPHQL_ETAGS=True)
+    def test_check_warns_about_process_local_cache(self):
+        self.assertEqual([warning.id for warning in check_etag_cache(None)], ["crm.W001"])
+
+
+# -------------------- GLOBAL IDS --------------------
+class GlobalIDArgumentTests(TestCase):
+    """
+    Malformed IDs and IDs of another type resolve to nothing.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.customer = Customer.objects.create(name="Identified", email="identified@example.com")
+        cls.product = Product.objects.create(name="Identified", price=Decimal("1.00"), stock=5)
+
+    def test_customer_lookup(self):
+        query = "query ($id: ID!) { customer(id: $id) { name } }"
+        for value, expected in [
+            (str(self.customer.pk), {"name": "Identified"}),
+            (to_global_id("CustomerType", self.customer.pk), {"name": "Identified"}),
+            ("abc", None),
+            (to_global_id("ProductType", self.customer.pk), None),
+            (to_global_id("CustomerType", "abc"), None),
+        ]:
+            with self.subTest(value=value):
+                result = schema.execute(query, variables={"id": value})
+                self.assertIsNone(result.errors)
+                self.assertEqual(result.data["customer"], expected)
+
+    def create_order(self, customer_id, reservation_ids=()):
+        result = schema.execute(
+            "mutation ($input: OrderInput!) { createOrder(input: $input) { order { id } errors } }",
+            variables={
+                "input": {
+                    "customerId": customer_id,
+                    "productIds": [to_global_id("ProductType", self.product.pk)],
+                    "reservationIds": list(reservation_ids),
+                }
+            },
+        )
+        self.assertIsNone(result.errors)
+        return result.data["createOrder"]
+
+    def test_create_order_rejects_other_types_id(self):
+        created = self.create_order(to_global_id("ProductType", self.product.pk))
+        self.assertEqual(created["errors"], ["Invalid customer ID."])
+
+    def test_create_order_ignores_malformed_reservation_ids(self):
+        created = self.create_order(to_global_id("CustomerType", self.customer.pk), ["abc"])
+        self.assertIsNone(created["errors"])
+        self.assertIsNotNone(created["order"])
+
+
+# -------------------- TOP-N CONNECTIONS --------------------
+class TopNConnectionTests(TestCase):
+    """
+    Nested orders pages prefetched for a whole customers page match the
+    pages each customer resolves on its own.
+    """
+
+    ORDERS = """
+        orders(first: 2, after: $after, offset: $offset, orderBy: "-totalAmount") {
+            totalCount pageInfo { hasNextPage } edges { cursor node { totalAmount } }
+        }
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.customers = Customer.objects.bulk_create(
+            [Customer(name=f"Top {i}", email=f"top{i}@example.com") for i in range(3)]
+        )
+        Order.objects.bulk_create(
+            [
+                Order(customer=customer, total_amount=Decimal(amount), order_date=timezone.now())
+                for customer, amounts in zip(cls.customers, ([3, 1, 5, 2, 4], [10, 20], []))
+                for amount in amounts
+            ]
+        )
+
+    def customers_page(self, after=None, offset=None):
+        query = "query ($after: String, $offset: Int) { allCustomers { edges { node { name %s } } } }" % self.ORDERS
+        with CaptureQueriesContext(connection) as queries:
+            data = run(query, {"after": after, "offset": offset})
+        return [edge["node"]["orders"] for edge in data["allCustomers"]["edges"]], [q["sql"] for q in queries]
+
+    def customer_orders(self, customer, after=None, offset=None):
+        query = "query ($id: ID!, $after: String, $offset: Int) { node(id: $id) { ... on CustomerType { %s } } }" % self.ORDERS
+        return run(query, {"id": to_global_id("CustomerType", customer.pk), "after": after, "offset": offset})["node"]["orders"]
+
+    def test_window_matches_per_customer_pages(self):
+        after = to_global_id("arrayconnection", 0)
+        pages, sql = self.customers_page(after)
+        self.assertEqual(pages, [self.customer_orders(customer, after) for customer in self.customers])
+        self.assertEqual(
+            [[Decimal(edge["node"]["totalAmount"]) for edge in page["edges"]] for page in pages],
+            [[4, 3], [10], []],
+        )
+        self.assertEqual([page["pageInfo"]["hasNextPage"] for page in pages], [True, False, False])
+        self.assertEqual([page["totalCount"] for page in pages], [5, 2, 0])
+        # customers count, customers with the totalCount subquery, one windowed orders query
+        self.assertEqual(len(sql), 3)
+        self.assertIn('"_orders_total"', sql[1])
+        self.assertIn("ROW_NUMBER()", sql[2])
+
+    def test_first_page_and_offset(self):
+        pages, _ = self.customers_page()
+        self.assertEqual(pages, [self.customer_orders(customer) for customer in self.customers])
+        self.assertEqual(
+            [[Decimal(edge["node"]["totalAmount"]) for edge in page["edges"]] for page in pages],
+            [[5, 4], [20, 10], []],
+        )
+        self.assertEqual([page["pageInfo"]["hasNextPage"] for page in pages], [True, False, False])
+
+        pages, _ = self.customers_page(offset=3)
+        self.assertEqual(pages, [self.customer_orders(customer, offset=3) for customer in self.customers])
+        self.assertEqual(
+            [[Decimal(edge["node"]["totalAmount"]) for edge in page["edges"]] for page in pages],
+            [[2, 1], [], []],
+        )
+
+
+# -------------------- INVENTORY --------------------
+class InventoryTests(TestCase):
+    """
+    Reservations, their expiry, and the locked fallback of sharded stock.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.customer = Customer.objects.create(name="Stocked", email="stocked@example.com")
+        cls.product = Product.objects.create(name="Stocked", price=Decimal("2.00"), stock=10)
+
+    def setUp(self):
+        cache.clear()  # shard counts are cached per product id
+
+    def stock(self):
+        return Product.objects.get(pk=self.product.pk).stock
+
+    def create_order(self, reservation_ids=()):
+        order = Order.objects.create(customer=self.customer, total_amount=Decimal("2.00"), order_date=timezone.now())
+        return order, take_for_order(order, [self.product.pk], reservation_ids)
+
+    def create_order_mutation(self):
+        result = schema.execute(
+            "mutation ($input: OrderInput!) { createOrder(input: $input) { order { id } errors } }",
+            variables={
+                "input": {
+                    "customerId": to_global_id("CustomerType", self.customer.pk),
+                    "productIds": [to_global_id("ProductType", self.product.pk)],
+                }
+            },
+        )
+        self.assertIsNone(result.errors)
+        return result.data["createOrder"]
+
+    def test_create_order_ignores_stock_by_default(self):
+        Product.objects.filter(pk=self.product.pk).update(stock=0)
+        self.assertIsNone(self.create_order_mutation()["errors"])
+        self.assertEqual(self.stock(), 0)
+
+    @override_settings(CRM_ORDERS_TAKE_STOCK=True)
+    def test_create_order_takes_stock_when_enabled(self):
+        self.assertIsNone(self.create_order_mutation()["errors"])
+        self.assertEqual(self.stock(), 9)
+
+        Product.objects.filter(pk=self.product.pk).update(stock=0)
+        created = self.create_order_mutation()
+        self.assertEqual(created, {"order": None, "errors": [f"Insufficient stock for product {self.product.pk}."]})
+        self.assertEqual(Order.objects.count(), 1)
+
+    @override_settings(CRM_ORDERS_TAKE_STOCK=True)
+    def test_sharded_take_reports_summed_stock(self):
+        set_stock_shards(self.product.pk, 4)
+        Product.objects.filter(pk=self.product.pk).update(stock=999)  # stale snapshot
+        published = []
+        with mock.patch("crm.inventory.get_pubsub") as get_pubsub_mock:
+            get_pubsub_mock.return_value.publish.side_effect = lambda channel, message: published.append(message)
+            with self.captureOnCommitCallbacks(execute=True):
+                self.assertIsNone(self.create_order_mutation()["errors"])
+        event = OutboxEvent.objects.get(aggregate_type="product", event_type="updated")
+        self.assertEqual(event.payload["stock"], 9)
+        self.assertEqual(published[-1], {"id": self.product.pk, "stock": 9, "previous": 10})
+
+    def test_order_attaches_one_unit_and_returns_the_surplus(self):
+        reservation = reserve_stock(self.product.pk, 3, customer_id=self.customer.pk)
+        self.assertEqual(self.stock(), 7)
+        order, changed = self.create_order([reservation.pk])
+        reservation.refresh_from_db()
+        self.assertEqual((reservation.order, reservation.quantity, reservation.expires_at), (order, 1, None))
+        self.assertEqual(self.stock(), 9)
+        self.assertEqual(changed, {self.product.pk})
+
+    def test_order_without_reservation_takes_stock(self):
+        _, changed = self.create_order()
+        self.assertEqual(self.stock(), 9)
+        self.assertEqual(changed, {self.product.pk})
+
+    def test_other_customers_reservation_is_rejected(self):
+        other = Customer.objects.create(name="Other", email="other@example.com")
+        reservation = reserve_stock(self.product.pk, 1, customer_id=other.pk)
+        with self.assertRaisesMessage(InvalidReservation, f"Invalid reservation ID: {reservation.pk}"):
+            self.create_order([reservation.pk])
+        reservation.refresh_from_db()
+        self.assertIsNone(reservation.order)
+        self.assertEqual(self.stock(), 9)
+
+    def test_expired_reservation_is_released_not_attached(self):
+        reservation = reserve_stock(self.product.pk, 2, ttl=0, customer_id=self.customer.pk)
+        self.create_order([reservation.pk])
+        self.assertEqual(self.stock(), 7)
+        self.assertEqual(release_expired_reservations(), 1)
+        self.assertEqual(self.stock(), 9)
+        self.assertFalse(StockReservation.objects.filter(pk=reservation.pk).exists())
+
+    def test_archiving_returns_units_held_by_attached_reservations(self):
+        reservation = reserve_stock(self.product.pk, 1, customer_id=self.customer.pk)
+        order, _ = self.create_order([reservation.pk])
+        order.order_date = datetime(2020, 1, 1, tzinfo=dt_timezone.utc)
+        order.save()
+        StockReservation.objects.filter(pk=reservation.pk).update(quantity=3)  # attached before the surplus return
+        self.assertEqual(self.stock(), 9)
+        self.assertEqual(archive_orders_before(datetime(2023, 1, 1, tzinfo=dt_timezone.utc)), 1)
+        self.assertEqual(self.stock(), 11)
+        self.assertFalse(StockReservation.objects.exists())
+
+    def test_sharded_take_falls_back_to_spreading_over_buckets(self):
+        set_stock_shards(self.product.pk, 4)  # buckets of 3, 3, 2, 2
+        take_stock(self.product.pk, 5)
+        self.assertEqual(sum(StockShard.objects.filter(product=self.product).values_list("count", flat=True)), 5)
+        with self.assertRaises(InsufficientStock):
+            take_stock(self.product.pk, 6)
+        return_stock(self.product.pk, 5)
+        self.assertEqual(compact_product_stock(self.product.pk), 10)
+        self.assertEqual(
+            list(StockShard.objects.filter(product=self.product).order_by("bucket").values_list("count", flat=True)),
+            [3, 3, 2, 2],
+        )
+
+    def test_reserve_stock_mutation_records_events(self):
+        result = schema.execute(
+            "mutation ($customer: ID!, $id: ID!) "
+            "{ reserveStock(customerId: $customer, productId: $id, quantity: 2) { reservation { id } errors } }",
+            variables={
+                "customer": to_global_id("CustomerType", self.customer.pk),
+                "id": to_global_id("ProductType", self.product.pk),
+            },
+        )
+        self.assertIsNone(result.errors)
+        self.assertEqual(
+            list(OutboxEvent.objects.order_by("id").values_list("aggregate_type", "event_type")),
+            [("stockreservation", "created"), ("product", "updated")],
+        )
+        self.assertEqual(OutboxEvent.objects.get(aggregate_type="product").payload["stock"], 8)
+
+
+# -------------------- ADMISSION CONTROL --------------------
+class RateLimitTests(TestCase):
+    """
+    Clients are keyed by known API keys only, fragments cost what their
+    inline selections cost, and requests over the concurrency cap are shed.
+    """
+
+    def test_unknown_api_keys_share_the_ip_bucket(self):
+        factory = RequestFactory()
+        keys = {
+            client_key(factory.get("/graphql/", HTTP_X_API_KEY=api_key))
+            for api_key in ("rotated-1", "rotated-2", "")
+        }
+        self.assertEqual(keys, {"ip:127.0.0.1"})
+        with self.settings(CRM_RATE_LIMIT_API_KEYS=["partner"]):
+            self.assertTrue(client_key(factory.get("/graphql/", HTTP_X_API_KEY="partner")).startswith("key:"))
+
+    def test_fragments_cost_like_inline_selections(self):
+        inline = "{ allCustomers(first: 50) { edges { node { name orders(first: 20) { edges { node { id } } } } } } }"
+        fragments = """
+            { allCustomers(first: 50) { ...Customers } }
+            fragment Customers on CustomerTypeConnection { edges { node { ...Orders } } }
+            fragment Orders on CustomerType { name orders(first: 20) { edges { node { id } } } }
+        """
+        cost = operation_cost(schema.graphql_schema, inline)
+        self.assertEqual(cost, 11)  # 50 customers + 50 x 20 orders, 100 nodes per token
+        self.assertEqual(operation_cost(schema.graphql_schema, fragments), cost)
+
+    def test_bulk_mutation_cost_scales_with_its_inputs(self):
+        query = "mutation ($rows: [CustomerInput]!) { bulkCreateCustomers(inputs: $rows) { errors } }"
+        rows = [{"name": f"Bulk {i}", "email": f"bulk{i}@example.com"} for i in range(40)]
+        self.assertEqual(operation_cost(schema.graphql_schema, query, {"rows": rows[:1]}), 6)
+        self.assertEqual(operation_cost(schema.graphql_schema, query, {"rows": rows}), 45)
+        inline = 'mutation { bulkCreateCustomers(inputs: [{name: "A", email: "a@example.com"}]) { errors } }'
+        self.assertEqual(operation_cost(schema.graphql_schema, inline), 6)
+
+    def test_cache_store_refills_like_a_token_bucket(self):
+        cache.clear()
+        store, clock = CacheStore(), [1000.25]
+        with mock.patch("time.time", lambda: clock[0]):
+            self.assertEqual([store.consume("ip:1", 1, 2, 10)[0] for _ in range(11)], [True] * 10 + [False])
+            self.assertAlmostEqual(store.consume("ip:1", 1, 2, 10)[1], 0.5)
+            # A fixed window would start over at the next boundary; the bucket
+            # has refilled four tokens after two seconds
+            clock[0] += 2
+            self.assertEqual([store.consume("ip:1", 1, 2, 10)[0] for _ in range(5)], [True] * 4 + [False])
+            clock[0] += 60
+            self.assertEqual(store.consume("ip:1", 10, 2, 10), (True, 0))
+
+    @override_settings(CRM_MAX_CONCURRENT_REQUESTS=1, CRM_ADMISSION_RETRY_AFTER=3)
+    def test_requests_over_the_concurrency_cap_are_shed_without_waiting(self):
+        factory = RequestFactory()
+        shed = []
+
+        def get_response(request):
+            # A second request arrives while this one holds the only slot
+            shed.append(middleware(factory.get("/graphql/", {"query": "{ allCustomers { totalCount } }"})))
+            return HttpResponse()
+
+        store = LocalMemoryStore()
+        with mock.patch("crm.middleware.get_store", return_value=store):
+            middleware = GraphQLAdmissionMiddleware(get_response)
+            start = time.monotonic()
+            response = middleware(factory.get("/graphql/", {"query": "{ allCustomers { totalCount } }"}))
+        self.assertLess(time.monotonic() - start, 1)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual((shed[0].status_code, shed[0]["Retry-After"]), (429, "3"))
+        self.assertEqual(store.counters(), {"admitted": 1, "rejected_rate": 0, "rejected_overload": 1})
+        self.assertEqual(middleware.gate.active, 0)
+
+
+# -------------------- PROFILING --------------------
+class ProfilingTests(TestCase):
+    """
+    Overlapping profiled requests restore the switch interval they found.
+    """
+
+    def test_overlapping_profiles_restore_switch_interval(self):
+        original = sys.getswitchinterval()
+        factory = RequestFactory()
+        with tempfile.TemporaryDirectory() as directory, self.settings(CRM_PROFILING_DIR=directory):
+            first = RequestProfiler(factory.get("/graphql/"))
+            second = RequestProfiler(factory.get("/graphql/"))
+            first.__enter__()
+            second.__enter__()
+            first.__exit__(None, None, None)
+            self.assertLess(sys.getswitchinterval(), original)  # second is still sampling
+            second.__exit__(None, None, None)
+        self.assertEqual(sys.getswitchinterval(), original)
+
+
+# -------------------- ADMIN --------------------
+class EstimatedRowCountTests(TestCase):
+    """
+    The SQLite estimate ignores rows removed from the start of the table.
+    """
+
+    def test_estimate_after_archiving_oldest_rows(self):
+        customer = Customer.objects.create(name="Counted", email="counted@example.com")
+        orders = Order.objects.bulk_create(
+            [Order(customer=customer, total_amount=Decimal(i), order_date=timezone.now()) for i in range(10)]
+        )
+        Order.objects.filter(pk__in=[order.pk for order in orders[:8]]).delete()
+        self.assertEqual(estimated_row_count(Order), 2)
+        Order.objects.all().delete()
+        self.assertIsNone(estimated_row_count(Order))
+
+
+# -------------------- ARCHIVE --------------------
+class ArchivedOrderReadTests(TestCase):
+    """
+    includeArchived pages load products in bulk, and archived orders'
+    global IDs resolve.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        customer = Customer.objects.create(name="Historic", email="historic@example.com")
+        products = Product.objects.bulk_create(
+            [Product(name=f"Historic {i}", price=Decimal("1.00")) for i in range(3)]
+        )
+        orders = Order.objects.bulk_create(
+            [
+                Order(
+                    customer=customer, total_amount=Decimal(i),
+                    order_date=datetime(2020 + i, 1, 1, tzinfo=dt_timezone.utc),
+                )
+                for i in range(6)
+            ]
+        )
+        for i, order in enumerate(orders):
+            order.products.set(products[: i % 3 + 1])
+        archive_orders_before(datetime(2023, 1, 1, tzinfo=dt_timezone.utc))
+        cls.archived_id = to_global_id("OrderType", orders[0].pk)
+        cls.live_id = to_global_id("OrderType", orders[5].pk)
+
+    def test_page_prefetches_products_for_live_and_archived_rows(self):
+        query = """
+            { allOrders(includeArchived: true) { edges { node { archived products { edges { node { name } } } } } } }
+        """
+        with CaptureQueriesContext(connection) as queries:
+            result = schema.execute(query)
+        self.assertIsNone(result.errors)
+        nodes = [edge["node"] for edge in result.data["allOrders"]["edges"]]
+        self.assertEqual([node["archived"] for node in nodes], [True] * 3 + [False] * 3)
+        self.assertEqual([len(node["products"]["edges"]) for node in nodes], [1, 2, 3, 1, 2, 3])
+        self.assertLessEqual(len(queries), 5)
+
+    def test_archived_global_ids_resolve(self):
+        result = schema.execute(
+            "query ($id: ID!, $ids: [ID!]!) { node(id: $id) { id } nodes(ids: $ids) { id } }",
+            variables={"id": self.archived_id, "ids": [self.live_id, self.archived_id]},
+        )
+        self.assertIsNone(result.errors)
+        self.assertEqual(result.data["node"], {"id": self.archived_id})
+        self.assertEqual(result.data["nodes"], [{"id": self.live_id}, {"id": self.archived_id}])
+
+
+# -------------------- CUSTOMER SEGMENTS --------------------
+class SegmentScoringTests(TestCase):
+    """
+    RFM quintile scores and segments for fixed metrics, from both scoring passes.
+    """
+
+    # (recency days, frequency, monetary) -> (r, f, m, segment)
+    CUSTOMERS = [
+        ((1.0, 10, 500.0), (5, 5, 5, "champions")),
+        ((5.0, 6, 100.0), (4, 5, 4, "champions")),
+        ((20.0, 4, 300.0), (3, 4, 5, "loyal")),
+        ((60.0, 2, 50.0), (2, 3, 3, "at_risk")),
+        ((200.0, 1, 20.0), (1, 2, 2, "hibernating")),
+        ((math.nan, 0, 0.0), (0, 0, 0, "prospect")),
+    ]
+
+    def metrics(self, rows, customer_ids=None):
+        metrics = RFMMetrics()
+        for index, (recency, frequency, monetary) in enumerate(rows):
+            metrics.customer_ids.append(customer_ids[index] if customer_ids else index + 1)
+            metrics.recency.append(recency)
+            metrics.frequency.append(frequency)
+            metrics.monetary.append(monetary)
+        return metrics
+
+    def rows(self, scores):
+        r, f, m, segment = (score.tolist() for score in scores)
+        return [(r[i], f[i], m[i], segments.SEGMENTS[segment[i]]) for i in range(len(r))]
+
+    def test_python_scores_known_customers(self):
+        metrics = self.metrics([row for row, _ in self.CUSTOMERS])
+        self.assertEqual(self.rows(segments._score_python(metrics)), [expected for _, expected in self.CUSTOMERS])
+
+    def test_without_orders_everyone_is_a_prospect(self):
+        metrics = self.metrics([(math.nan, 0, 0.0)] * 3)
+        self.assertEqual(self.rows(segments._score_python(metrics)), [(0, 0, 0, "prospect")] * 3)
+
+    @skipUnless(segments.numpy, "NumPy is not installed")
+    def test_vectorized_scores_match_python(self):
+        known = self.metrics([row for row, _ in self.CUSTOMERS])
+        self.assertEqual(self.rows(segments._score_vectorized(known)), [expected for _, expected in self.CUSTOMERS])
+        # Ties and uneven spreads around the quintile edges
+        varied = self.metrics(
+            [(math.nan, 0, 0.0) if i % 7 == 0 else (float(i % 13), i % 5 + 1, float(i % 11) * 9.5) for i in range(200)]
+        )
+        self.assertEqual(self.rows(segments._score_vectorized(varied)), self.rows(segments._score_python(varied)))
+
+    def test_store_segments_upserts_rows(self):
+        customers = Customer.objects.bulk_create(
+            [Customer(name=f"RFM {i}", email=f"rfm{i}@example.com") for i in range(len(self.CUSTOMERS))]
+        )
+        metrics = self.metrics([row for row, _ in self.CUSTOMERS], [customer.pk for customer in customers])
+        computed_at = timezone.now()
+        for _ in range(2):  # the second pass updates in place
+            store_segments(metrics, segments._score_python(metrics), computed_at, chunk_size=4)
+        stored = CustomerSegment.objects.order_by("customer_id").values_list(
+            "segment", "recency_days", "frequency", "monetary", "r_score", "f_score", "m_score"
+        )
+        self.assertEqual(
+            list(stored),
+            [
+                (segment, None if math.isnan(recency) else int(recency), frequency, Decimal(f"{monetary:.2f}"), r, f, m)
+                for (recency, frequency, monetary), (r, f, m, segment) in self.CUSTOMERS
+            ],
+        )
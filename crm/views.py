@@ -1,3 +1,322 @@
-from django.shortcuts import render
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import gzip
+import json
+import re
 
-# Create your views here.
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connection, connections
+from django.http import (
+    HttpResponse, HttpResponseBadRequest, HttpResponseNotAllowed, HttpResponseNotModified,
+)
+from django.utils.cache import patch_vary_headers
+from django.utils.decorators import method_decorator
+from django.utils.http import parse_etags
+from django.views.decorators.csrf import ensure_csrf_cookie
+from graphene_django.views import GraphQLView, HttpError
+from graphql import GraphQLError, OperationType, get_operation_ast, parse
+
+from .caching import analyze_operation, compute_etag, model_versions
+from .profiling import PROFILE_ID_HEADER, RequestProfiler, profiling_requested
+from .singleflight import flight_key, get_flights, read_operation
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - optional speedup
+    orjson = None
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover - optional encoding
+    brotli = None
+
+ACCEPT_ENCODING_RE = re.compile(r"\s*([a-z*]+)\s*(?:;\s*q=([0-9.]+))?")
+
+
+# -------------------- SERIALIZATION --------------------
+def _orjson_default(value):
+    # orjson handles datetimes natively; Decimals (e.g. totalAmount) go out as strings
+    return str(value)
+
+
+def fast_json_dumps(data, pretty=False):
+    """
+    Encodes to UTF-8 bytes with orjson when installed, else stdlib json.
+    """
+    if orjson is not None:
+        option = orjson.OPT_INDENT_2 | orjson.OPT_SORT_KEYS if pretty else 0
+        return orjson.dumps(data, default=_orjson_default, option=option)
+    if pretty:
+        return json.dumps(data, sort_keys=True, indent=2, separators=(",", ": "), cls=DjangoJSONEncoder).encode()
+    return json.dumps(data, separators=(",", ":"), cls=DjangoJSONEncoder).encode()
+
+
+# -------------------- COMPRESSION --------------------
+def negotiate_encoding(request):
+    """
+    Picks br or gzip from Accept-Encoding by q-value, preferring br on ties.
+    """
+    offered = {}
+    for match in ACCEPT_ENCODING_RE.finditer(request.headers.get("Accept-Encoding", "").lower()):
+        try:
+            offered[match.group(1)] = float(match.group(2) or 1)
+        except ValueError:
+            continue
+    candidates = ["br", "gzip"] if brotli is not None else ["gzip"]
+    ranked = [(offered.get(name, offered.get("*", 0)), -i, name) for i, name in enumerate(candidates)]
+    quality, _, name = max(ranked)
+    return name if quality > 0 else None
+
+
+def compress_response(request, response):
+    """
+    Compresses a JSON response above CRM_GRAPHQL_COMPRESS_MIN_BYTES in one
+    pass; the body is already in memory, so there is nothing to stream.
+    """
+    if response.streaming or response.has_header("Content-Encoding"):
+        return response
+    if len(response.content) < settings.CRM_GRAPHQL_COMPRESS_MIN_BYTES:
+        return response
+    patch_vary_headers(response, ("Accept-Encoding",))
+    encoding = negotiate_encoding(request)
+    if encoding is None:
+        return response
+
+    if encoding == "br":
+        response.content = brotli.compress(response.content, quality=5)
+    else:
+        response.content = gzip.compress(response.content, compresslevel=6, mtime=0)
+    response["Content-Length"] = str(len(response.content))
+    response["Content-Encoding"] = encoding
+    return response
+
+
+# -------------------- GRAPHQL VIEW --------------------
+class CRMGraphQLView(GraphQLView):
+    """
+    GraphQLView with two opt-in options:
+    `fast_json` encodes results with orjson (when installed) and
+    `compress` negotiates br/gzip for large responses.
+
+    GET queries get Cache-Control, and an ETag with CRM_GRAPHQL_ETAGS (see
+    crm.caching); a matching If-None-Match is answered with 304 without
+    executing the query.
+
+    Authorized clients can ask for a request to be profiled (crm.profiling).
+
+    Identical concurrent query operations share one execution
+    (crm.singleflight).
+    """
+
+    fast_json = False
+    compress = False
+    profiler = None
+
+    def __init__(self, fast_json=None, compress=None, **kwargs):
+        super().__init__(**kwargs)
+        self.fast_json = fast_json if fast_json is not None else self.fast_json
+        self.compress = compress if compress is not None else self.compress
+
+    def dispatch(self, request, *args, **kwargs):
+        if not profiling_requested(request):
+            return self.dispatch_graphql(request, *args, **kwargs)
+        with RequestProfiler(request) as self.profiler:
+            response = self.dispatch_graphql(request, *args, **kwargs)
+        response[PROFILE_ID_HEADER] = self.profiler.profile_id
+        return response
+
+    def dispatch_graphql(self, request, *args, **kwargs):
+        cache_headers = self.get_cache_headers(request)
+        if self.profiler is not None:
+            cache_headers = None  # always execute a profiled request
+        if cache_headers and cache_headers.get("ETag") in parse_etags(request.headers.get("If-None-Match", "")):
+            response = HttpResponseNotModified()
+        else:
+            response = super().dispatch(request, *args, **kwargs)
+            if response.status_code != 200:
+                cache_headers = None
+        for header, value in (cache_headers or {}).items():
+            response[header] = value
+
+        if self.compress and response.get("Content-Type", "").startswith("application/json"):
+            response = compress_response(request, response)
+        return response
+
+    def get_response(self, request, data, show_graphiql=False):
+        key = self.get_flight_key(request, data, show_graphiql)
+        if key is None:
+            return super().get_response(request, data, show_graphiql)
+        response, _ = get_flights().do(
+            key, partial(super().get_response, request, data, show_graphiql), shared=settings.CRM_SINGLE_FLIGHT_SHARED
+        )
+        return response
+
+    def get_flight_key(self, request, data, show_graphiql=False):
+        """
+        Single-flight key for a query operation, else None. Requests inside
+        a transaction or being profiled always execute on their own.
+        """
+        if not settings.CRM_SINGLE_FLIGHT_ENABLED or show_graphiql or self.profiler is not None:
+            return None
+        if connection.in_atomic_block:
+            return None  # may read this transaction's uncommitted writes
+        try:
+            query, variables, operation_name, id = self.get_graphql_params(request, data)
+        except HttpError:
+            return None
+        if not isinstance(query, str):
+            return None
+        operation = read_operation(self.schema.graphql_schema, query, operation_name)
+        if operation is None:
+            return None
+
+        normalized, models = operation
+        authenticated = request.user.is_authenticated
+        variant = [type(self).__name__, self.fast_json, bool(request.GET.get("pretty")), id if self.batch else None]
+        return flight_key(
+            normalized, variables, operation_name, models,
+            scope=str(request.user.pk) if authenticated else "", variant=variant,
+        )
+
+    def get_middleware(self, request):
+        middleware = super().get_middleware(request)
+        if self.profiler is None:
+            return middleware
+        return [*(middleware or []), self.profiler.resolver_middleware]
+
+    def get_cache_headers(self, request):
+        """
+        Cache-Control, plus an ETag with CRM_GRAPHQL_ETAGS, for a GET query
+        operation, else None.
+        """
+        if request.method != "GET" or not request.GET.get("query"):
+            return None
+        if self.graphiql and self.can_display_graphiql(request, request.GET):
+            return None
+        try:
+            query, variables, operation_name, _ = self.get_graphql_params(request, {})
+            document = parse(query)
+        except (HttpError, GraphQLError):
+            return None
+        operation_ast = get_operation_ast(document, operation_name)
+        if operation_ast is None or operation_ast.operation != OperationType.QUERY:
+            return None
+
+        models, max_age = analyze_operation(self.schema.graphql_schema, document, operation_name)
+        authenticated = request.user.is_authenticated
+        visibility = "private" if authenticated else "public"
+        headers = {"Cache-Control": f"{visibility}, max-age={max_age}"}
+        if settings.CRM_GRAPHQL_ETAGS:
+            headers["ETag"] = compute_etag(
+                query, variables, operation_name, model_versions(models),
+                scope=str(request.user.pk) if authenticated else "",
+            )
+        return headers
+
+    def json_encode(self, request, d, pretty=False):
+        if not self.fast_json:
+            return super().json_encode(request, d, pretty=pretty)
+        return fast_json_dumps(d, pretty=self.pretty or pretty or bool(request.GET.get("pretty"))).decode()
+
+
+# -------------------- BATCHED GRAPHQL --------------------
+class BatchGraphQLView(CRMGraphQLView):
+    """
+    Accepts a JSON array of operations and returns an array of results in
+    the same order. Runs of consecutive queries execute concurrently on a
+    thread pool (CRM_GRAPHQL_BATCH_WORKERS); mutations run one at a time
+    and act as barriers, so later reads see their writes. Every operation
+    shares the same request as its context; a malformed operation gets its
+    own error result while the others still run.
+    """
+
+    batch = True
+
+    @method_decorator(ensure_csrf_cookie)
+    def dispatch(self, request, *args, **kwargs):
+        response = self.get_batch_response(request)
+        if self.compress:
+            response = compress_response(request, response)
+        return response
+
+    def get_batch_response(self, request):
+        try:
+            if request.method.lower() != "post":
+                raise HttpError(HttpResponseNotAllowed(["POST"], "Batched GraphQL requests must be POSTed."))
+
+            data = self.parse_body(request)
+            if not isinstance(data, list) or not data:
+                raise HttpError(HttpResponseBadRequest("Batch requests should receive a non-empty JSON list."))
+
+            responses = self.get_batch_responses(request, data)
+            result = "[{}]".format(",".join(response[0] for response in responses))
+            status_code = max(response[1] for response in responses)
+            return HttpResponse(status=status_code, content=result, content_type="application/json")
+
+        except HttpError as e:
+            response = e.response
+            response["Content-Type"] = "application/json"
+            response.content = self.json_encode(request, {"errors": [self.format_error(e)]})
+            return response
+
+    def get_batch_responses(self, request, data):
+        responses = [None] * len(data)
+        reads = []
+
+        for index, entry in enumerate(data):
+            if self.is_query(request, entry):
+                reads.append(index)
+                continue
+            self.run_concurrently(request, data, reads, responses)
+            reads = []
+            responses[index] = self.get_entry_response(request, entry)
+        self.run_concurrently(request, data, reads, responses)
+        return responses
+
+    def run_concurrently(self, request, data, indexes, responses):
+        workers = min(len(indexes), settings.CRM_GRAPHQL_BATCH_WORKERS)
+        # Worker threads use their own DB connections, which cannot see an
+        # open transaction on this one; stay on this thread in that case.
+        if workers <= 1 or connection.in_atomic_block:
+            for index in indexes:
+                responses[index] = self.get_entry_response(request, data[index])
+            return
+
+        def run(entry):
+            try:
+                return self.get_entry_response(request, entry)
+            finally:
+                connections.close_all()
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for index, response in zip(indexes, pool.map(run, [data[i] for i in indexes])):
+                responses[index] = response
+
+    def get_entry_response(self, request, entry):
+        """
+        (result, status) for one entry. A malformed entry gets its own error
+        result instead of failing the whole batch.
+        """
+        try:
+            if not isinstance(entry, dict):
+                raise HttpError(HttpResponseBadRequest("Batch entries should be JSON objects."))
+            return self.get_response(request, entry)
+        except HttpError as e:
+            status_code = e.response.status_code
+            response = {
+                "errors": [self.format_error(e)],
+                "id": entry.get("id") if isinstance(entry, dict) else None,
+                "status": status_code,
+            }
+            return self.json_encode(request, response), status_code
+
+    def is_query(self, request, entry):
+        if not isinstance(entry, dict):
+            return False
+        try:
+            query, _, operation_name, _ = self.get_graphql_params(request, entry)
+            operation_ast = get_operation_ast(parse(query), operation_name)
+        except Exception:
+            return False
+        return operation_ast is not None and operation_ast.operation == OperationType.QUERY
@@ -5,7 +5,7 @@ from django.utils import timezone
 import random
 
 # -------------------- SETUP DJANGO --------------------
-os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'alx_backend_graphql.settings')
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'alx_backend_graphql.settings_jobs')
 django.setup()
 
 from crm.models import Customer, Product, Order